@@ -0,0 +1,117 @@
+from datetime import date
+from typing import Optional
+from logger import logger
+import redis
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB
+
+# Приблизительные счетчики активности в Redis: HyperLogLog для уникальных
+# пользователей и чатов (~12 KB на ключ, погрешность ~0.8%) и хеш сообщений по чатам
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+
+ACTIVITY_PREFIX = "activity:"
+
+# Сколько хранить счетчики: дневные - чуть больше месяца, месячные - чуть больше года
+DAILY_TTL = 40 * 24 * 3600
+MONTHLY_TTL = 400 * 24 * 3600
+
+
+def _users_day_key(day: str) -> str:
+    """HLL уникальных пользователей за день"""
+    return f"{ACTIVITY_PREFIX}users:day:{day}"
+
+
+def _users_month_key(month: str) -> str:
+    """HLL уникальных пользователей за месяц"""
+    return f"{ACTIVITY_PREFIX}users:month:{month}"
+
+
+def _chats_day_key(day: str) -> str:
+    """HLL активных групповых чатов за день"""
+    return f"{ACTIVITY_PREFIX}chats:day:{day}"
+
+
+def _chats_month_key(month: str) -> str:
+    """HLL активных групповых чатов за месяц"""
+    return f"{ACTIVITY_PREFIX}chats:month:{month}"
+
+
+def _chat_updates_key(day: str) -> str:
+    """Хеш chat_id -> количество апдейтов за день"""
+    return f"{ACTIVITY_PREFIX}chat_updates:{day}"
+
+
+def record_activity(user_id: Optional[int], chat_id: Optional[int], is_group: bool) -> None:
+    """
+    Учитывает апдейт в счетчиках активности одним пайплайном Redis.
+
+    Args:
+        user_id: ID пользователя Telegram (None для апдейтов без пользователя)
+        chat_id: ID чата (None для апдейтов без чата)
+        is_group: True для групп и супергрупп
+    """
+    if user_id is None and chat_id is None:
+        return
+
+    day = date.today().isoformat()
+    month = day[:7]
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        if user_id is not None:
+            pipe.pfadd(_users_day_key(day), user_id)
+            pipe.expire(_users_day_key(day), DAILY_TTL)
+            pipe.pfadd(_users_month_key(month), user_id)
+            pipe.expire(_users_month_key(month), MONTHLY_TTL)
+        if chat_id is not None and is_group:
+            pipe.pfadd(_chats_day_key(day), chat_id)
+            pipe.expire(_chats_day_key(day), DAILY_TTL)
+            pipe.pfadd(_chats_month_key(month), chat_id)
+            pipe.expire(_chats_month_key(month), MONTHLY_TTL)
+        if chat_id is not None:
+            pipe.hincrby(_chat_updates_key(day), chat_id, 1)
+            pipe.expire(_chat_updates_key(day), DAILY_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"[Activity] Failed to record activity for user {user_id} in chat {chat_id}: {e}")
+
+
+def get_activity_summary(day: Optional[str] = None, top_chats: int = 10) -> Optional[dict]:
+    """
+    Возвращает DAU/MAU и активность чатов за день без обращения к SQLite.
+
+    Args:
+        day: Дата в формате YYYY-MM-DD (по умолчанию - сегодня)
+        top_chats: Сколько самых активных чатов вернуть
+
+    Returns:
+        dict: Счетчики активности или None при ошибке Redis
+    """
+    day = day or date.today().isoformat()
+    month = day[:7]
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.pfcount(_users_day_key(day))
+        pipe.pfcount(_users_month_key(month))
+        pipe.pfcount(_chats_day_key(day))
+        pipe.pfcount(_chats_month_key(month))
+        pipe.hgetall(_chat_updates_key(day))
+        dau, mau, active_chats_day, active_chats_month, chat_updates = pipe.execute()
+    except Exception as e:
+        logger.error(f"[Activity] Failed to read activity counters for {day}: {e}")
+        return None
+
+    busiest_chats = sorted(
+        ((int(chat_id), int(count)) for chat_id, count in chat_updates.items()),
+        key=lambda item: item[1],
+        reverse=True
+    )[:top_chats]
+
+    return {
+        "date": day,
+        "month": month,
+        "dau": dau,
+        "mau": mau,
+        "active_chats_day": active_chats_day,
+        "active_chats_month": active_chats_month,
+        "chats_with_updates": len(chat_updates),
+        "top_chats": busiest_chats,
+    }
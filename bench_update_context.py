@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк классификации апдейта.
+Сравнивает стоимость вопросов, которые обработчик задает об одном апдейте
+(обрабатывать ли, идентификатор чата, контекст для логов, отвечать ли, личный ли чат):
+отдельными функциями chat_detector, каждая из которых разбирает апдейт заново,
+и через общий UpdateContext, где каждое свойство вычисляется один раз.
+
+Примеры:
+  python bench_update_context.py
+  python bench_update_context.py --iterations 200000
+"""
+
+import argparse
+import time
+
+from telegram import Update
+
+from chat_detector import (
+    UpdateContext, get_chat_identifier, get_log_context, get_update_context, is_private_chat,
+    should_process_message, should_respond_in_chat
+)
+
+BOT_USERNAME = "bench_gpt_bot"
+BOT_ID = 777000
+
+# Длинный текст: is_bot_mentioned переводит его в нижний регистр при каждом вызове
+LONG_TEXT = "Обсуждаем планы на неделю, кто что успел сделать и что осталось. " * 20
+
+
+def build_update(kind: str) -> Update:
+    """Собирает апдейт одного из сценариев в формате Bot API."""
+    user = {"id": 42, "is_bot": False, "first_name": "Bench", "username": "bench_user"}
+    message = {"message_id": 1, "date": int(time.time()), "from": user, "text": LONG_TEXT}
+    if kind == "private":
+        message["chat"] = {"id": 42, "type": "private", "first_name": "Bench"}
+    elif kind == "group_context":
+        message["chat"] = {"id": -100500, "type": "supergroup", "title": "Bench chat"}
+    elif kind == "group_mention":
+        message["chat"] = {"id": -100500, "type": "supergroup", "title": "Bench chat"}
+        message["text"] = f"@{BOT_USERNAME} {LONG_TEXT}"
+        message["entities"] = [{"type": "mention", "offset": 0, "length": len(BOT_USERNAME) + 1}]
+    elif kind == "topic_reply":
+        message["chat"] = {"id": -100500, "type": "supergroup", "title": "Bench chat", "is_forum": True}
+        message["message_thread_id"] = 5
+        message["reply_to_message"] = {
+            "message_id": 0, "date": int(time.time()),
+            "chat": message["chat"],
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bot", "username": BOT_USERNAME},
+            "text": "Предыдущий ответ",
+        }
+    return Update.de_json({"update_id": 1, "message": message}, None)
+
+
+def classify_with_functions(update: Update) -> None:
+    """Вопросы handle_message до UpdateContext: каждая функция разбирает апдейт заново."""
+    if not should_process_message(update):
+        return
+    get_chat_identifier(update)
+    get_log_context(update)
+    should_respond_in_chat(update, BOT_USERNAME, BOT_ID)
+    should_respond_in_chat(update, BOT_USERNAME, BOT_ID)
+    is_private_chat(update)
+
+
+def classify_with_context(update: Update) -> None:
+    """Те же вопросы через общий UpdateContext (как в обработчиках и процессоре апдейтов)."""
+    update_context = UpdateContext(update, BOT_USERNAME, BOT_ID)
+    if not update_context.should_process:
+        return
+    update_context.chat_identifier
+    update_context.log_context
+    update_context.should_respond
+    update_context.should_respond
+    update_context.is_private
+
+
+def classify_with_shared_context(update: Update) -> None:
+    """Повторное обращение к уже созданному контексту: обработчик после процессора апдейтов."""
+    update_context = get_update_context(update, BOT_USERNAME, BOT_ID)
+    if not update_context.should_process:
+        return
+    update_context.chat_identifier
+    update_context.log_context
+    update_context.should_respond
+    update_context.is_private
+
+
+def measure(func, update: Update, iterations: int) -> float:
+    """Среднее время одного вызова, микросекунды."""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func(update)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Стоимость классификации апдейта")
+    parser.add_argument("--iterations", type=int, default=50000, help="вызовов на сценарий")
+    args = parser.parse_args()
+
+    print(f"{'сценарий':<16}{'функции, мкс':>15}{'контекст, мкс':>16}{'повторно, мкс':>16}{'ускорение':>12}")
+    for kind in ("private", "group_context", "group_mention", "topic_reply"):
+        update = build_update(kind)
+        functions_us = measure(classify_with_functions, update, args.iterations)
+        # Свежий контекст на каждый вызов - стоимость первой классификации апдейта
+        context_us = measure(classify_with_context, update, args.iterations)
+        shared_us = measure(classify_with_shared_context, update, args.iterations)
+        print(f"{kind:<16}{functions_us:>15.2f}{context_us:>16.2f}{shared_us:>16.2f}"
+              f"{functions_us / context_us:>11.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,24 @@ Chat Detection System for Dual-Mode Bot Operation
 
 This module provides functions to detect chat types and determine whether
 the bot should respond in group/channel contexts based on mentions and replies.
+
+UpdateContext answers all of these questions for one update, each at most once;
+handlers and the update processor share one instance per update through
+get_update_context(). The module-level functions remain for single checks.
 """
 
 import re
+from collections import OrderedDict
 from enum import Enum
+from functools import cached_property
 from typing import Optional
 from telegram import Update, Message
 from logger import logger
 
+# Number of recent updates whose contexts are kept for reuse; an update is
+# classified by the update processor and then by its handlers within moments
+UPDATE_CONTEXT_CACHE_SIZE = 1024
+
 
 class ChatType(Enum):
     """Enumeration of supported chat types"""
@@ -78,37 +88,7 @@ def is_bot_mentioned(update: Update, bot_username: str) -> bool:
     Returns:
         bool: True if bot is mentioned, False otherwise
     """
-    if not update.message:
-        return False
-    
-    # Check both text and caption (for photos/documents with captions)
-    text_to_check = update.message.text or update.message.caption
-    if not text_to_check:
-        return False
-    
-    message_text = text_to_check.lower()
-    bot_mention = f"@{bot_username.lower()}"
-    
-    # Check for @botusername mention
-    if bot_mention in message_text:
-        return True
-    
-    # Check for mentions in entities (more reliable)
-    # Check both text entities and caption entities
-    entities_to_check = []
-    if update.message.entities:
-        entities_to_check.extend(update.message.entities)
-    if update.message.caption_entities:
-        entities_to_check.extend(update.message.caption_entities)
-    
-    for entity in entities_to_check:
-        if entity.type == "mention":
-            # Extract the mention from the message text
-            mention_text = message_text[entity.offset:entity.offset + entity.length]
-            if mention_text == bot_mention:
-                return True
-    
-    return False
+    return UpdateContext(update, bot_username=bot_username).is_mentioned
 
 
 def is_reply_to_bot(update: Update, bot_id: int) -> bool:
@@ -122,14 +102,7 @@ def is_reply_to_bot(update: Update, bot_id: int) -> bool:
     Returns:
         bool: True if replying to bot, False otherwise
     """
-    if not update.message or not update.message.reply_to_message:
-        return False
-    
-    replied_message = update.message.reply_to_message
-    
-    # Check if the replied message is from the bot
-    return (replied_message.from_user and 
-            replied_message.from_user.id == bot_id)
+    return UpdateContext(update, bot_id=bot_id).is_reply_to_bot
 
 
 def is_bot_command(update: Update) -> bool:
@@ -142,30 +115,7 @@ def is_bot_command(update: Update) -> bool:
     Returns:
         bool: True if message is a command, False otherwise
     """
-    if not update.message:
-        return False
-    
-    # Check both text and caption for commands
-    text_to_check = update.message.text or update.message.caption
-    if not text_to_check:
-        return False
-    
-    # Check if message starts with /
-    if text_to_check.startswith('/'):
-        return True
-    
-    # Check for command entities in both text and caption
-    entities_to_check = []
-    if update.message.entities:
-        entities_to_check.extend(update.message.entities)
-    if update.message.caption_entities:
-        entities_to_check.extend(update.message.caption_entities)
-    
-    for entity in entities_to_check:
-        if entity.type == "bot_command":
-            return True
-    
-    return False
+    return UpdateContext(update).is_command
 
 
 def should_process_message(update: Update) -> bool:
@@ -180,32 +130,7 @@ def should_process_message(update: Update) -> bool:
     Returns:
         bool: True if bot should process the message for context
     """
-    chat_type = get_chat_type(update)
-    
-    # Always process messages in private chats
-    if chat_type == ChatType.PRIVATE:
-        return True
-    
-    # In groups, process all user messages (text, photos, documents, etc.)
-    if chat_type in [ChatType.GROUP, ChatType.SUPERGROUP]:
-        # Skip if no message at all
-        if not update.message:
-            return False
-        
-        # Skip messages from other bots (unless it's a command to our bot)
-        if update.message.from_user and update.message.from_user.is_bot:
-            return is_bot_command(update)
-        
-        # Process text messages, photos, documents, etc.
-        # Skip system messages (service messages have no from_user)
-        return update.message.from_user is not None
-    
-    # For channels, only process commands
-    if chat_type == ChatType.CHANNEL:
-        return is_bot_command(update)
-    
-    # Default: don't process
-    return False
+    return UpdateContext(update).should_process
 
 
 def should_respond_in_chat(update: Update, bot_username: str, bot_id: int) -> bool:
@@ -222,27 +147,7 @@ def should_respond_in_chat(update: Update, bot_username: str, bot_id: int) -> bo
     Returns:
         bool: True if bot should respond, False otherwise
     """
-    chat_type = get_chat_type(update)
-    
-    # Always respond in private chats
-    if chat_type == ChatType.PRIVATE:
-        return True
-    
-    # In group chats, respond only to:
-    # 1. Messages that mention the bot
-    # 2. Replies to bot messages
-    # 3. Bot commands
-    if chat_type in [ChatType.GROUP, ChatType.SUPERGROUP]:
-        return (is_bot_mentioned(update, bot_username) or 
-                is_reply_to_bot(update, bot_id) or 
-                is_bot_command(update))
-    
-    # For channels, only respond to commands for now
-    if chat_type == ChatType.CHANNEL:
-        return is_bot_command(update)
-    
-    # Default: don't respond
-    return False
+    return UpdateContext(update, bot_username, bot_id).should_respond
 
 
 def has_topic_thread(update: Update) -> bool:
@@ -296,21 +201,7 @@ def get_chat_identifier(update: Update) -> str:
         - Supergroup without topics: "chat:-123456789"
         - Supergroup with topics: "chat:-123456789:topic:5"
     """
-    chat_type = get_chat_type(update)
-    
-    if chat_type == ChatType.PRIVATE:
-        # For private chats, use user_id for backward compatibility
-        return f"user:{update.effective_user.id}"
-    else:
-        # For group chats, use chat_id
-        base_identifier = f"chat:{update.effective_chat.id}"
-        
-        # Check if this is a supergroup with topics
-        if chat_type == ChatType.SUPERGROUP and has_topic_thread(update):
-            topic_id = get_topic_thread_id(update)
-            return f"{base_identifier}:topic:{topic_id}"
-        
-        return base_identifier
+    return UpdateContext(update).chat_identifier
 
 
 def get_log_context(update: Update) -> str:
@@ -330,26 +221,211 @@ def get_log_context(update: Update) -> str:
         - Supergroup: "[Supergroup] user_123(@john) in chat_-456(My Supergroup)"
         - Supergroup with topic: "[Supergroup] user_123(@john) in chat_-456(My Supergroup) | Topic: 5"
     """
-    chat_type = get_chat_type(update)
-    user = update.effective_user
-    chat = update.effective_chat
-    
-    user_info = f"user_{user.id}"
-    if user.username:
-        user_info += f"(@{user.username})"
-    
-    if chat_type == ChatType.PRIVATE:
-        return f"[Private] {user_info}"
-    else:
+    return UpdateContext(update).log_context
+
+
+class UpdateContext:
+    """
+    Classification of one update, computed lazily and at most once per property.
+
+    Usage:
+        update_context = get_update_context(update, bot_username, bot_id)
+        if update_context.should_respond:
+            logger.info(f"{update_context.log_context} - ...")
+    """
+
+    def __init__(self, update: Update, bot_username: Optional[str] = None, bot_id: Optional[int] = None):
+        """
+        Args:
+            update: Telegram Update object
+            bot_username: Bot username (without @); taken from the update's bot if omitted
+            bot_id: Bot's Telegram ID; taken from the update's bot if omitted
+        """
+        self.update = update
+        self._bot_username = bot_username
+        self._bot_id = bot_id
+
+    def _resolve_bot(self) -> None:
+        if self._bot_username is not None and self._bot_id is not None:
+            return
+        try:
+            bot = self.update.get_bot()
+            self._bot_username = self._bot_username if self._bot_username is not None else bot.username
+            self._bot_id = self._bot_id if self._bot_id is not None else bot.id
+        except RuntimeError:
+            # Update is not bound to a bot - mentions and replies cannot be recognized
+            pass
+
+    def supply_bot(self, bot_username: Optional[str], bot_id: Optional[int]) -> None:
+        """Fills in a bot identity that was unknown, recomputing what depended on it"""
+        changed = False
+        if bot_username is not None and self._bot_username is None:
+            self._bot_username = bot_username
+            changed = True
+        if bot_id is not None and self._bot_id is None:
+            self._bot_id = bot_id
+            changed = True
+        if changed:
+            for name in ("is_mentioned", "is_reply_to_bot", "should_respond"):
+                self.__dict__.pop(name, None)
+
+    @cached_property
+    def chat_type(self) -> ChatType:
+        """Chat type"""
+        return get_chat_type(self.update)
+
+    @cached_property
+    def is_private(self) -> bool:
+        return self.chat_type == ChatType.PRIVATE
+
+    @cached_property
+    def is_group(self) -> bool:
+        return self.chat_type in (ChatType.GROUP, ChatType.SUPERGROUP)
+
+    @cached_property
+    def text(self) -> Optional[str]:
+        """Message text or caption"""
+        message = self.update.message
+        if not message:
+            return None
+        return message.text or message.caption
+
+    @cached_property
+    def is_command(self) -> bool:
+        """Whether the message is a bot command (in text or caption)"""
+        message = self.update.message
+        if not self.text:
+            return False
+        if self.text.startswith('/'):
+            return True
+        return any(
+            entity.type == "bot_command"
+            for entities in (message.entities, message.caption_entities) if entities
+            for entity in entities
+        )
+
+    @cached_property
+    def is_mentioned(self) -> bool:
+        """Whether the bot is mentioned in the message text or caption"""
+        if not self.text:
+            return False
+        self._resolve_bot()
+        if not self._bot_username:
+            return False
+        # A "mention" entity is a substring of the text, so the substring check covers it
+        return f"@{self._bot_username.lower()}" in self.text.lower()
+
+    @cached_property
+    def is_reply_to_bot(self) -> bool:
+        """Whether the message is a reply to a bot message"""
+        message = self.update.message
+        if not message or not message.reply_to_message:
+            return False
+        self._resolve_bot()
+        replied_user = message.reply_to_message.from_user
+        return bool(replied_user and self._bot_id is not None and replied_user.id == self._bot_id)
+
+    @cached_property
+    def should_process(self) -> bool:
+        """
+        Whether the message is processed for context: everything in private chats,
+        user messages in groups, commands only from other bots and in channels.
+        """
+        if self.is_private:
+            return True
+        message = self.update.message
+        if self.is_group:
+            if not message:
+                return False
+            if message.from_user and message.from_user.is_bot:
+                return self.is_command
+            return message.from_user is not None
+        if self.chat_type == ChatType.CHANNEL:
+            return self.is_command
+        return False
+
+    @cached_property
+    def should_respond(self) -> bool:
+        """
+        Whether the bot responds: always in private chats, in groups only to
+        mentions, replies to its messages and commands.
+        """
+        if self.is_private:
+            return True
+        if self.is_group:
+            return self.is_mentioned or self.is_reply_to_bot or self.is_command
+        if self.chat_type == ChatType.CHANNEL:
+            return self.is_command
+        return False
+
+    @cached_property
+    def topic_thread_id(self) -> Optional[int]:
+        """Topic thread ID of a supergroup message, if any"""
+        if not self.update.message:
+            return None
+        return getattr(self.update.message, 'message_thread_id', None)
+
+    @cached_property
+    def chat_identifier(self) -> str:
+        """Session identifier ("user:ID", "chat:ID" or "chat:ID:topic:N")"""
+        if self.is_private:
+            return f"user:{self.update.effective_user.id}"
+        base_identifier = f"chat:{self.update.effective_chat.id}"
+        if self.chat_type == ChatType.SUPERGROUP and self.topic_thread_id is not None:
+            return f"{base_identifier}:topic:{self.topic_thread_id}"
+        return base_identifier
+
+    @cached_property
+    def log_context(self) -> str:
+        """Contextual string for logs ("[Supergroup] user_1(@john) in chat_-2(Title) | Topic: 5")"""
+        user = self.update.effective_user
+        chat = self.update.effective_chat
+
+        user_info = f"user_{user.id}"
+        if user.username:
+            user_info += f"(@{user.username})"
+
+        if self.is_private:
+            return f"[Private] {user_info}"
+
         chat_info = f"chat_{chat.id}"
         if chat.title:
             chat_info += f"({chat.title})"
-        
-        base_context = f"[{chat_type.value.title()}] {user_info} in {chat_info}"
-        
-        # Add topic information for supergroups with topics
-        if chat_type == ChatType.SUPERGROUP and has_topic_thread(update):
-            topic_id = get_topic_thread_id(update)
-            base_context += f" | Topic: {topic_id}"
-        
-        return base_context 
\ No newline at end of file
+        base_context = f"[{self.chat_type.value.title()}] {user_info} in {chat_info}"
+        if self.chat_type == ChatType.SUPERGROUP and self.topic_thread_id is not None:
+            base_context += f" | Topic: {self.topic_thread_id}"
+        return base_context
+
+
+_update_contexts: "OrderedDict[int, UpdateContext]" = OrderedDict()
+
+
+def get_update_context(update: Update, bot_username: Optional[str] = None,
+                       bot_id: Optional[int] = None) -> UpdateContext:
+    """
+    Returns the shared context of an update, creating it on first use.
+
+    Args:
+        update: Telegram Update object
+        bot_username: Bot username (without @); taken from the update's bot if omitted
+        bot_id: Bot's Telegram ID; taken from the update's bot if omitted
+
+    A bot identity passed here fills in one the cached context could not resolve.
+
+    Returns:
+        UpdateContext: The same instance for every call with this update object
+    """
+    key = id(update)
+    update_context = _update_contexts.get(key)
+    # id() of a collected update may be reused, so the cached entry must hold this very object
+    if update_context is not None and update_context.update is update:
+        _update_contexts.move_to_end(key)
+        update_context.supply_bot(bot_username, bot_id)
+        return update_context
+
+    update_context = UpdateContext(update, bot_username, bot_id)
+    _update_contexts[key] = update_context
+    _update_contexts.move_to_end(key)
+    if len(_update_contexts) > UPDATE_CONTEXT_CACHE_SIZE:
+        _update_contexts.popitem(last=False)
+    return update_context
@@ -10,6 +10,80 @@ ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID")  # заранее созданн
 # Канал для проверки подписки
 CHANNEL_ID = os.getenv("CHANNEL_ID", "@logloss_notes")  # ID канала по умолчанию
 
+# Несколько каналов через запятую (например, "@channel_a,@channel_b"); по умолчанию - CHANNEL_ID
+CHANNEL_IDS = [channel.strip() for channel in os.getenv("CHANNEL_IDS", CHANNEL_ID).split(",") if channel.strip()]
+# Режим проверки: "any" - подписка хотя бы на один канал, "all" - на все каналы
+CHANNEL_MATCH_MODE = os.getenv("CHANNEL_MATCH_MODE", "any").lower()
+
+# Способ получения апдейтов: "polling" (getUpdates) или "webhook" (встроенный HTTP-сервер)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")  # Путь обработчика на сервере
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")  # Адрес, на котором слушает сервер (за reverse proxy)
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Параллельных соединений от Telegram
+WEBHOOK_CERT_PATH = os.getenv("WEBHOOK_CERT_PATH")  # TLS без reverse proxy (опционально)
+WEBHOOK_KEY_PATH = os.getenv("WEBHOOK_KEY_PATH")
+
+# Параллельная обработка апдейтов: разные чаты - параллельно, внутри чата/топика - строго по порядку
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))  # Одновременно выполняемых апдейтов (1 - последовательно)
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "256"))  # Апдейтов в обработке и ожидании
+# Доля слотов для фоновой работы (сообщения групп только для контекста, служебные апдейты);
+# команды и обращения к боту получают свободные слоты первыми
+BACKGROUND_CONCURRENCY_SHARE = float(os.getenv("BACKGROUND_CONCURRENCY_SHARE", "0.25"))
+
+# Справедливые очереди вызовов OpenAI: слоты делятся между тенантами (user:ID / chat:ID,
+# все топики группы - один тенант) пропорционально весам, чтобы одна активная группа не занимала все
+OPENAI_RUN_CONCURRENCY = int(os.getenv("OPENAI_RUN_CONCURRENCY", "8"))  # Одновременных запусков ассистента
+OPENAI_UPLOAD_CONCURRENCY = int(os.getenv("OPENAI_UPLOAD_CONCURRENCY", "4"))  # Одновременных загрузок файлов
+OPENAI_IMAGE_CONCURRENCY = int(os.getenv("OPENAI_IMAGE_CONCURRENCY", "2"))  # Одновременных генераций DALL-E
+# Контроль допуска: при переполнении очереди или долгом ожидании запрос сразу получает ответ "занято"
+OPENAI_MAX_QUEUED = int(os.getenv("OPENAI_MAX_QUEUED", "64"))  # Ожидающих запросов на каждый тип вызова (0 - без лимита)
+OPENAI_ADMISSION_TIMEOUT = float(os.getenv("OPENAI_ADMISSION_TIMEOUT", "20"))  # Макс. ожидание слота, с (0 - без лимита)
+# Адаптивные лимиты по заголовкам x-ratelimit-*: при остатке квоты ниже запаса или 429 лимит
+# одновременных вызовов уменьшается вдвое, затем плавно растет обратно до значений выше
+OPENAI_ADAPTIVE_CONCURRENCY = os.getenv("OPENAI_ADAPTIVE_CONCURRENCY", "true").lower() == "true"
+OPENAI_MIN_CONCURRENCY = int(os.getenv("OPENAI_MIN_CONCURRENCY", "1"))  # Нижняя граница лимита
+OPENAI_RATELIMIT_HEADROOM = float(os.getenv("OPENAI_RATELIMIT_HEADROOM", "0.1"))  # Доля остатка квоты для снижения
+# Повторы при временных сбоях OpenAI (соединение, 408/409/429, 5xx): экспоненциальная пауза со случайным
+# разбросом; неидемпотентные операции повторяются только если сбойная попытка точно не выполнилась
+OPENAI_RETRY_ATTEMPTS = int(os.getenv("OPENAI_RETRY_ATTEMPTS", "4"))  # Всего попыток на операцию
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "0.5"))  # Базовая пауза, с
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "8"))  # Максимальная пауза, с
+OPENAI_REQUEST_BUDGET = float(os.getenv("OPENAI_REQUEST_BUDGET", "120"))  # Бюджет времени на запрос пользователя, с (0 - без лимита)
+# Запуски ассистента дольше лимита отменяются в OpenAI (runs.cancel), пользователь получает ответ об этом
+OPENAI_RUN_TIMEOUT = float(os.getenv("OPENAI_RUN_TIMEOUT", "90"))  # Макс. длительность запуска, с
+OPENAI_SHUTDOWN_GRACE = float(os.getenv("OPENAI_SHUTDOWN_GRACE", "15"))  # Ожидание запусков при остановке, затем отмена, с
+FAIR_QUEUE_WEIGHTS = os.getenv("FAIR_QUEUE_WEIGHTS", "")  # Веса тенантов, например "chat:-100123=4,user:42=2"
+FAIR_QUEUE_DEFAULT_WEIGHT = float(os.getenv("FAIR_QUEUE_DEFAULT_WEIGHT", "1"))  # Вес остальных тенантов
+
+# Многопроцессный режим: фронт-процесс принимает апдейты и раздает их воркерам по хешу чата
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))  # Число процессов-воркеров (1 - один процесс без фронта)
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))  # Очередь апдейтов на воркер
+
+# Очередь апдейтов в Redis Streams: main.py только принимает апдейты, обработчики работают
+# в воркерах "python stream_queue.py worker --partition N"
+UPDATE_QUEUE = os.getenv("UPDATE_QUEUE", "local").lower()  # local - обработка в этом же процессе, stream - через Redis Streams
+UPDATE_STREAM_KEY = os.getenv("UPDATE_STREAM_KEY", "updates")  # Префикс ключей стримов (updates:0, updates:1, ...)
+UPDATE_STREAM_GROUP = os.getenv("UPDATE_STREAM_GROUP", "bot-workers")  # Группа потребителей
+UPDATE_STREAM_PARTITIONS = int(os.getenv("UPDATE_STREAM_PARTITIONS", "1"))  # Число стримов; чат всегда попадает в один
+UPDATE_STREAM_MAXLEN = int(os.getenv("UPDATE_STREAM_MAXLEN", "100000"))  # Хранимая история стрима для повторной обработки
+UPDATE_STREAM_IN_FLIGHT = int(os.getenv("UPDATE_STREAM_IN_FLIGHT", "64"))  # Апдейтов в обработке на воркер
+UPDATE_STREAM_CLAIM_IDLE_MS = int(os.getenv("UPDATE_STREAM_CLAIM_IDLE_MS", "60000"))  # Простой, после которого запись забирает другой воркер, мс
+UPDATE_STREAM_MAX_DELIVERIES = int(os.getenv("UPDATE_STREAM_MAX_DELIVERIES", "5"))  # Попыток до переноса в dead-letter стрим
+
+# Процессов, выполняющих обработчики (воркеры шардов или партиций стримов): лимиты
+# OPENAI_*_CONCURRENCY общие на весь бот и делятся между ними
+HANDLER_PROCESSES = max(1, UPDATE_STREAM_PARTITIONS if UPDATE_QUEUE == "stream" else BOT_WORKERS)
+
+# Окно де-дупликации апдейтов по update_id и (chat_id, message_id), с (0 - выключено);
+# Telegram хранит неполученные апдейты до суток
+UPDATE_DEDUP_TTL = int(os.getenv("UPDATE_DEDUP_TTL", "86400"))
+
+# Администраторы бота (через запятую): доступ к /stats
+ADMIN_USER_IDS = [int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()]
+
 # Список разрешённых Telegram ID (резервный механизм)
 # ALLOWED_USERS = [792501309, 916387745, 2120274462]  # Закомментировано - теперь используем проверку подписки
 
@@ -18,4 +92,35 @@ REDIS_PORT = int(os.getenv("REDIS_PORT"))
 REDIS_DB = int(os.getenv("REDIS_DB"))
 
 # Настройки для аналитики пользователей
-ANALYTICS_DB_PATH = os.getenv("ANALYTICS_DB_PATH", "./data/user_analytics.db")
\ No newline at end of file
+ANALYTICS_DB_PATH = os.getenv("ANALYTICS_DB_PATH", "./data/user_analytics.db")
+ANALYTICS_BUSY_TIMEOUT_MS = int(os.getenv("ANALYTICS_BUSY_TIMEOUT_MS", "5000"))  # Ожидание блокировки SQLite
+ANALYTICS_CACHED_STATEMENTS = int(os.getenv("ANALYTICS_CACHED_STATEMENTS", "128"))  # Кеш подготовленных выражений
+# Отложенная запись аналитики: события копятся в памяти и пишутся пачкой
+ANALYTICS_WRITE_BEHIND = os.getenv("ANALYTICS_WRITE_BEHIND", "true").lower() == "true"
+ANALYTICS_FLUSH_INTERVAL_MS = int(os.getenv("ANALYTICS_FLUSH_INTERVAL_MS", "500"))  # Период сброса буфера
+ANALYTICS_FLUSH_MAX_ROWS = int(os.getenv("ANALYTICS_FLUSH_MAX_ROWS", "500"))  # Досрочный сброс при накоплении строк
+ANALYTICS_MAX_BUFFERED_ROWS = int(os.getenv("ANALYTICS_MAX_BUFFERED_ROWS", "100000"))  # Предел буфера при ошибках записи
+# Хранение сырых событий: старше N дней переносятся в сжатые помесячные архивы (0 - хранить все)
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "90"))
+ANALYTICS_ARCHIVE_DIR = os.getenv("ANALYTICS_ARCHIVE_DIR", "./data/archive")
+ANALYTICS_ARCHIVE_BATCH_SIZE = int(os.getenv("ANALYTICS_ARCHIVE_BATCH_SIZE", "5000"))  # Строк за одну транзакцию удаления
+ANALYTICS_VACUUM_PAGES = int(os.getenv("ANALYTICS_VACUUM_PAGES", "1000"))  # Страниц за один шаг incremental_vacuum
+ANALYTICS_RETENTION_HOUR = int(os.getenv("ANALYTICS_RETENTION_HOUR", "4"))  # Час запуска ежедневной очистки (UTC)
+
+# Дневные лимиты токенов (0 - без ограничений); расход считается в Redis
+DAILY_TOKEN_LIMIT_USER = int(os.getenv("DAILY_TOKEN_LIMIT_USER", "0"))  # На пользователя
+DAILY_TOKEN_LIMIT_CHAT = int(os.getenv("DAILY_TOKEN_LIMIT_CHAT", "0"))  # На групповой чат (все топики вместе)
+QUOTA_CACHE_TTL_MS = int(os.getenv("QUOTA_CACHE_TTL_MS", "1000"))  # Как долго доверять локальной копии счетчика
+
+# Конвейер обработчиков сообщений: порядок проверок (дешевые отказы - первыми)
+HANDLER_PIPELINE_ORDER = os.getenv("HANDLER_PIPELINE_ORDER", "filter,classify,rate_limit,authorize")
+# Авторизация сообщений группы, которые только добавляются в контекст:
+# strict - проверка подписки на каждое, lazy - только по кешу подписок, per_chat - раз в AUTH_CHAT_TTL на чат
+AUTH_CONTEXT_POLICY = os.getenv("AUTH_CONTEXT_POLICY", "strict").lower()
+AUTH_CHAT_TTL = int(os.getenv("AUTH_CHAT_TTL", "3600"))  # Сколько чат считается авторизованным, с
+
+# Прогрев кеша подписок при старте (по недавно активным пользователям из аналитики)
+SUBSCRIPTION_WARMUP_ENABLED = os.getenv("SUBSCRIPTION_WARMUP_ENABLED", "true").lower() == "true"
+SUBSCRIPTION_WARMUP_DAYS = int(os.getenv("SUBSCRIPTION_WARMUP_DAYS", "3"))  # За сколько дней брать активных пользователей
+SUBSCRIPTION_WARMUP_BATCH_SIZE = int(os.getenv("SUBSCRIPTION_WARMUP_BATCH_SIZE", "20"))  # Запросов getChatMember в одной пачке
+SUBSCRIPTION_WARMUP_BATCH_DELAY = float(os.getenv("SUBSCRIPTION_WARMUP_BATCH_DELAY", "1.0"))  # Пауза между пачками, сек
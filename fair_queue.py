@@ -0,0 +1,291 @@
+"""
+Weighted Fair Queuing of OpenAI Work Across Tenants
+
+A tenant is a user ("user:<id>") or a group chat ("chat:<id>"); all topics of
+a supergroup belong to the chat's tenant. Concurrent slots are handed out by
+start-time fair queuing: each request gets a virtual finish tag based on its
+tenant's weight, and the request with the smallest tag runs next. A burst from
+one busy chat therefore queues behind itself instead of in front of everyone.
+
+Admission is bounded: when the wait queue is full, or a request cannot start
+within the admission timeout, AdmissionRejected is raised so the caller can
+answer "busy" right away instead of piling up behind a spike.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+from logger import logger
+
+# Tenants without queued or running work are forgotten after this many seconds
+TENANT_IDLE_TTL = 3600
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted to a fair queue"""
+
+    def __init__(self, queue_name: str, tenant: str, reason: str):
+        """
+        Args:
+            queue_name: Name of the queue that rejected the request
+            tenant: Tenant of the request
+            reason: "queue_full" or "timeout"
+        """
+        super().__init__(f"{queue_name} queue rejected {tenant}: {reason}")
+        self.queue_name = queue_name
+        self.tenant = tenant
+        self.reason = reason
+
+
+def tenant_for(chat_identifier: Optional[str], user_id: Optional[int] = None) -> str:
+    """
+    Maps a chat identifier to its tenant.
+
+    Args:
+        chat_identifier: "user:ID", "chat:ID" or "chat:ID:topic:N"
+        user_id: Fallback when no chat identifier is known
+
+    Returns:
+        str: Tenant key ("user:ID" or "chat:ID")
+    """
+    if chat_identifier:
+        parts = chat_identifier.split(":")
+        if len(parts) >= 2 and parts[0] in ("user", "chat"):
+            return f"{parts[0]}:{parts[1]}"
+    return f"user:{user_id}" if user_id is not None else "unknown"
+
+
+def parse_weights(spec: Optional[str]) -> dict:
+    """
+    Parses tenant weights from "chat:-100123=4,user:42=0.5".
+
+    Returns:
+        dict: Tenant key -> weight
+    """
+    weights = {}
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        try:
+            tenant, weight = item.rsplit("=", 1)
+            weights[tenant.strip()] = float(weight)
+        except ValueError:
+            logger.warning(f"[FairQueue] Invalid tenant weight entry: {item!r}")
+    return {tenant: weight for tenant, weight in weights.items() if weight > 0}
+
+
+class _TenantState:
+    """Virtual time and metrics of one tenant"""
+
+    __slots__ = ("last_finish", "queued", "running", "served", "rejected", "total_wait", "max_wait", "last_seen")
+
+    def __init__(self):
+        self.last_finish = 0.0
+        self.queued = 0
+        self.running = 0
+        self.served = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_seen = time.monotonic()
+
+
+class FairQueue:
+    """
+    Concurrency limiter with weighted fair queuing across tenants.
+
+    Usage:
+        async with queue.slot(tenant):
+            ...  # OpenAI call
+    """
+
+    def __init__(self, name: str, concurrency: int, weights: Optional[dict] = None, default_weight: float = 1.0,
+                 max_queued: int = 0, wait_timeout: Optional[float] = None):
+        """
+        Args:
+            name: Queue name for logs and metrics
+            concurrency: Maximum number of concurrent slots
+            weights: Tenant key -> weight (share of slots relative to other busy tenants)
+            default_weight: Weight of tenants not listed in weights
+            max_queued: Maximum number of waiting requests (0 - unbounded)
+            wait_timeout: Maximum wait for a slot in seconds (None - wait indefinitely)
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be a positive integer")
+        self.name = name
+        self.concurrency = concurrency
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.max_queued = max_queued
+        self.wait_timeout = wait_timeout
+        self.running = 0
+        self.rejected = 0
+        self._waiting = 0
+        self._virtual_time = 0.0
+        self._heap: list = []
+        self._sequence = itertools.count()
+        self._tenants: dict[str, _TenantState] = {}
+
+    def weight_of(self, tenant: str) -> float:
+        """Weight of a tenant"""
+        return self.weights.get(tenant, self.default_weight)
+
+    @property
+    def queued(self) -> int:
+        """Number of requests waiting for a slot"""
+        return self._waiting
+
+    def set_concurrency(self, concurrency: int) -> None:
+        """
+        Changes the number of concurrent slots. Running requests keep their slots;
+        a lower limit takes effect as they finish.
+        """
+        self.concurrency = max(1, concurrency)
+        self._dispatch()
+
+    @property
+    def oldest_wait(self) -> float:
+        """How long the longest-waiting request has been queued, seconds"""
+        oldest = min((entry[4] for entry in self._heap if not entry[5].done()), default=None)
+        return time.monotonic() - oldest if oldest is not None else 0.0
+
+    def _tenant_state(self, tenant: str) -> _TenantState:
+        state = self._tenants.get(tenant)
+        if state is None:
+            state = self._tenants[tenant] = _TenantState()
+            if len(self._tenants) % 256 == 0:
+                self._prune()
+        state.last_seen = time.monotonic()
+        return state
+
+    def _prune(self) -> None:
+        """Drops idle tenants so metrics do not grow without bound"""
+        now = time.monotonic()
+        for tenant, state in list(self._tenants.items()):
+            if not state.queued and not state.running and now - state.last_seen > TENANT_IDLE_TTL:
+                del self._tenants[tenant]
+
+    def _start(self, tenant: str, state: _TenantState, enqueued_at: float) -> None:
+        wait = time.monotonic() - enqueued_at
+        self.running += 1
+        state.running += 1
+        state.served += 1
+        state.total_wait += wait
+        state.max_wait = max(state.max_wait, wait)
+
+    def _reject(self, tenant: str, state: _TenantState, reason: str) -> AdmissionRejected:
+        self.rejected += 1
+        state.rejected += 1
+        logger.warning(f"[FairQueue] {self.name}: rejected {tenant} ({reason}), "
+                       f"running {self.running}/{self.concurrency}, queued {self.queued}")
+        return AdmissionRejected(self.name, tenant, reason)
+
+    def _dispatch(self) -> None:
+        """Starts waiting requests in order of their virtual finish tags"""
+        while self._heap and self.running < self.concurrency:
+            _, _, start_tag, tenant, enqueued_at, waiter = heapq.heappop(self._heap)
+            if waiter.done():
+                # Cancelled or timed out while waiting, already uncounted
+                continue
+            state = self._tenants[tenant]
+            state.queued -= 1
+            self._waiting -= 1
+            self._virtual_time = max(self._virtual_time, start_tag)
+            self._start(tenant, state, enqueued_at)
+            waiter.set_result(None)
+
+    async def acquire(self, tenant: str) -> None:
+        """
+        Waits for a slot on behalf of a tenant.
+
+        Raises:
+            AdmissionRejected: The wait queue is full or the wait timed out
+        """
+        state = self._tenant_state(tenant)
+        if self.max_queued and self.queued >= self.max_queued and self.running >= self.concurrency:
+            raise self._reject(tenant, state, "queue_full")
+        start_tag = max(self._virtual_time, state.last_finish)
+        state.last_finish = start_tag + 1.0 / self.weight_of(tenant)
+        enqueued_at = time.monotonic()
+
+        if self.running < self.concurrency and not self._waiting:
+            self._virtual_time = max(self._virtual_time, start_tag)
+            self._start(tenant, state, enqueued_at)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        state.queued += 1
+        self._waiting += 1
+        heapq.heappush(self._heap, (state.last_finish, next(self._sequence), start_tag, tenant, enqueued_at, waiter))
+        try:
+            async with asyncio.timeout(self.wait_timeout):
+                await waiter
+        except (asyncio.CancelledError, TimeoutError) as wait_error:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted right before cancellation - give it back
+                self.release(tenant)
+            else:
+                # Entry stays in the heap and is skipped by _dispatch
+                waiter.cancel()
+                state.queued -= 1
+                self._waiting -= 1
+            if isinstance(wait_error, TimeoutError):
+                raise self._reject(tenant, state, "timeout") from None
+            raise
+
+    def release(self, tenant: str) -> None:
+        """Returns a slot"""
+        self.running -= 1
+        state = self._tenants.get(tenant)
+        if state is not None:
+            state.running -= 1
+            state.last_seen = time.monotonic()
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, tenant: str):
+        """Context manager holding a slot on behalf of a tenant"""
+        await self.acquire(tenant)
+        try:
+            yield
+        finally:
+            self.release(tenant)
+
+    def get_stats(self, top: int = 10) -> dict:
+        """
+        Queue depth and wait-time metrics.
+
+        Args:
+            top: Number of tenants to include, busiest first
+
+        Returns:
+            dict: Queue totals and per-tenant metrics
+        """
+        tenants = sorted(
+            self._tenants.items(),
+            key=lambda item: (item[1].queued + item[1].running, item[1].served),
+            reverse=True
+        )[:top]
+        return {
+            "name": self.name,
+            "concurrency": self.concurrency,
+            "running": self.running,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "oldest_wait_ms": round(self.oldest_wait * 1000),
+            "tenants": {
+                tenant: {
+                    "weight": self.weight_of(tenant),
+                    "queued": state.queued,
+                    "running": state.running,
+                    "served": state.served,
+                    "rejected": state.rejected,
+                    "avg_wait_ms": round(state.total_wait / state.served * 1000) if state.served else 0,
+                    "max_wait_ms": round(state.max_wait * 1000),
+                }
+                for tenant, state in tenants
+            },
+        }
@@ -0,0 +1,217 @@
+"""
+Declarative Handler Pipeline for Messages
+
+Text and photo messages pass the same stages before any real work is done:
+
+- filter: drops updates the bot does not process at all (service messages,
+  other bots, empty text);
+- classify: decides whether the bot responds or only ingests the message as
+  group context;
+- rate_limit: replies and stops when the daily token quota is exhausted
+  (responses only - context ingestion runs no assistant);
+- authorize: checks the channel subscription.
+
+Every stage may stop the update. HANDLER_PIPELINE_ORDER sets the order, so
+the cheapest rejections run first; the action (reply or context ingestion)
+always runs last. Classification is lazy (see UpdateContext), so stages that
+need it work in any order.
+
+AUTH_CONTEXT_POLICY decides how overheard group messages are authorized:
+
+- strict: like requests - a subscription check per message;
+- lazy: only a cached subscription status is consulted; messages of users
+  without one are ingested and their status is checked in the background,
+  so the next messages are decided from the cache;
+- per_chat: a chat where an authorized member was seen in the last
+  AUTH_CHAT_TTL seconds ingests context without per-user checks.
+
+Responses are always authorized per user.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Optional
+from telegram import Update
+from telegram.ext import ContextTypes
+from chat_detector import UpdateContext, get_update_context
+from logger import logger
+
+STAGE_FILTER = "filter"
+STAGE_CLASSIFY = "classify"
+STAGE_RATE_LIMIT = "rate_limit"
+STAGE_AUTHORIZE = "authorize"
+
+DEFAULT_ORDER = (STAGE_FILTER, STAGE_CLASSIFY, STAGE_RATE_LIMIT, STAGE_AUTHORIZE)
+
+AUTH_POLICY_STRICT = "strict"
+AUTH_POLICY_LAZY = "lazy"
+AUTH_POLICY_PER_CHAT = "per_chat"
+AUTH_POLICIES = (AUTH_POLICY_STRICT, AUTH_POLICY_LAZY, AUTH_POLICY_PER_CHAT)
+
+
+def parse_order(spec: Optional[str]) -> tuple:
+    """
+    Parses the stage order from "filter,classify,rate_limit,authorize".
+
+    Every stage must be listed exactly once; otherwise the default order is used.
+
+    Returns:
+        tuple: Stage names in execution order
+    """
+    order = tuple(stage.strip() for stage in (spec or "").split(",") if stage.strip())
+    if sorted(order) != sorted(DEFAULT_ORDER):
+        if order:
+            logger.warning(f"[HandlerPipeline] Invalid stage order {spec!r}, using {','.join(DEFAULT_ORDER)}")
+        return DEFAULT_ORDER
+    return order
+
+
+class MessageState:
+    """One message passing through a pipeline"""
+
+    __slots__ = ("update", "context", "update_context", "user_id", "text", "chat_identifier", "log_context")
+
+    def __init__(self, update: Update, context: ContextTypes.DEFAULT_TYPE, update_context: UpdateContext):
+        self.update = update
+        self.context = context
+        self.update_context = update_context
+        self.user_id = update.effective_user.id if update.effective_user else None
+        self.text: Optional[str] = None
+        self.chat_identifier: Optional[str] = None
+        self.log_context: Optional[str] = None
+
+    @property
+    def respond(self) -> bool:
+        """Whether the bot responds (otherwise the message is ingested as context)"""
+        return self.update_context.should_respond
+
+
+class AuthHooks:
+    """Authorization callbacks supplied by the bot"""
+
+    __slots__ = ("check", "cached", "deny", "chat_authorized", "mark_chat_authorized")
+
+    def __init__(self, check: Callable[[int], Awaitable[bool]], cached: Callable[[int], Optional[bool]],
+                 deny: Callable[[Update], Awaitable[None]], chat_authorized: Callable[[int], bool],
+                 mark_chat_authorized: Callable[[int], None]):
+        """
+        Args:
+            check: Full subscription check of a user (cache, then Telegram API)
+            cached: Cached subscription status of a user, None if unknown
+            deny: Sends the "access restricted" reply
+            chat_authorized: Whether an authorized member was recently seen in a chat
+            mark_chat_authorized: Records that an authorized member was seen in a chat
+        """
+        self.check = check
+        self.cached = cached
+        self.deny = deny
+        self.chat_authorized = chat_authorized
+        self.mark_chat_authorized = mark_chat_authorized
+
+
+class HandlerPipeline:
+    """
+    Runs the gate stages of a message handler, then its action.
+
+    Usage:
+        pipeline = HandlerPipeline("Message", respond=..., ingest=..., auth=..., over_quota=...)
+
+        async def handle_message(update, context):
+            await pipeline.run(update, context)
+    """
+
+    def __init__(self, label: str, respond: Callable[[MessageState], Awaitable[None]],
+                 ingest: Optional[Callable[[MessageState], Awaitable[None]]], auth: AuthHooks,
+                 over_quota: Callable[[Update, int, str], Awaitable[bool]],
+                 bot_identity: Callable[[], tuple], requires_text: bool = False,
+                 order: tuple = DEFAULT_ORDER, auth_policy: str = AUTH_POLICY_STRICT):
+        """
+        Args:
+            label: Message kind for logs ("Message", "Photo")
+            respond: Action for messages the bot responds to
+            ingest: Action for context-only messages (None - they are dropped)
+            auth: Authorization callbacks
+            over_quota: Replies and returns True when the quota is exhausted
+            bot_identity: Returns (bot username, bot id)
+            requires_text: Drop messages without text or caption
+            order: Stage order (see parse_order)
+            auth_policy: Authorization policy of context-only messages
+        """
+        if auth_policy not in AUTH_POLICIES:
+            logger.warning(f"[HandlerPipeline] Unknown auth policy {auth_policy!r}, using {AUTH_POLICY_STRICT}")
+            auth_policy = AUTH_POLICY_STRICT
+        self.label = label
+        self.respond = respond
+        self.ingest = ingest
+        self.auth = auth
+        self.over_quota = over_quota
+        self.bot_identity = bot_identity
+        self.requires_text = requires_text
+        self.auth_policy = auth_policy
+        stages = {
+            STAGE_FILTER: self._filter,
+            STAGE_CLASSIFY: self._classify,
+            STAGE_RATE_LIMIT: self._rate_limit,
+            STAGE_AUTHORIZE: self._authorize,
+        }
+        self.stages = [stages[name] for name in order]
+        self._background_checks: dict[int, asyncio.Task] = {}
+
+    async def run(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Runs the stages in order and the action if none of them stopped the message"""
+        bot_username, bot_id = self.bot_identity()
+        state = MessageState(update, context, get_update_context(update, bot_username, bot_id))
+        for stage in self.stages:
+            if not await stage(state):
+                return
+        state.chat_identifier = state.update_context.chat_identifier
+        state.log_context = state.update_context.log_context
+        logger.info(f"{state.log_context} - {self.label} received {'[RESPOND]' if state.respond else '[CONTEXT]'}")
+        await (self.respond if state.respond else self.ingest)(state)
+
+    async def _filter(self, state: MessageState) -> bool:
+        if not state.update_context.should_process or state.user_id is None:
+            return False
+        state.text = state.update_context.text
+        return bool(state.text) or not self.requires_text
+
+    async def _classify(self, state: MessageState) -> bool:
+        # Context-only messages are dropped by pipelines that cannot ingest them
+        return state.respond or self.ingest is not None
+
+    async def _rate_limit(self, state: MessageState) -> bool:
+        if not state.respond:
+            return True
+        return not await self.over_quota(state.update, state.user_id, state.update_context.chat_identifier)
+
+    async def _authorize(self, state: MessageState) -> bool:
+        if state.user_id is None:
+            return False
+        chat_id = state.update.effective_chat.id
+        if state.respond:
+            if await self.auth.check(state.user_id):
+                if self.auth_policy == AUTH_POLICY_PER_CHAT and state.update_context.is_group:
+                    self.auth.mark_chat_authorized(chat_id)
+                return True
+            await self.auth.deny(state.update)
+            return False
+
+        if self.auth_policy == AUTH_POLICY_PER_CHAT:
+            if self.auth.chat_authorized(chat_id):
+                return True
+            if await self.auth.check(state.user_id):
+                self.auth.mark_chat_authorized(chat_id)
+                return True
+            return False
+
+        if self.auth_policy == AUTH_POLICY_LAZY:
+            cached = self.auth.cached(state.user_id)
+            if cached is not None:
+                return cached
+            # Decide from the cache next time; this message is ingested without waiting
+            if state.user_id not in self._background_checks:
+                task = asyncio.create_task(self.auth.check(state.user_id))
+                self._background_checks[state.user_id] = task
+                task.add_done_callback(lambda _task, user_id=state.user_id: self._background_checks.pop(user_id, None))
+            return True
+
+        return await self.auth.check(state.user_id)
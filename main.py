@@ -2,28 +2,48 @@ import asyncio
 import os
 import logging
 import re
+import time
 import traceback
 import signal
+from datetime import date, datetime, time as dtime, timedelta, timezone
 
 from logger import logger
 import tempfile
 from pathlib import Path
+from typing import Optional
 import logging
 import re
 import traceback
 
 from telegram import Update, BotCommand
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-from config import TELEGRAM_BOT_TOKEN, CHANNEL_ID
-from openai_handler import send_message_and_get_response, send_message_and_get_response_for_chat, add_message_to_context, add_message_to_context_for_chat, get_message_history, export_message_history, send_image_and_get_response, send_image_and_get_response_for_chat, add_image_to_context, add_image_to_context_for_chat, detect_image_generation_request, generate_image_dalle, send_document_and_get_response
+from telegram.ext import Application, ApplicationBuilder, ApplicationHandlerStop, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+from config import (
+    TELEGRAM_BOT_TOKEN, CHANNEL_IDS, CHANNEL_MATCH_MODE, SUBSCRIPTION_WARMUP_ENABLED, SUBSCRIPTION_WARMUP_DAYS,
+    SUBSCRIPTION_WARMUP_BATCH_SIZE, SUBSCRIPTION_WARMUP_BATCH_DELAY,
+    ANALYTICS_RETENTION_DAYS, ANALYTICS_RETENTION_HOUR, ADMIN_USER_IDS,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS, WEBHOOK_CERT_PATH, WEBHOOK_KEY_PATH, UPDATE_CONCURRENCY, MAX_PENDING_UPDATES,
+    BACKGROUND_CONCURRENCY_SHARE, BOT_WORKERS, OPENAI_SHUTDOWN_GRACE, UPDATE_QUEUE,
+    HANDLER_PIPELINE_ORDER, AUTH_CONTEXT_POLICY
+)
+from openai_handler import send_message_and_get_response, send_message_and_get_response_for_chat, add_message_to_context, add_message_to_context_for_chat, get_message_history, export_message_history, send_image_and_get_response, send_image_and_get_response_for_chat, add_image_to_context, add_image_to_context_for_chat, detect_image_generation_request, generate_image_dalle, send_document_and_get_response, OPENAI_QUEUES, OPENAI_LIMITERS, interrupt_runs_for_chat, cancel_saved_runs_for_chat, shutdown_active_runs, resume_pending_run
 from session_manager import reset_thread, reset_chat_thread, get_thread_id_for_chat, set_thread_id_for_chat
 from telegram.constants import ChatAction
-from subscription_checker import check_channel_subscription
-from user_analytics import analytics
-from chat_detector import (
-    should_process_message, should_respond_in_chat, get_chat_identifier, get_log_context, 
-    is_private_chat, is_group_chat
+from subscription_checker import (
+    check_channels_subscription, warm_subscription_cache, get_cached_subscription, is_chat_authorized, mark_chat_authorized,
+    requires_all_channels
+)
+from usage_quota import check_quota, quotas_enabled, reconcile_counters
+from activity_counters import record_activity, get_activity_summary
+from update_processor import ChatOrderedUpdateProcessor
+from openai_retry import get_retry_stats
+from pending_runs import load_pending_runs, set_reply_placeholder
+from update_dedup import claim_update
+from user_analytics import (
+    analytics, RequestTrace, start_request_trace, REQUEST_KIND_TEXT, REQUEST_KIND_IMAGE, REQUEST_KIND_DOCUMENT, REQUEST_KIND_DALLE
 )
+from chat_detector import get_update_context
+from handler_pipeline import AuthHooks, HandlerPipeline, MessageState, parse_order
 from telegram.request import HTTPXRequest
 import telegram
 
@@ -33,6 +53,9 @@ LOG_FILE = os.path.join(os.path.dirname(__file__), "bot.log")
 # Bot information for dual-mode operation
 bot_info = {"username": None, "id": None}
 
+# Режим проверки подписки на CHANNEL_IDS (неверное значение логируется при старте)
+REQUIRE_ALL_CHANNELS = requires_all_channels(CHANNEL_MATCH_MODE)
+
 async def init_bot_info(bot):
     """Initialize bot information for dual-mode operation"""
     try:
@@ -67,19 +90,22 @@ async def is_authorized_async(user_id: int) -> bool:
         bool: True если пользователь авторизован (подписан на канал)
     """
     try:
-        return await check_channel_subscription(TELEGRAM_BOT_TOKEN, CHANNEL_ID, user_id)
+        return await check_channels_subscription(
+            TELEGRAM_BOT_TOKEN, CHANNEL_IDS, user_id, require_all=REQUIRE_ALL_CHANNELS
+        )
     except Exception as e:
         logger.error(f"[Authorization] Error checking subscription for user {user_id}: {e}")
         return False
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    update_context = get_update_context(update, bot_info["username"], bot_info["id"])
     # Check if bot should respond in this chat context
-    if not should_respond_in_chat(update, bot_info["username"], bot_info["id"]):
+    if not update_context.should_respond:
         return  # Ignore start command in group chats without mention/reply
     
     user_id = update.effective_user.id
     username = update.effective_user.username or "Unknown"
-    log_context = get_log_context(update)
+    log_context = update_context.log_context
     logger.info(f"[Start] {log_context}")
     
     if not await is_authorized_async(user_id):
@@ -107,7 +133,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Provide context-appropriate welcome message
-    if is_private_chat(update):
+    if update_context.is_private:
         await update.message.reply_text(
             "🤖 <b>Добро пожаловать в Telegram GPT Bot!</b>\n\n"
             "Я - ваш персональный AI-ассистент с уникальными возможностями:\n"
@@ -155,9 +181,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='HTML'
         )
 
+async def interrupt_on_reset(update: Update, chat_identifier: str):
+    """
+    Прерывает выполняющийся запрос чата при /reset, не дожидаясь очереди чата.
+    Сам сброс выполняет команда reset после того, как прерванный запрос завершится.
+    """
+    if update.effective_user is None or not await is_authorized_async(update.effective_user.id):
+        return
+    interrupt_runs_for_chat(chat_identifier, reason="reset")
+
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    update_context = get_update_context(update, bot_info["username"], bot_info["id"])
     # Check if bot should respond in this chat context
-    if not should_respond_in_chat(update, bot_info["username"], bot_info["id"]):
+    if not update_context.should_respond:
         return  # Ignore reset command in group chats without mention/reply
     
     user_id = update.effective_user.id
@@ -170,189 +206,216 @@ async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    chat_identifier = get_chat_identifier(update)
-    log_context = get_log_context(update)
+    chat_identifier = update_context.chat_identifier
+    log_context = update_context.log_context
+    
+    # Запрос, выполняющийся вне очереди чата (UPDATE_CONCURRENCY=1, возобновленный после
+    # перезапуска или в другом шарде), не должен дописать ответ из старого треда после сброса
+    interrupt_runs_for_chat(chat_identifier, reason="reset")
+    await cancel_saved_runs_for_chat(chat_identifier)
     
     # Use dual-mode reset
     await reset_chat_thread(chat_identifier)
     
     # Provide appropriate response based on chat type
-    if is_private_chat(update):
+    if update_context.is_private:
         await update.message.reply_text("🔄 История и файлы сброшены. Новая беседа начата!")
     else:
         await update.message.reply_text("🔄 История беседы в этом чате сброшена. Новая беседа начата!")
     
     logger.info(f"{log_context} - Reset completed")
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # First check if we should process this message at all
-    if not should_process_message(update):
-        return  # Ignore system messages, other bots, etc.
-    
-    user_id = update.effective_user.id
-    # Handle both text messages and captions (for context tracking)
-    user_message = update.message.text or update.message.caption
+async def reply_if_over_quota(update: Update, user_id: int, chat_identifier: str) -> bool:
+    """
+    Проверяет дневную квоту токенов перед запросом к OpenAI и сообщает о превышении.
     
-    # Skip if no text content to process
-    if not user_message:
-        return
+    Returns:
+        bool: True если квота исчерпана и запрос выполнять не нужно
+    """
+    exceeded = check_quota(user_id, chat_identifier)
+    if not exceeded:
+        return False
     
+    scope_text = "вашего аккаунта" if exceeded["scope"] == "user" else "этого чата"
+    await update.message.reply_text(
+        f"⏳ <b>Дневной лимит исчерпан</b>\n\n"
+        f"Лимит {scope_text}: <b>{exceeded['limit']}</b> токенов в сутки, "
+        f"использовано: <b>{exceeded['used']}</b>.\n"
+        f"Лимит обновится в полночь.",
+        parse_mode='HTML'
+    )
+    return True
+
+async def ingest_text_context(state: MessageState):
+    """Добавляет сообщение в контекст беседы без ответа"""
+    update = state.update
     username = get_username(update)
-    chat_identifier = get_chat_identifier(update)
-    log_context = get_log_context(update)
-    
-    # Check authorization - required for both processing and responding
-    if not await is_authorized_async(user_id):
-        # Only show authorization message if bot should respond
-        if should_respond_in_chat(update, bot_info["username"], bot_info["id"]):
-            await update.message.reply_text(
-                "🚫 Доступ к боту ограничен!\n\n"
-                "Для использования бота необходимо подписаться на канал:\n"
-                "👉 https://t.me/logloss_notes\n\n"
-                "После подписки попробуйте снова."
-            )
-        return
-    
-    # Check if we should respond to this message
-    should_respond = should_respond_in_chat(update, bot_info["username"], bot_info["id"])
-    
-    logger.info(f"{log_context} - Message received {'[RESPOND]' if should_respond else '[CONTEXT]'}")
-    
-    # If we shouldn't respond, just add to context and return
-    if not should_respond:
-        try:
-            if is_private_chat(update):
-                # This shouldn't happen in private chats, but handle it anyway
-                await add_message_to_context(user_id, user_message, username)
-            else:
-                # Add group message to context without responding
-                await add_message_to_context_for_chat(chat_identifier, user_message, username, user_id)
-        except Exception as context_error:
-            logger.error(f"Error adding message to context {log_context}: {context_error}")
-        return
-    
-    # From here on, we're responding to the message
-    await update.message.chat.send_action(action="typing")
+    try:
+        if state.update_context.is_private:
+            # This shouldn't happen in private chats, but handle it anyway
+            await add_message_to_context(state.user_id, state.text, username)
+        else:
+            # Add group message to context without responding
+            await add_message_to_context_for_chat(state.chat_identifier, state.text, username, state.user_id)
+    except Exception as context_error:
+        logger.error(f"Error adding message to context {state.log_context}: {context_error}")
+
+async def respond_to_text(state: MessageState):
+    """Отвечает на текстовое сообщение"""
+    username = get_username(state.update)
+    trace = start_request_trace(REQUEST_KIND_TEXT, state.user_id, username, state.chat_identifier)
+    try:
+        await process_text_reply(state.update, state.context, trace, state.text, username,
+                                 state.chat_identifier, state.log_context)
+    finally:
+        await trace.finish()
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Text messages and captions: filter, classify, quota and authorization, then reply or context"""
+    await text_pipeline.run(update, context)
+
+async def send_reply_placeholder(update: Update, trace: RequestTrace):
+    """Отправляет индикатор набора и сообщение-заглушку одновременно, возвращает заглушку"""
+    with trace.span("placeholder"):
+        typing_result, processing_message = await asyncio.gather(
+            update.message.chat.send_action(action="typing"),
+            update.message.reply_text(
+                "🤖 Ваш запрос передан в <b>ChatGPT</b> и обрабатывается...",
+                parse_mode='HTML'
+            ),
+            return_exceptions=True
+        )
+    if isinstance(typing_result, Exception):
+        logger.warning(f"Failed to send typing action: {typing_result}")
+    if isinstance(processing_message, Exception):
+        raise processing_message
+    return processing_message
+
+async def process_text_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, trace: RequestTrace,
+                             user_message: str, username: str, chat_identifier: str, log_context: str):
+    """Generates and delivers a reply to a text message the bot is responding to"""
+    user_id = update.effective_user.id
 
     # NEW: Image generation detection
     if await detect_image_generation_request(user_message):
+        await update.message.chat.send_action(action="typing")
         await handle_image_generation_request(update, context, user_message)
         return
 
-    # Отправляем сообщение о том, что запрос обрабатывается
-    processing_message = await update.message.reply_text(
-        "🤖 Ваш запрос передан в <b>ChatGPT</b> и обрабатывается...",
-        parse_mode='HTML'
-    )
+    # Заглушка отправляется в Telegram, пока в OpenAI ищется тред и добавляется сообщение;
+    # запуск ассистента ждет заглушку, чтобы ответ можно было доставить в нее после перезапуска
+    parallel_started_at = time.monotonic()
+    placeholder_task = asyncio.create_task(send_reply_placeholder(update, trace))
+
+    async def placeholder_ready():
+        processing_message = await placeholder_task
+        set_reply_placeholder(processing_message.chat_id, processing_message.message_id)
+        trace.log_overlap(("placeholder", "prepare"), parallel_started_at)
 
     try:
         # Use dual-mode session management
-        if is_private_chat(update):
+        if get_update_context(update).is_private:
             # For private chats, use legacy user_id based system
-            reply = await send_message_and_get_response(user_id, user_message, username)
+            reply = await send_message_and_get_response(user_id, user_message, username, before_run=placeholder_ready)
         else:
             # For group chats, use chat-based system
-            reply = await send_message_and_get_response_for_chat(chat_identifier, user_message, username, user_id)
+            reply = await send_message_and_get_response_for_chat(
+                chat_identifier, user_message, username, user_id, before_run=placeholder_ready
+            )
+        processing_message = await placeholder_task
         
         # Конвертируем Markdown в HTML для красивого отображения
         formatted_reply = markdown_to_html(reply)
         
         # Заменяем сообщение о обработке на ответ
+        send_started_at = time.monotonic()
         try:
             await processing_message.edit_text(formatted_reply, parse_mode='HTML')
         except Exception as message_edit_error:
             # If editing failed (e.g., message too long), send new message with reply
             logger.warning(f"Failed to edit processing message: {message_edit_error}")
             await update.message.reply_text(formatted_reply, parse_mode='HTML')
+        trace.mark_sent(send_started_at)
             
     except Exception as message_processing_error:
         logger.error(f"Error processing message {log_context}: {message_processing_error}")
         # Replace processing message with error message
         try:
+            processing_message = await placeholder_task
             await processing_message.edit_text("❌ Произошла ошибка при обработке запроса. Попробуйте еще раз.")
         except:
             await update.message.reply_text("❌ Произошла ошибка при обработке запроса. Попробуйте еще раз.")
+    finally:
+        if not placeholder_task.done():
+            placeholder_task.cancel()
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle photo messages with optional caption"""
-    # First check if we should process this message at all
-    if not should_process_message(update):
-        return  # Ignore system messages, other bots, etc.
-    
-    user_id = update.effective_user.id
+async def ingest_photo_context(state: MessageState):
+    """Добавляет изображение в контекст беседы без ответа"""
+    update, context = state.update, state.context
+    update_context = state.update_context
+    user_id = state.user_id
     username = get_username(update)
     caption = update.message.caption or ""
-    chat_identifier = get_chat_identifier(update)
-    log_context = get_log_context(update)
+    chat_identifier = state.chat_identifier
+    log_context = state.log_context
     
-    # Check authorization - required for both processing and responding
-    if not await is_authorized_async(user_id):
-        # Only show authorization message if bot should respond
-        if should_respond_in_chat(update, bot_info["username"], bot_info["id"]):
-            await update.message.reply_text(
-                "🚫 Доступ к боту ограничен!\n\n"
-                "Для использования бота необходимо подписаться на канал:\n"
-                "👉 https://t.me/logloss_notes\n\n"
-                "После подписки попробуйте снова."
-            )
-        return
-    
-    # Check if we should respond to this message
-    should_respond = should_respond_in_chat(update, bot_info["username"], bot_info["id"])
-    
-    logger.info(f"{log_context} - Photo received {'[RESPOND]' if should_respond else '[CONTEXT]'}")
-    
-    # If we shouldn't respond, add image to context and return
-    if not should_respond:
-        try:
-            # Download image first for context processing
-            # Get the largest photo size
-            photo = update.message.photo[-1]
-            
-            # Check file size (max 20MB as per Telegram limit)
-            if photo.file_size > 20 * 1024 * 1024:
-                logger.warning(f"{log_context} - Image too large for context processing: {photo.file_size} bytes")
-                return
-            
-            # Get file info
-            file = await context.bot.get_file(photo.file_id)
-            
-            # Create temporary file
-            temp_dir = Path(tempfile.gettempdir()) / "telegram_bot_images"
-            temp_dir.mkdir(exist_ok=True)
-            
-            # Generate unique filename
-            file_extension = Path(file.file_path).suffix.lower()
-            if file_extension not in ['.jpg', '.jpeg', '.png', '.webp']:
-                logger.warning(f"{log_context} - Unsupported image format for context: {file_extension}")
-                return
-            
-            temp_file_path = temp_dir / f"image_{user_id}_{photo.file_unique_id}{file_extension}"
-            
-            # Download image using Telegram Bot API
-            await file.download_to_drive(temp_file_path)
-            
-            # Add to conversation context without responding
-            if is_private_chat(update):
-                # This shouldn't happen in private chats, but handle anyway
-                await add_image_to_context(user_id, str(temp_file_path), caption, username)
-            else:
-                # Add group image to context without responding
-                await add_image_to_context_for_chat(chat_identifier, str(temp_file_path), caption, username, user_id)
-            
-            logger.info(f"{log_context} - Image added to context (no response)")
-            
-        except Exception as context_error:
-            logger.error(f"Error adding image to context {log_context}: {context_error}")
-        finally:
-            # Clean up temp file
-            if 'temp_file_path' in locals() and temp_file_path.exists():
-                temp_file_path.unlink()
-        return
+    try:
+        # Download image first for context processing
+        # Get the largest photo size
+        photo = update.message.photo[-1]
+
+        # Check file size (max 20MB as per Telegram limit)
+        if photo.file_size > 20 * 1024 * 1024:
+            logger.warning(f"{log_context} - Image too large for context processing: {photo.file_size} bytes")
+            return
+
+        # Get file info
+        file = await context.bot.get_file(photo.file_id)
+
+        # Create temporary file
+        temp_dir = Path(tempfile.gettempdir()) / "telegram_bot_images"
+        temp_dir.mkdir(exist_ok=True)
+
+        # Generate unique filename
+        file_extension = Path(file.file_path).suffix.lower()
+        if file_extension not in ['.jpg', '.jpeg', '.png', '.webp']:
+            logger.warning(f"{log_context} - Unsupported image format for context: {file_extension}")
+            return
+
+        temp_file_path = temp_dir / f"image_{user_id}_{photo.file_unique_id}{file_extension}"
+
+        # Download image using Telegram Bot API
+        await file.download_to_drive(temp_file_path)
+
+        # Add to conversation context without responding
+        if update_context.is_private:
+            # This shouldn't happen in private chats, but handle anyway
+            await add_image_to_context(user_id, str(temp_file_path), caption, username)
+        else:
+            # Add group image to context without responding
+            await add_image_to_context_for_chat(chat_identifier, str(temp_file_path), caption, username, user_id)
+
+        logger.info(f"{log_context} - Image added to context (no response)")
+
+    except Exception as context_error:
+        logger.error(f"Error adding image to context {log_context}: {context_error}")
+    finally:
+        # Clean up temp file
+        if 'temp_file_path' in locals() and temp_file_path.exists():
+            temp_file_path.unlink()
+
+async def respond_to_photo(state: MessageState):
+    """Отвечает на изображение"""
+    update, context = state.update, state.context
+    update_context = state.update_context
+    user_id = state.user_id
+    username = get_username(update)
+    caption = update.message.caption or ""
+    chat_identifier = state.chat_identifier
     
-    # From here on, we're responding to the photo
     await update.message.chat.send_action(action="typing")
     
+    trace = start_request_trace(REQUEST_KIND_IMAGE, user_id, username, chat_identifier)
     try:
         # Get the largest photo size
         photo = update.message.photo[-1]
@@ -389,9 +452,10 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "🖼️ Ваше изображение передано в <b>ChatGPT</b> для анализа...",
             parse_mode='HTML'
         )
+        set_reply_placeholder(processing_message.chat_id, processing_message.message_id)
         
         # Process image with OpenAI using dual-mode
-        if is_private_chat(update):
+        if update_context.is_private:
             # For private chats, use legacy user_id based system
             reply = await send_image_and_get_response(user_id, str(temp_file_path), caption, username)
         else:
@@ -402,6 +466,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         formatted_reply = markdown_to_html(reply)
         
         # Заменяем сообщение о обработке на ответ
+        send_started_at = time.monotonic()
         try:
             await processing_message.edit_text(formatted_reply, parse_mode='HTML')
         except Exception as e:
@@ -409,6 +474,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # отправляем новое сообщение с ответом
             logger.warning(f"Failed to edit processing message for image: {e}")
             await update.message.reply_text(formatted_reply, parse_mode='HTML')
+        trace.mark_sent(send_started_at)
         
     except Exception as image_processing_error:
         logger.error(f"Error processing photo from user {user_id}: {image_processing_error}")
@@ -427,6 +493,43 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 temp_file_path.unlink()
         except Exception as cleanup_error:
             logger.error(f"Error cleaning up temp file: {cleanup_error}")
+        await trace.finish()
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle photo messages with optional caption"""
+    await photo_pipeline.run(update, context)
+
+async def deny_access(update: Update):
+    """Сообщает пользователю без подписки, как получить доступ"""
+    await update.message.reply_text(
+        "🚫 Доступ к боту ограничен!\n\n"
+        "Для использования бота необходимо подписаться на канал:\n"
+        "👉 https://t.me/logloss_notes\n\n"
+        "После подписки попробуйте снова."
+    )
+
+def get_cached_authorization(user_id: int) -> Optional[bool]:
+    """Статус подписки пользователя из кеша, без запросов к Telegram (None - неизвестен)"""
+    return get_cached_subscription(CHANNEL_IDS, user_id, require_all=REQUIRE_ALL_CHANNELS)
+
+# Проверки сообщений до основной работы: порядок и политика авторизации контекста - в config.py
+auth_hooks = AuthHooks(
+    check=is_authorized_async,
+    cached=get_cached_authorization,
+    deny=deny_access,
+    chat_authorized=is_chat_authorized,
+    mark_chat_authorized=mark_chat_authorized
+)
+text_pipeline = HandlerPipeline(
+    "Message", respond=respond_to_text, ingest=ingest_text_context, auth=auth_hooks,
+    over_quota=reply_if_over_quota, bot_identity=lambda: (bot_info["username"], bot_info["id"]),
+    requires_text=True, order=parse_order(HANDLER_PIPELINE_ORDER), auth_policy=AUTH_CONTEXT_POLICY
+)
+photo_pipeline = HandlerPipeline(
+    "Photo", respond=respond_to_photo, ingest=ingest_photo_context, auth=auth_hooks,
+    over_quota=reply_if_over_quota, bot_identity=lambda: (bot_info["username"], bot_info["id"]),
+    order=parse_order(HANDLER_PIPELINE_ORDER), auth_policy=AUTH_CONTEXT_POLICY
+)
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle document messages (TXT, PDF, DOCX)"""
@@ -489,6 +592,9 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
+    if await reply_if_over_quota(update, user_id, f"user:{user_id}"):
+        return
+    
     await update.message.chat.send_action(action="typing")
     logger.info(f"Document processing started for user {user_id} (@{username}): {document.mime_type}")
     
@@ -498,8 +604,10 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"<i>Это может занять некоторое время в зависимости от размера документа</i>",
         parse_mode='HTML'
     )
+    set_reply_placeholder(processing_message.chat_id, processing_message.message_id)
     
     temp_file_path = None
+    trace = start_request_trace(REQUEST_KIND_DOCUMENT, user_id, username, f"user:{user_id}")
     try:
         # Get file info
         file = await context.bot.get_file(document.file_id)
@@ -529,7 +637,9 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         formatted_reply = markdown_to_html(reply)
         
         # Edit processing message with result
+        send_started_at = time.monotonic()
         await processing_message.edit_text(formatted_reply, parse_mode='HTML')
+        trace.mark_sent(send_started_at)
         
         logger.info(f"Document processed successfully for user {user_id}")
         
@@ -556,12 +666,17 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.debug(f"Cleaned up temp file: {temp_file_path}")
         except Exception as cleanup_error:
             logger.error(f"Error cleaning up temp document file: {cleanup_error}")
+        await trace.finish()
 
 async def handle_image_generation_request(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str):
     """Processes image generation requests"""
     user_id = update.effective_user.id
     username = get_username(update)
     
+    chat_identifier = get_update_context(update).chat_identifier
+    if await reply_if_over_quota(update, user_id, chat_identifier):
+        return
+    
     # Processing notification
     processing_message = await update.message.reply_text(
         "🎨 Generating image with <b>DALL-E 3</b>...\n"
@@ -569,11 +684,13 @@ async def handle_image_generation_request(update: Update, context: ContextTypes.
         parse_mode='HTML'
     )
     
+    trace = start_request_trace(REQUEST_KIND_DALLE, user_id, username, chat_identifier)
     try:
         # Generate image
         image_url, tokens_used = await generate_image_dalle(prompt, user_id, username)
         
         # Send result
+        send_started_at = time.monotonic()
         await update.message.reply_photo(
             photo=image_url,
             caption=f"🎨 <b>Generated by DALL-E 3</b>\n\n"
@@ -581,6 +698,7 @@ async def handle_image_generation_request(update: Update, context: ContextTypes.
                    f"<i>Used ~{tokens_used} tokens (≈$0.04)</i>",
             parse_mode='HTML'
         )
+        trace.mark_sent(send_started_at)
         
         # Remove processing message
         await processing_message.delete()
@@ -591,6 +709,8 @@ async def handle_image_generation_request(update: Update, context: ContextTypes.
         error_message = str(image_generation_error) if str(image_generation_error) else "Image generation failed"
         await processing_message.edit_text(f"❌ {error_message}")
         logger.error(f"Image generation failed for user {user_id}: {image_generation_error}")
+    finally:
+        await trace.finish()
 
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -702,6 +822,79 @@ async def generate_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     prompt = " ".join(context.args)
     await handle_image_generation_request(update, context, prompt)
 
+async def skip_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Останавливает обработку повторно доставленного апдейта (группа -2, раньше всех обработчиков)"""
+    message = update.message
+    if not claim_update(
+        context.bot.id, update.update_id,
+        message.chat_id if message else None,
+        message.message_id if message else None
+    ):
+        logger.info(f"[Dedup] Skipping duplicate update {update.update_id}")
+        raise ApplicationHandlerStop
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Учитывает каждый апдейт в счетчиках DAU/MAU и активности чатов (группа -1, до основных обработчиков)"""
+    user = update.effective_user
+    chat = update.effective_chat
+    record_activity(
+        user.id if user else None,
+        chat.id if chat else None,
+        chat is not None and chat.type in ("group", "supergroup")
+    )
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Command /stats - activity counters for administrators"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_USER_IDS:
+        return  # Команда скрыта от обычных пользователей
+    
+    summary = get_activity_summary()
+    if summary is None:
+        await update.message.reply_text("❌ Счетчики активности недоступны")
+        return
+    
+    top_chats = "\n".join(
+        f"• <code>{chat_id}</code>: {count}" for chat_id, count in summary["top_chats"]
+    ) or "• нет данных"
+    
+    queue_sections = []
+    for openai_queue in OPENAI_QUEUES:
+        queue_stats = openai_queue.get_stats(top=5)
+        busy_tenants = "\n".join(
+            f"• <code>{tenant}</code> (вес {metrics['weight']:g}): в очереди {metrics['queued']}, "
+            f"выполняется {metrics['running']}, отклонено {metrics['rejected']}, "
+            f"ожидание ср. {metrics['avg_wait_ms']} / макс. {metrics['max_wait_ms']} мс"
+            for tenant, metrics in queue_stats["tenants"].items()
+        ) or "• нет данных"
+        limiter = OPENAI_LIMITERS.get(queue_stats["name"])
+        limit_note = f" (адаптивный лимит, макс. {limiter.max_limit})" if limiter else ""
+        queue_sections.append(
+            f"<b>Очередь OpenAI {queue_stats['name']}:</b> выполняется {queue_stats['running']}/{queue_stats['concurrency']}{limit_note}, "
+            f"в очереди {queue_stats['queued']} (дольше всех {queue_stats['oldest_wait_ms']} мс), "
+            f"отклонено {queue_stats['rejected']}\n{busy_tenants}"
+        )
+    queues_text = "\n\n".join(queue_sections)
+    
+    retry_lines = "\n".join(
+        f"• <code>{operation}</code>: вызовов {counters['calls']}, повторов {counters['retries']}, "
+        f"восстановлено {counters['recovered']}, ошибок {counters['failed']}"
+        for operation, counters in get_retry_stats().items()
+        if counters["retries"] or counters["recovered"] or counters["failed"]
+    ) or "• повторов не было"
+    await update.message.reply_text(
+        f"📊 <b>Активность за {summary['date']}</b>\n\n"
+        f"👤 DAU: <b>{summary['dau']}</b>\n"
+        f"👥 MAU ({summary['month']}): <b>{summary['mau']}</b>\n"
+        f"💬 Активных групп за день: <b>{summary['active_chats_day']}</b>\n"
+        f"💬 Активных групп за месяц: <b>{summary['active_chats_month']}</b>\n\n"
+        f"<b>Самые активные чаты (апдейтов за день):</b>\n{top_chats}\n\n"
+        f"{queues_text}\n\n"
+        f"<b>Повторы вызовов OpenAI:</b>\n{retry_lines}\n\n"
+        f"<i>DAU/MAU - оценка HyperLogLog, погрешность ~1%</i>",
+        parse_mode='HTML'
+    )
+
 def init_analytics_sync():
     """Синхронная обертка для инициализации аналитики."""
     try:
@@ -714,6 +907,83 @@ def init_analytics_sync():
     except Exception as analytics_init_error:
         logger.error(f"Failed to initialize analytics database: {analytics_init_error}")
 
+async def deliver_resumed_reply(bot, record: dict):
+    """Дожидается ответа на запуск, прерванный перезапуском, и дописывает его в сообщение-заглушку"""
+    try:
+        reply = await resume_pending_run(record)
+        formatted_reply = markdown_to_html(reply)
+        try:
+            await bot.edit_message_text(
+                formatted_reply, chat_id=record["chat_id"], message_id=record["message_id"], parse_mode='HTML'
+            )
+        except Exception as message_edit_error:
+            # Заглушка удалена или ответ слишком длинный - отправляем ответом на нее
+            logger.warning(f"Failed to edit placeholder for resumed run {record['run_id']}: {message_edit_error}")
+            await bot.send_message(
+                record["chat_id"], formatted_reply, parse_mode='HTML',
+                reply_to_message_id=record["message_id"], allow_sending_without_reply=True
+            )
+        logger.info(f"[PendingRuns] Delivered reply of resumed run {record['run_id']} to chat {record['chat_id']}")
+    except Exception as resume_error:
+        logger.error(f"[PendingRuns] Failed to resume run {record['run_id']}: {resume_error}")
+
+async def resume_pending_runs(context: ContextTypes.DEFAULT_TYPE):
+    """Подхватывает запуски ассистента, не завершенные до перезапуска бота (фоновая задача при старте)"""
+    records = load_pending_runs()
+    if not records:
+        return
+    logger.info(f"[PendingRuns] Resuming {len(records)} runs interrupted by restart")
+    await asyncio.gather(*(deliver_resumed_reply(context.bot, record) for record in records))
+
+async def warmup_subscription_cache(context: ContextTypes.DEFAULT_TYPE):
+    """Прогревает кеш подписок недавно активных пользователей (фоновая задача при старте)"""
+    try:
+        user_ids = await analytics.get_recent_active_users(days=SUBSCRIPTION_WARMUP_DAYS)
+        if not user_ids:
+            logger.info("[Subscription] Cache warmup skipped: no recently active users")
+            return
+        
+        logger.info(f"[Subscription] Cache warmup started for {len(user_ids)} recently active users")
+        await warm_subscription_cache(
+            TELEGRAM_BOT_TOKEN,
+            CHANNEL_IDS,
+            user_ids,
+            batch_size=SUBSCRIPTION_WARMUP_BATCH_SIZE,
+            batch_delay=SUBSCRIPTION_WARMUP_BATCH_DELAY,
+            require_all=REQUIRE_ALL_CHANNELS
+        )
+    except Exception as warmup_error:
+        logger.error(f"[Subscription] Cache warmup failed: {warmup_error}")
+
+async def analytics_retention(context: ContextTypes.DEFAULT_TYPE):
+    """Архивирует старые события аналитики и возвращает место в базе (ежедневная задача)"""
+    try:
+        result = await analytics.run_retention()
+        logger.info(f"[Analytics] Retention finished: {result['archived_events']} events archived, "
+                    f"{result['reclaimed_pages']} pages reclaimed")
+    except Exception as retention_error:
+        logger.error(f"[Analytics] Retention failed: {retention_error}")
+
+async def reconcile_quota_counters(context: ContextTypes.DEFAULT_TYPE):
+    """Сверяет счетчики дневных квот в Redis с данными SQLite (при старте и ночью)"""
+    try:
+        await analytics.flush()
+        today = date.today()
+        days = [today]
+        # Ночной запуск сверяет и только что завершившийся день
+        if datetime.now().hour == 0:
+            days.insert(0, today - timedelta(days=1))
+        for day in days:
+            target_date = day.isoformat()
+            user_totals = {
+                row["user_id"]: row["total_tokens"]
+                for row in await analytics.get_all_users_usage_by_date(target_date)
+            }
+            chat_totals = await analytics.get_chat_usage_by_date(target_date)
+            reconcile_counters(target_date, user_totals, chat_totals)
+    except Exception as reconcile_error:
+        logger.error(f"[Quota] Counter reconcile failed: {reconcile_error}")
+
 async def setup_bot_commands(bot):
     """Устанавливает меню команд для бота."""
     commands = [
@@ -763,8 +1033,17 @@ def markdown_to_html(text):
     
     return text.strip()
 
-async def setup_handlers(app):
-    """Настройка обработчиков бота"""
+async def setup_handlers(app, maintenance_jobs: bool = True, deduplicate: bool = True):
+    """
+    Настройка обработчиков бота.
+    
+    Args:
+        app: Приложение бота
+        maintenance_jobs: Планировать фоновые задачи (прогрев кеша, сверка квот, архивирование);
+            в многопроцессном режиме - только в одном воркере
+        deduplicate: Пропускать повторно доставленные апдейты; в режиме Redis Streams повторы
+            отсекает прием, а перевыданные записи стрима должны обрабатываться снова
+    """
     # Инициализируем аналитику асинхронно
     try:
         await analytics.init_database()
@@ -787,18 +1066,96 @@ async def setup_handlers(app):
         logger.error(f"❌ Ошибка установки меню команд: {commands_error}")
 
     # Добавляем обработчики команд и сообщений
+    # Счетчики активности видят все апдейты и не мешают основным обработчикам
+    if deduplicate:
+        app.add_handler(TypeHandler(Update, skip_duplicate_update), group=-2)
+    app.add_handler(TypeHandler(Update, track_activity), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("reset", reset))
     app.add_handler(CommandHandler("history", history))
     app.add_handler(CommandHandler("export", export))
     app.add_handler(CommandHandler("subscribe", subscribe))
     app.add_handler(CommandHandler("generate", generate_command))
+    app.add_handler(CommandHandler("stats", stats_command))
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     app.add_handler(MessageHandler(filters.Document.PDF | filters.Document.TXT | filters.Document.Category("application/vnd.openxmlformats-officedocument.wordprocessingml.document"), handle_document))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
+    # Прогрев кеша подписок выполняется в фоне через JobQueue и не блокирует polling
+    if SUBSCRIPTION_WARMUP_ENABLED and maintenance_jobs and app.job_queue:
+        app.job_queue.run_once(warmup_subscription_cache, when=1, name="subscription_cache_warmup")
+        logger.info("✅ Прогрев кеша подписок запланирован")
+    
+    # Ответы на запуски, прерванные перезапуском, доставляются в исходные сообщения
+    if maintenance_jobs and app.job_queue:
+        app.job_queue.run_once(resume_pending_runs, when=1, name="resume_pending_runs")
+    
+    # Сверка счетчиков квот с SQLite: сразу после старта и каждую ночь
+    if quotas_enabled() and maintenance_jobs and app.job_queue:
+        app.job_queue.run_once(reconcile_quota_counters, when=2, name="quota_reconcile_startup")
+        app.job_queue.run_daily(
+            reconcile_quota_counters,
+            time=dtime(hour=0, minute=5, tzinfo=datetime.now().astimezone().tzinfo),
+            name="quota_reconcile"
+        )
+        logger.info("✅ Сверка счетчиков квот запланирована")
+    
+    # Архивирование старых событий аналитики раз в сутки в тихие часы
+    if ANALYTICS_RETENTION_DAYS > 0 and maintenance_jobs and app.job_queue:
+        app.job_queue.run_daily(
+            analytics_retention,
+            time=dtime(hour=ANALYTICS_RETENTION_HOUR, tzinfo=timezone.utc),
+            name="analytics_retention"
+        )
+        logger.info("✅ Архивирование аналитики запланировано")
+    
     logger.info("✅ Обработчики настроены")
 
+async def start_receiving_updates(app):
+    """
+    Запускает получение апдейтов в режиме BOT_MODE.
+    
+    webhook - встроенный HTTP-сервер PTB: Telegram сам присылает апдейты (push), запросы
+    без верного X-Telegram-Bot-Api-Secret-Token отклоняются сервером с 403.
+    polling - long polling через getUpdates (при старте webhook снимается автоматически).
+    """
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+        if not WEBHOOK_SECRET_TOKEN:
+            logger.warning("⚠️ WEBHOOK_SECRET_TOKEN не задан: апдейты на webhook не проверяются")
+        
+        url_path = WEBHOOK_PATH.strip("/")
+        await app.updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=url_path,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            cert=WEBHOOK_CERT_PATH,
+            key=WEBHOOK_KEY_PATH,
+            bootstrap_retries=3,            # Количество попыток setWebhook при запуске
+            allowed_updates=None,           # Получаем все типы обновлений
+            drop_pending_updates=False      # Не пропускаем ожидающие обновления
+        )
+        logger.info(f"✅ Webhook запущен: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{url_path}")
+        return
+    
+    # Запускаем polling с настройками устойчивости
+    await app.updater.start_polling(
+        poll_interval=1.0,              # Интервал между запросами
+        timeout=30,                     # Timeout для getUpdates
+        bootstrap_retries=3,            # Количество попыток при запуске
+        read_timeout=120,               # Timeout чтения
+        write_timeout=60,               # Timeout записи  
+        connect_timeout=30,             # Timeout соединения
+        pool_timeout=20,                # Timeout пула соединений
+        allowed_updates=None,           # Получаем все типы обновлений
+        drop_pending_updates=False      # Не пропускаем ожидающие обновления
+    )
+    logger.info("✅ Polling запущен")
+
 async def cleanup_app(app):
     """Безопасная остановка приложения"""
     try:
@@ -821,18 +1178,18 @@ async def cleanup_app(app):
     except Exception as shutdown_error:
         logger.warning(f"⚠️ Ошибка при завершении приложения: {shutdown_error}")
 
-async def main():
-    """Главная функция для запуска бота"""
-    logger.info("🚀 Запускаем Telegram бота...")
+def build_application(concurrent: bool = True) -> Application:
+    """
+    Создает приложение бота с настройками соединения.
     
-    # Проверяем наличие токена
-    bot_token = TELEGRAM_BOT_TOKEN
-    if not bot_token:
-        logger.error("❌ TELEGRAM_BOT_TOKEN не найден в конфигурации")
-        return
-
+    Args:
+        concurrent: Включить параллельную обработку апдейтов (UPDATE_CONCURRENCY)
+    """
     # Настройки для надежного соединения
     request = HTTPXRequest(
+        # По умолчанию в пуле одно соединение: при параллельной обработке апдейтов
+        # запросы к Bot API выстраивались бы за ним в очередь
+        connection_pool_size=max(1, UPDATE_CONCURRENCY) + 4,
         read_timeout=60,        # Время ожидания ответа от сервера
         write_timeout=60,       # Время ожидания отправки данных
         connect_timeout=30,     # Время ожидания соединения
@@ -847,13 +1204,43 @@ async def main():
     )
 
     # Создаем приложение бота с настройками устойчивости
-    app = (
+    builder = (
         Application.builder()
-        .token(bot_token)
+        .token(TELEGRAM_BOT_TOKEN)
         .request(request)
         .get_updates_request(get_updates_request)
-        .build()
     )
+    if concurrent and UPDATE_CONCURRENCY > 1:
+        # Долгий запрос одного чата не блокирует остальные; порядок внутри чата сохраняется
+        builder = builder.concurrent_updates(
+            ChatOrderedUpdateProcessor(
+                UPDATE_CONCURRENCY, MAX_PENDING_UPDATES, BACKGROUND_CONCURRENCY_SHARE,
+                interrupt_callback=interrupt_on_reset
+            )
+        )
+    return builder.build()
+
+async def close_analytics():
+    """Graceful shutdown аналитики: сначала сбрасываем буфер отложенной записи"""
+    try:
+        flushed = await analytics.flush()
+        logger.info(f"✅ Буфер аналитики сброшен ({flushed} событий)")
+        await analytics.close()
+        logger.info("✅ Аналитика остановлена")
+    except Exception as analytics_close_error:
+        logger.error(f"❌ Ошибка при остановке аналитики: {analytics_close_error}")
+
+async def main():
+    """Главная функция для запуска бота"""
+    logger.info("🚀 Запускаем Telegram бота...")
+    
+    # Проверяем наличие токена
+    bot_token = TELEGRAM_BOT_TOKEN
+    if not bot_token:
+        logger.error("❌ TELEGRAM_BOT_TOKEN не найден в конфигурации")
+        return
+
+    app = build_application()
 
     # Добавляем обработчики
     await setup_handlers(app)
@@ -873,23 +1260,12 @@ async def main():
             
             # Запускаем polling с обработкой ошибок
             await app.start()
-            logger.info("✅ Бот запущен, начинаем polling...")
+            logger.info(f"✅ Бот запущен, режим получения апдейтов: {BOT_MODE}")
             
             # Сбрасываем счетчик попыток при успешном запуске
             retry_count = 0
             
-            # Запускаем polling с настройками устойчивости
-            await app.updater.start_polling(
-                poll_interval=1.0,              # Интервал между запросами
-                timeout=30,                     # Timeout для getUpdates
-                bootstrap_retries=3,            # Количество попыток при запуске
-                read_timeout=120,               # Timeout чтения
-                write_timeout=60,               # Timeout записи  
-                connect_timeout=30,             # Timeout соединения
-                pool_timeout=20,                # Timeout пула соединений
-                allowed_updates=None,           # Получаем все типы обновлений
-                drop_pending_updates=False      # Не пропускаем ожидающие обновления
-            )
+            await start_receiving_updates(app)
             
             # Ожидаем остановки
             stop_event = asyncio.Event()
@@ -908,6 +1284,7 @@ async def main():
             
             # Ожидаем сигнал остановки
             await stop_event.wait()
+            break
             
         except telegram.error.NetworkError as e:
             retry_count += 1
@@ -983,20 +1360,28 @@ async def main():
     # Финальная остановка
     try:
         logger.info("🔄 Останавливаем бота...")
+        if app.updater and app.updater.running:
+            await app.updater.stop()
+        # Запросы к ассистенту в работе: даем доработать, остальные отменяем в OpenAI
+        await shutdown_active_runs(OPENAI_SHUTDOWN_GRACE)
         if app.running:
             await app.stop()
         await app.shutdown()
         logger.info("✅ Бот остановлен")
         
-        # Graceful shutdown аналитики
-        try:
-            await analytics.close()
-            logger.info("✅ Аналитика остановлена")
-        except Exception as analytics_close_error:
-            logger.error(f"❌ Ошибка при остановке аналитики: {analytics_close_error}")
+        await close_analytics()
             
     except Exception as e:
         logger.error(f"❌ Ошибка при остановке бота: {e}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if UPDATE_QUEUE == "stream":
+        # Прием апдейтов в Redis Streams; обработчики запускаются отдельно: python stream_queue.py worker
+        from stream_queue import run_stream_intake
+        run_stream_intake()
+    elif BOT_WORKERS > 1:
+        # Многопроцессный режим: фронт-процесс принимает апдейты и раздает их воркерам по чатам
+        from sharding import run_sharded
+        run_sharded(BOT_WORKERS)
+    else:
+        asyncio.run(main())
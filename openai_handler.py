@@ -1,48 +1,538 @@
 import asyncio
 import re
-from config import OPENAI_API_KEY, ASSISTANT_ID
+import time
+from typing import Awaitable, Callable, Optional
+from config import (
+    OPENAI_API_KEY, ASSISTANT_ID, OPENAI_RUN_CONCURRENCY, OPENAI_UPLOAD_CONCURRENCY, OPENAI_IMAGE_CONCURRENCY,
+    OPENAI_MAX_QUEUED, OPENAI_ADMISSION_TIMEOUT, FAIR_QUEUE_WEIGHTS, FAIR_QUEUE_DEFAULT_WEIGHT,
+    OPENAI_ADAPTIVE_CONCURRENCY, OPENAI_MIN_CONCURRENCY, OPENAI_RATELIMIT_HEADROOM, OPENAI_RUN_TIMEOUT,
+    HANDLER_PROCESSES
+)
 from session_manager import get_thread_id, set_thread_id, add_user_image, add_user_document, get_thread_id_for_chat, set_thread_id_for_chat, add_chat_image, add_chat_document
 from logger import logger
-from openai import AsyncOpenAI
+from fair_queue import AdmissionRejected, FairQueue, parse_weights, tenant_for
+from openai_retry import budget_left, call_openai
+from pending_runs import get_reply_placeholder, save_pending_run, remove_pending_run, load_pending_runs
+from openai_limits import AdaptiveConcurrency, rate_limit_hook, CALL_KIND_RUNS, CALL_KIND_UPLOADS, CALL_KIND_IMAGES
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from openai.types import Image, ImageModel, ImagesResponse
 import openai
 import tempfile
-from user_analytics import analytics
+from user_analytics import (
+    analytics, get_request_trace, trace_span, REQUEST_KIND_TEXT, REQUEST_KIND_IMAGE, REQUEST_KIND_DOCUMENT
+)
+
+
+def _process_share(limit: int) -> int:
+    """
+    Part of a bot-wide concurrency limit available to this process.
+    Every handler process has its own queues, so the limit is split between them
+    (at least one slot each, so a limit below the process count is exceeded).
+    """
+    return max(1, limit // HANDLER_PROCESSES)
+
+
+# Runs, file uploads and image generations are admitted per tenant by weighted fair
+# queuing, with a bounded wait queue and admission timeout for each kind of call.
+# Fairness holds within a process; with several processes the topics of one group
+# may be served by different ones
+_tenant_weights = parse_weights(FAIR_QUEUE_WEIGHTS)
+_admission_timeout = OPENAI_ADMISSION_TIMEOUT or None
+run_queue = FairQueue(
+    CALL_KIND_RUNS, _process_share(OPENAI_RUN_CONCURRENCY), _tenant_weights, FAIR_QUEUE_DEFAULT_WEIGHT,
+    max_queued=OPENAI_MAX_QUEUED, wait_timeout=_admission_timeout
+)
+upload_queue = FairQueue(
+    CALL_KIND_UPLOADS, _process_share(OPENAI_UPLOAD_CONCURRENCY), _tenant_weights, FAIR_QUEUE_DEFAULT_WEIGHT,
+    max_queued=OPENAI_MAX_QUEUED, wait_timeout=_admission_timeout
+)
+image_queue = FairQueue(
+    CALL_KIND_IMAGES, _process_share(OPENAI_IMAGE_CONCURRENCY), _tenant_weights, FAIR_QUEUE_DEFAULT_WEIGHT,
+    max_queued=OPENAI_MAX_QUEUED, wait_timeout=_admission_timeout
+)
+OPENAI_QUEUES = (run_queue, upload_queue, image_queue)
+
+# Queue limits adapt to the rate-limit headers of every response (AIMD)
+OPENAI_LIMITERS = {}
+if OPENAI_ADAPTIVE_CONCURRENCY:
+    OPENAI_LIMITERS = {
+        openai_queue.name: AdaptiveConcurrency(
+            openai_queue, min_limit=OPENAI_MIN_CONCURRENCY, headroom=OPENAI_RATELIMIT_HEADROOM
+        )
+        for openai_queue in OPENAI_QUEUES
+    }
+
+# Retries are handled by openai_retry with per-operation idempotency rules
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(event_hooks={"response": [rate_limit_hook(OPENAI_LIMITERS)]})
+)
+
+# Reply when a request is not admitted during a load spike
+BUSY_REPLY = "⏳ Сейчас слишком много запросов. Попробуйте еще раз через минуту."
+
+
+def _current_tenant(default_tenant: str) -> str:
+    """Tenant of the current request trace, or the given default outside of one"""
+    trace = get_request_trace()
+    if trace:
+        return tenant_for(trace.chat_identifier, trace.user_id)
+    return default_tenant
+
+
+async def _upload_file(file_path: str, purpose: str, chat_identifier: str):
+    """
+    Uploads a file to OpenAI within the upload queue's admission limits.
+    
+    Raises:
+        AdmissionRejected: The upload could not start in time
+    """
+    async def upload_once():
+        with open(file_path, "rb") as upload:
+            return await client.files.create(file=upload, purpose=purpose)
+
+    async with upload_queue.slot(_current_tenant(tenant_for(chat_identifier))):
+        return await call_openai("files.create", upload_once)
+
+
+async def _add_user_message(thread_id: str, content, attachments: list = None):
+    """
+    Adds a user message to the thread.
+    If an attempt fails ambiguously, the thread is checked for a user message created
+    since that attempt (messages of one chat are processed one at a time) before retrying.
+    """
+    extra = {"attachments": attachments} if attachments else {}
+
+    async def find_created_message(attempt_started: float):
+        latest = await _list_messages(thread_id, limit=1, order="desc")
+        if latest.data and latest.data[0].role == "user" and latest.data[0].created_at >= int(attempt_started) - 1:
+            return latest.data[0]
+        return None
+
+    return await call_openai(
+        "messages.create",
+        lambda: client.beta.threads.messages.create(thread_id=thread_id, role="user", content=content, **extra),
+        recover=find_created_message
+    )
+
+
+async def _delete_message(thread_id: str, message_id: str) -> None:
+    """Deletes a message from the thread, logging failures"""
+    try:
+        await call_openai(
+            "messages.delete",
+            lambda: client.beta.threads.messages.delete(thread_id=thread_id, message_id=message_id)
+        )
+    except Exception as delete_error:
+        logger.warning(f"[OpenAI] Failed to delete message {message_id} from thread {thread_id}: {delete_error}")
+
+
+async def _list_messages(thread_id: str, **params):
+    """Lists thread messages"""
+    return await call_openai("messages.list", lambda: client.beta.threads.messages.list(thread_id=thread_id, **params))
 
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 async def create_thread():
-    thread = await client.beta.threads.create()
+    thread = await call_openai("threads.create", lambda: client.beta.threads.create())
     return thread.id
 
-async def send_message_and_get_response(user_id: int, user_message: str, username: str = None) -> str:
-    thread_id = get_thread_id(user_id)
-    if not thread_id:
-        thread_id = await create_thread()
-        set_thread_id(user_id, thread_id)
 
-    # Добавляем сообщение пользователя
-    await client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=user_message
-    )
+# Run statuses after which polling stops
+TERMINAL_RUN_STATUSES = ("completed", "failed", "cancelled", "expired", "incomplete")
+
+# Replies for runs that ended without an answer, by reason
+RUN_INTERRUPTED_REPLIES = {
+    "timeout": "⏱ Ассистент не успел ответить. Попробуйте еще раз.",
+    "expired": "⏱ Ассистент не успел ответить. Попробуйте еще раз.",
+    "incomplete": "❌ Ответ ассистента оборвался. Попробуйте еще раз.",
+    "reset": "🔄 Запрос отменен: история беседы сброшена.",
+    "shutdown": "⚙️ Бот перезапускается, запрос отменен. Попробуйте еще раз через минуту.",
+    "handoff": "⚙️ Бот перезапускается. Ответ появится в этом сообщении после перезапуска.",
+}
+
 
-    # Запускаем выполнение
-    run = await client.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=ASSISTANT_ID,
+class RunInterrupted(Exception):
+    """Raised when a run ends without an answer here: deadline, expiry, /reset or shutdown"""
+    
+    def __init__(self, reason: str, run_id: str = None):
+        super().__init__(f"Run {run_id} interrupted: {reason}")
+        self.reason = reason
+        self.run_id = run_id
+    
+    @property
+    def reply(self) -> str:
+        """Message for the user"""
+        return RUN_INTERRUPTED_REPLIES.get(self.reason, RUN_INTERRUPTED_REPLIES["timeout"])
+
+
+class _ActiveRun:
+    """Run being polled; interrupt() makes the poller stop and cancel it right away"""
+    
+    __slots__ = ("thread_id", "run_id", "persisted", "cancel_reason", "interrupted")
+    
+    def __init__(self, thread_id: str, run_id: str, persisted: bool = False):
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.persisted = persisted
+        self.cancel_reason = None
+        self.interrupted = asyncio.Event()
+    
+    def interrupt(self, reason: str) -> None:
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+        self.interrupted.set()
+
+
+# thread_id -> run currently polled in this process (a thread has at most one active run)
+_active_runs: dict[str, _ActiveRun] = {}
+
+
+def interrupt_runs(thread_id: str = None, reason: str = "reset") -> int:
+    """
+    Asks pollers to cancel active runs.
+    
+    Args:
+        thread_id: Thread whose run to interrupt (None - all runs)
+        reason: Key of RUN_INTERRUPTED_REPLIES
+    
+    Returns:
+        int: Number of interrupted runs
+    """
+    targets = list(_active_runs.values()) if thread_id is None else [_active_runs.get(thread_id)]
+    interrupted = 0
+    for active in targets:
+        if active is not None:
+            active.interrupt(reason)
+            interrupted += 1
+    return interrupted
+
+
+def interrupt_runs_for_chat(chat_identifier: str, reason: str = "reset") -> int:
+    """Interrupts the active run of a chat's thread"""
+    thread_id = get_thread_id_for_chat(chat_identifier)
+    if not thread_id or thread_id not in _active_runs:
+        return 0
+    logger.info(f"[OpenAI] Interrupting active run for {chat_identifier} ({reason})")
+    return interrupt_runs(thread_id, reason)
+
+
+async def cancel_saved_runs_for_chat(chat_identifier: str) -> int:
+    """
+    Cancels runs of a chat's thread saved in pending_runs but not polled in this process
+    (resumed after a restart or running in another shard). Their pollers get the
+    "cancelled" status and reply with a cancellation instead of an answer from the old thread.
+    """
+    thread_id = get_thread_id_for_chat(chat_identifier)
+    if not thread_id:
+        return 0
+    cancelled = 0
+    for record in load_pending_runs():
+        if record["thread_id"] != thread_id or thread_id in _active_runs:
+            continue
+        logger.info(f"[OpenAI] Cancelling saved run {record['run_id']} for {chat_identifier}")
+        await _cancel_run(thread_id, record["run_id"])
+        cancelled += 1
+    return cancelled
+
+
+async def shutdown_active_runs(grace_period: float) -> None:
+    """
+    Lets active runs finish within the grace period, then stops polling the rest.
+    Runs saved in pending_runs are left running and resumed after restart;
+    the others are cancelled.
+    
+    Args:
+        grace_period: Seconds to wait before stopping
+    """
+    waited = 0.0
+    while _active_runs and waited < grace_period:
+        await asyncio.sleep(0.5)
+        waited += 0.5
+    if _active_runs:
+        handed_off = sum(1 for active in _active_runs.values() if active.persisted)
+        logger.info(f"[OpenAI] Stopping {len(_active_runs)} active runs on shutdown "
+                    f"({handed_off} left running to resume after restart)")
+        for active in list(_active_runs.values()):
+            active.interrupt("handoff" if active.persisted else "shutdown")
+
+
+async def _cancel_run(thread_id: str, run_id: str) -> None:
+    """Cancels a run on the OpenAI side, ignoring runs that already finished"""
+    try:
+        await call_openai("runs.cancel", lambda: client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id))
+        logger.info(f"[OpenAI] Run {run_id} cancelled")
+    except openai.APIStatusError as cancel_error:
+        # 400 - the run reached a terminal status in the meantime
+        if cancel_error.status_code != 400:
+            logger.warning(f"[OpenAI] Failed to cancel run {run_id}: {cancel_error}")
+    except Exception as cancel_error:
+        logger.warning(f"[OpenAI] Failed to cancel run {run_id}: {cancel_error}")
+
+
+async def _find_started_run(thread_id: str, attempt_started: float):
+    """Returns the run started on the thread since attempt_started, if any"""
+    latest = await call_openai(
+        "runs.list", lambda: client.beta.threads.runs.list(thread_id=thread_id, limit=1, order="desc")
     )
+    if latest.data and latest.data[0].created_at >= int(attempt_started) - 1:
+        return latest.data[0]
+    return None
+
 
-    # Ожидаем завершения
-    while True:
-        run_status = await client.beta.threads.runs.retrieve(
-            thread_id=thread_id,
-            run_id=run.id
+async def _poll_run(thread_id: str, run_id: str, timeout: float, persisted: bool = False):
+    """
+    Polls a run until a terminal status.
+    
+    The run is cancelled on the OpenAI side when it outlives the timeout, when it is
+    interrupted by /reset or shutdown, when it requires an unsupported action, and when
+    the polling coroutine itself is cancelled. A persisted run interrupted by shutdown is
+    left running instead, so it can be resumed after restart.
+    
+    Args:
+        thread_id: Thread of the run
+        run_id: Run to poll
+        timeout: Seconds until the run is cancelled
+        persisted: The run is saved in pending_runs
+    
+    Returns:
+        Run status object with a terminal status (or requires_action)
+    
+    Raises:
+        RunInterrupted: The run was stopped or ended without an answer
+    """
+    deadline = time.monotonic() + timeout
+    active = _ActiveRun(thread_id, run_id, persisted)
+    _active_runs[thread_id] = active
+    finished = False
+    try:
+        while True:
+            run_status = await call_openai(
+                "runs.retrieve",
+                lambda: client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+            )
+            if run_status.status in TERMINAL_RUN_STATUSES:
+                finished = True
+                break
+            if run_status.status == "requires_action":
+                # Tool calls are not supported - free the thread instead of waiting for expiry
+                break
+            if time.monotonic() >= deadline:
+                logger.warning(f"[OpenAI] Run {run_id} exceeded its {timeout:g}s deadline (status {run_status.status})")
+                active.interrupt("timeout")
+            if active.cancel_reason:
+                break
+            try:
+                await asyncio.wait_for(active.interrupted.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if _active_runs.get(thread_id) is active:
+            del _active_runs[thread_id]
+        if active.cancel_reason != "handoff":
+            if not finished:
+                # Shielded so the run is cancelled even when this coroutine is being cancelled
+                await asyncio.shield(_cancel_run(thread_id, run_id))
+            if persisted:
+                remove_pending_run(run_id)
+
+    if active.cancel_reason:
+        raise RunInterrupted(active.cancel_reason, run_id)
+    if run_status.status in ("expired", "incomplete"):
+        logger.warning(f"[OpenAI] Run {run_id} ended with status {run_status.status}")
+        raise RunInterrupted(run_status.status, run_id)
+    return run_status
+
+
+async def _run_assistant(thread_id: str, user_message_id: str = None):
+    """
+    Starts an assistant run on the thread and polls it until a terminal status.
+    The run waits for a slot in the tenant's fair queue first; the wait counts as queue
+    time on the request trace, and run start and finish are marked for latency analytics.
+    
+    When the handler has a reply placeholder, the run is saved in pending_runs while it is
+    polled, so its answer can still be delivered if the bot restarts in the meantime.
+    The run is bounded by OPENAI_RUN_TIMEOUT and the request budget (see _poll_run); a request
+    whose budget ran out while it waited for a slot or retried gets no run at all.
+    
+    Args:
+        thread_id: Thread to run the assistant on
+        user_message_id: Message the run answers; deleted from the thread when no run is
+            started for it, so the next request does not answer it as well
+    
+    Returns:
+        tuple: (run, run_status)
+    
+    Raises:
+        AdmissionRejected: The run could not start in time
+        RunInterrupted: The run was stopped or ended without an answer
+    """
+    trace = get_request_trace()
+    
+    try:
+        return await _admitted_run(thread_id, trace)
+    except (AdmissionRejected, RunInterrupted) as not_answered:
+        # No run was started (not admitted, or the budget ran out while waiting)
+        not_started = isinstance(not_answered, AdmissionRejected) or not_answered.run_id is None
+        if user_message_id and not_started:
+            await _delete_message(thread_id, user_message_id)
+        raise
+
+
+async def _admitted_run(thread_id: str, trace):
+    """Runs the assistant within a run_queue slot (see _run_assistant)"""
+    async with run_queue.slot(_current_tenant(f"thread:{thread_id}")):
+        remaining_budget = budget_left()
+        if remaining_budget is not None and remaining_budget <= 0:
+            # A run started now would be billed and cancelled by the first poll
+            logger.warning(f"[OpenAI] Request budget spent before the run on thread {thread_id}, not starting it")
+            raise RunInterrupted("timeout")
+        run = await call_openai(
+            "runs.create",
+            lambda: client.beta.threads.runs.create(thread_id=thread_id, assistant_id=ASSISTANT_ID),
+            recover=lambda attempt_started: _find_started_run(thread_id, attempt_started)
+        )
+        if trace:
+            trace.mark_run_started()
+
+        placeholder = get_reply_placeholder()
+        persisted = placeholder is not None and save_pending_run(
+            run.id, thread_id, *placeholder,
+            chat_identifier=trace.chat_identifier if trace else None,
+            user_id=trace.user_id if trace else None,
+            username=trace.username if trace else None,
+            request_kind=trace.request_kind if trace else None
         )
-        if run_status.status in ["completed", "failed", "cancelled"]:
-            break
-        await asyncio.sleep(1)
+
+        timeout = OPENAI_RUN_TIMEOUT
+        remaining_budget = budget_left()
+        if remaining_budget is not None:
+            timeout = min(timeout, max(0.0, remaining_budget))
+        try:
+            run_status = await _poll_run(thread_id, run.id, timeout, persisted)
+        finally:
+            if trace:
+                trace.mark_run_finished()
+    return run, run_status
+
+
+async def resume_pending_run(record: dict) -> str:
+    """
+    Waits for a run saved before a restart and returns its answer.
+    Token usage is recorded without a request trace.
+    
+    Args:
+        record: Record from pending_runs.load_pending_runs()
+    
+    Returns:
+        str: Assistant reply or a message explaining why there is none
+    """
+    run_id, thread_id = record["run_id"], record["thread_id"]
+    try:
+        async with run_queue.slot(tenant_for(record["chat_identifier"], record["user_id"])):
+            run_status = await _poll_run(thread_id, run_id, OPENAI_RUN_TIMEOUT, persisted=True)
+    except AdmissionRejected:
+        return BUSY_REPLY
+    except RunInterrupted as interrupted:
+        return interrupted.reply
+    
+    if run_status.status == "cancelled":
+        # Cancelled by /reset handled in another process
+        logger.info(f"[OpenAI] Resumed run {run_id} was cancelled")
+        return "❌ Запрос был отменен. Попробуйте еще раз."
+    if run_status.status != "completed":
+        logger.warning(f"[OpenAI] Resumed run {run_id} ended with status {run_status.status}")
+        return "❌ Ошибка при обработке запроса. Попробуйте еще раз."
+    
+    if record["chat_identifier"]:
+        await _record_run_usage(
+            run_status, record["user_id"], record["username"] or None,
+            record["chat_identifier"], record["request_kind"] or REQUEST_KIND_TEXT
+        )
+    
+    messages = await _list_messages(thread_id, run_id=run_id)
+    for message in reversed(messages.data):
+        if message.role == "assistant":
+            return message.content[0].text.value
+    return "Ошибка: не удалось получить ответ."
+
+
+async def _record_run_usage(run_status, user_id: int, username: str, chat_identifier: str, request_kind: str):
+    """
+    Records token usage of a finished run.
+    When a request trace is active, usage is attached to it and written after the reply is sent;
+    otherwise it is recorded right away.
+    
+    Args:
+        run_status: Finished run object
+        user_id: User ID for analytics (extracted from chat_identifier for private chats if missing)
+        username: Username for analytics
+        chat_identifier: Either "user:USER_ID" or "chat:CHAT_ID"
+        request_kind: Request kind (text/image/document)
+    """
+    if not (run_status.usage and run_status.usage.total_tokens):
+        return
+    
+    usage = run_status.usage
+    logger.debug(f"[OpenAI] Tokens used for {chat_identifier}: {usage.total_tokens} (prompt: {usage.prompt_tokens}, completion: {usage.completion_tokens})")
+    
+    try:
+        analytics_user_id = user_id
+        if not analytics_user_id and chat_identifier.startswith("user:"):
+            analytics_user_id = int(chat_identifier.split(":")[1])
+        if not analytics_user_id:
+            return
+        
+        trace = get_request_trace()
+        if trace:
+            trace.set_usage(usage.total_tokens, model=run_status.model,
+                            prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+        else:
+            await analytics.record_usage(
+                analytics_user_id, username, usage.total_tokens,
+                request_kind=request_kind,
+                chat_identifier=chat_identifier,
+                model=run_status.model,
+                prompt_tokens=usage.prompt_tokens,
+                completion_tokens=usage.completion_tokens
+            )
+    except Exception as e:
+        logger.error(f"Failed to record usage analytics for {chat_identifier}: {e}")
+
+async def send_message_and_get_response(user_id: int, user_message: str, username: str = None,
+                                        before_run: Optional[Callable[[], Awaitable]] = None) -> str:
+    """
+    Sends a private chat message to the assistant and returns its reply.
+    
+    Args:
+        user_id: User ID of the private chat
+        user_message: Message text from user
+        username: Username for analytics
+        before_run: Awaited after the message is posted and before the run starts; lets the
+            handler send its placeholder concurrently with the thread lookup and messages.create
+    
+    Returns:
+        str: Assistant response
+    """
+    with trace_span("prepare"):
+        thread_id = get_thread_id(user_id)
+        if not thread_id:
+            thread_id = await create_thread()
+            set_thread_id(user_id, thread_id)
+
+        # Добавляем сообщение пользователя
+        user_message_id = (await _add_user_message(thread_id, user_message)).id
+
+    if before_run is not None:
+        await before_run()
+
+    # Запускаем выполнение и ожидаем завершения
+    try:
+        run, run_status = await _run_assistant(thread_id, user_message_id)
+    except AdmissionRejected:
+        return BUSY_REPLY
+    except RunInterrupted as interrupted:
+        return interrupted.reply
 
     # Проверка статуса выполнения
     if run_status.status == "failed":
@@ -58,20 +548,10 @@ async def send_message_and_get_response(user_id: int, user_message: str, usernam
         return "❌ Запрос требует дополнительных действий, которые не поддерживаются."
 
     # Записываем использование токенов в аналитику
-    tokens_used = 0
-    if run_status.usage and run_status.usage.total_tokens:
-        tokens_used = run_status.usage.total_tokens
-        logger.debug(f"[OpenAI] Tokens used: {tokens_used} (prompt: {run_status.usage.prompt_tokens}, completion: {run_status.usage.completion_tokens})")
-    
-    # Записываем в аналитику
-    if tokens_used > 0:
-        try:
-            await analytics.record_usage(user_id, username, tokens_used)
-        except Exception as e:
-            logger.error(f"Failed to record usage analytics: {e}")
+    await _record_run_usage(run_status, user_id, username, f"user:{user_id}", REQUEST_KIND_TEXT)
 
     # Получаем только новые сообщения
-    messages = await client.beta.threads.messages.list(thread_id=thread_id)
+    messages = await _list_messages(thread_id)
     
     # Логирование для диагностики (БЕЗ содержимого сообщений!)
     logger.debug(f"[OpenAI] Retrieved {len(messages.data)} messages for user {user_id}")
@@ -117,11 +597,7 @@ async def add_message_to_context(user_id: int, user_message: str, username: str
 
     try:
         # Add message to thread without running the assistant
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_message
-        )
+        await _add_user_message(thread_id, user_message)
         logger.debug(f"Added context message for user {user_id}")
     except Exception as e:
         logger.error(f"Error adding message to context for user {user_id}: {e}")
@@ -146,11 +622,7 @@ async def add_message_to_context_for_chat(chat_identifier: str, user_message: st
 
     try:
         # Add message to thread without running the assistant
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_message
-        )
+        await _add_user_message(thread_id, user_message)
         logger.debug(f"Added context message for {chat_identifier}")
     except Exception as e:
         logger.error(f"Error adding message to context for {chat_identifier}: {e}")
@@ -175,11 +647,7 @@ async def add_image_to_context(user_id: int, image_path: str, caption: str = "",
 
     try:
         # Upload image file to OpenAI with purpose="vision"
-        with open(image_path, "rb") as image_file:
-            uploaded_file = await client.files.create(
-                file=image_file,
-                purpose="vision"
-            )
+        uploaded_file = await _upload_file(image_path, "vision", f"user:{user_id}")
         
         # Save file_id in Redis for tracking
         add_user_image(user_id, uploaded_file.id)
@@ -203,11 +671,7 @@ async def add_image_to_context(user_id: int, image_path: str, caption: str = "",
             })
         
         # Add message to thread without running the assistant
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=message_content
-        )
+        await _add_user_message(thread_id, message_content)
         
         logger.debug(f"Added image to context for user {user_id} (file_id: {uploaded_file.id})")
         
@@ -235,11 +699,7 @@ async def add_image_to_context_for_chat(chat_identifier: str, image_path: str, c
 
     try:
         # Upload image file to OpenAI with purpose="vision"
-        with open(image_path, "rb") as image_file:
-            uploaded_file = await client.files.create(
-                file=image_file,
-                purpose="vision"
-            )
+        uploaded_file = await _upload_file(image_path, "vision", chat_identifier)
         
         # Save file_id in Redis for tracking
         add_chat_image(chat_identifier, uploaded_file.id)
@@ -263,11 +723,7 @@ async def add_image_to_context_for_chat(chat_identifier: str, image_path: str, c
             })
         
         # Add message to thread without running the assistant
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=message_content
-        )
+        await _add_user_message(thread_id, message_content)
         
         logger.debug(f"Added image to context for {chat_identifier} (file_id: {uploaded_file.id})")
         
@@ -275,7 +731,8 @@ async def add_image_to_context_for_chat(chat_identifier: str, image_path: str, c
         logger.error(f"Error adding image to context for {chat_identifier}: {e}")
 
 
-async def send_message_and_get_response_for_chat(chat_identifier: str, user_message: str, username: str = None, user_id: int = None) -> str:
+async def send_message_and_get_response_for_chat(chat_identifier: str, user_message: str, username: str = None, user_id: int = None,
+                                                 before_run: Optional[Callable[[], Awaitable]] = None) -> str:
     """
     Dual-mode version of send_message_and_get_response that works with chat identifiers.
     
@@ -284,37 +741,30 @@ async def send_message_and_get_response_for_chat(chat_identifier: str, user_mess
         user_message: Message text from user
         username: Username for analytics
         user_id: User ID for analytics (required for group chats)
+        before_run: Awaited after the message is posted and before the run starts
     
     Returns:
         str: Assistant response
     """
-    thread_id = get_thread_id_for_chat(chat_identifier)
-    if not thread_id:
-        thread_id = await create_thread()
-        set_thread_id_for_chat(chat_identifier, thread_id)
+    with trace_span("prepare"):
+        thread_id = get_thread_id_for_chat(chat_identifier)
+        if not thread_id:
+            thread_id = await create_thread()
+            set_thread_id_for_chat(chat_identifier, thread_id)
 
-    # Добавляем сообщение пользователя
-    await client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=user_message
-    )
+        # Добавляем сообщение пользователя
+        user_message_id = (await _add_user_message(thread_id, user_message)).id
 
-    # Запускаем выполнение
-    run = await client.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=ASSISTANT_ID,
-    )
+    if before_run is not None:
+        await before_run()
 
-    # Ожидаем завершения
-    while True:
-        run_status = await client.beta.threads.runs.retrieve(
-            thread_id=thread_id,
-            run_id=run.id
-        )
-        if run_status.status in ["completed", "failed", "cancelled"]:
-            break
-        await asyncio.sleep(1)
+    # Запускаем выполнение и ожидаем завершения
+    try:
+        run, run_status = await _run_assistant(thread_id, user_message_id)
+    except AdmissionRejected:
+        return BUSY_REPLY
+    except RunInterrupted as interrupted:
+        return interrupted.reply
 
     # Проверка статуса выполнения
     if run_status.status == "failed":
@@ -330,25 +780,10 @@ async def send_message_and_get_response_for_chat(chat_identifier: str, user_mess
         return "❌ Запрос требует дополнительных действий, которые не поддерживаются."
 
     # Записываем использование токенов в аналитику
-    tokens_used = 0
-    if run_status.usage and run_status.usage.total_tokens:
-        tokens_used = run_status.usage.total_tokens
-        logger.debug(f"[OpenAI] Tokens used for {chat_identifier}: {tokens_used} (prompt: {run_status.usage.prompt_tokens}, completion: {run_status.usage.completion_tokens})")
-    
-    # Записываем в аналитику (используем user_id если доступен, иначе извлекаем из chat_identifier)
-    if tokens_used > 0:
-        try:
-            analytics_user_id = user_id
-            if not analytics_user_id and chat_identifier.startswith("user:"):
-                analytics_user_id = int(chat_identifier.split(":")[1])
-            
-            if analytics_user_id:
-                await analytics.record_usage(analytics_user_id, username, tokens_used)
-        except Exception as e:
-            logger.error(f"Failed to record usage analytics for {chat_identifier}: {e}")
+    await _record_run_usage(run_status, user_id, username, chat_identifier, REQUEST_KIND_TEXT)
 
     # Получаем только новые сообщения
-    messages = await client.beta.threads.messages.list(thread_id=thread_id)
+    messages = await _list_messages(thread_id)
     
     # Логирование для диагностики (БЕЗ содержимого сообщений!)
     logger.debug(f"[OpenAI] Retrieved {len(messages.data)} messages for {chat_identifier}")
@@ -382,7 +817,7 @@ async def get_message_history(user_id: int, limit: int = 10) -> str:
         return "История пуста. Вы ещё не начинали диалог."
 
     try:
-        messages = await client.beta.threads.messages.list(thread_id=thread_id, limit=limit)
+        messages = await _list_messages(thread_id, limit=limit)
         history = []
         for message in reversed(messages.data):  # от старых к новым
             role = "🤖" if message.role == "assistant" else "🧑"
@@ -399,7 +834,7 @@ async def export_message_history(user_id: int, limit: int = 50) -> str | None:
         return None
 
     try:
-        messages = await client.beta.threads.messages.list(thread_id=thread_id, limit=limit)
+        messages = await _list_messages(thread_id, limit=limit)
         history = []
         for message in reversed(messages.data):
             role = "Assistant" if message.role == "assistant" else "User"
@@ -426,11 +861,7 @@ async def send_image_and_get_response(user_id: int, image_path: str, caption: st
 
     try:
         # Upload image file to OpenAI with purpose="vision"
-        with open(image_path, "rb") as image_file:
-            uploaded_file = await client.files.create(
-                file=image_file,
-                purpose="vision"
-            )
+        uploaded_file = await _upload_file(image_path, "vision", f"user:{user_id}")
         
         # Save file_id in Redis for tracking
         add_user_image(user_id, uploaded_file.id)
@@ -460,27 +891,10 @@ async def send_image_and_get_response(user_id: int, image_path: str, caption: st
             })
 
         # Add message to thread
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=message_content
-        )
-
-        # Run assistant
-        run = await client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=ASSISTANT_ID,
-        )
+        user_message_id = (await _add_user_message(thread_id, message_content)).id
 
-        # Wait for completion
-        while True:
-            run_status = await client.beta.threads.runs.retrieve(
-                thread_id=thread_id,
-                run_id=run.id
-            )
-            if run_status.status in ["completed", "failed", "cancelled"]:
-                break
-            await asyncio.sleep(1)
+        # Run assistant and wait for completion
+        run, run_status = await _run_assistant(thread_id, user_message_id)
 
         # Check for errors
         if run_status.status == "failed":
@@ -496,20 +910,10 @@ async def send_image_and_get_response(user_id: int, image_path: str, caption: st
             return "❌ Запрос требует дополнительных действий, которые не поддерживаются."
 
         # Record token usage
-        tokens_used = 0
-        if run_status.usage and run_status.usage.total_tokens:
-            tokens_used = run_status.usage.total_tokens
-            logger.debug(f"[OpenAI] Image processing tokens used: {tokens_used}")
-        
-        # Record analytics
-        if tokens_used > 0:
-            try:
-                await analytics.record_usage(user_id, username, tokens_used)
-            except Exception as e:
-                logger.error(f"Failed to record usage analytics: {e}")
+        await _record_run_usage(run_status, user_id, username, f"user:{user_id}", REQUEST_KIND_IMAGE)
 
         # Get response
-        messages = await client.beta.threads.messages.list(thread_id=thread_id)
+        messages = await _list_messages(thread_id)
 
         for message in reversed(messages.data):
             if (
@@ -526,6 +930,10 @@ async def send_image_and_get_response(user_id: int, image_path: str, caption: st
 
         return "Ошибка: не удалось получить ответ на изображение."
 
+    except AdmissionRejected:
+        return BUSY_REPLY
+    except RunInterrupted as interrupted:
+        return interrupted.reply
     except Exception as e:
         logger.error(f"Error processing image for user {user_id}: {e}")
         return "❌ Произошла ошибка при анализе изображения. Попробуйте еще раз."
@@ -552,11 +960,7 @@ async def send_image_and_get_response_for_chat(chat_identifier: str, image_path:
 
     try:
         # Upload image file to OpenAI with purpose="vision"
-        with open(image_path, "rb") as image_file:
-            uploaded_file = await client.files.create(
-                file=image_file,
-                purpose="vision"
-            )
+        uploaded_file = await _upload_file(image_path, "vision", chat_identifier)
         
         # Save file_id in Redis for tracking
         add_chat_image(chat_identifier, uploaded_file.id)
@@ -586,27 +990,10 @@ async def send_image_and_get_response_for_chat(chat_identifier: str, image_path:
             })
 
         # Add message to thread
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=message_content
-        )
+        user_message_id = (await _add_user_message(thread_id, message_content)).id
 
-        # Run assistant
-        run = await client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=ASSISTANT_ID,
-        )
-
-        # Wait for completion
-        while True:
-            run_status = await client.beta.threads.runs.retrieve(
-                thread_id=thread_id,
-                run_id=run.id
-            )
-            if run_status.status in ["completed", "failed", "cancelled"]:
-                break
-            await asyncio.sleep(1)
+        # Run assistant and wait for completion
+        run, run_status = await _run_assistant(thread_id, user_message_id)
 
         # Check for errors
         if run_status.status == "failed":
@@ -622,25 +1009,10 @@ async def send_image_and_get_response_for_chat(chat_identifier: str, image_path:
             return "❌ Запрос требует дополнительных действий, которые не поддерживаются."
 
         # Record token usage
-        tokens_used = 0
-        if run_status.usage and run_status.usage.total_tokens:
-            tokens_used = run_status.usage.total_tokens
-            logger.debug(f"[OpenAI] Image processing tokens used for {chat_identifier}: {tokens_used}")
-        
-        # Record analytics (using user_id if available)
-        if tokens_used > 0:
-            try:
-                analytics_user_id = user_id
-                if not analytics_user_id and chat_identifier.startswith("user:"):
-                    analytics_user_id = int(chat_identifier.split(":")[1])
-                
-                if analytics_user_id:
-                    await analytics.record_usage(analytics_user_id, username, tokens_used)
-            except Exception as e:
-                logger.error(f"Failed to record usage analytics for {chat_identifier}: {e}")
+        await _record_run_usage(run_status, user_id, username, chat_identifier, REQUEST_KIND_IMAGE)
 
         # Get response
-        messages = await client.beta.threads.messages.list(thread_id=thread_id)
+        messages = await _list_messages(thread_id)
 
         for message in reversed(messages.data):
             if (
@@ -657,6 +1029,10 @@ async def send_image_and_get_response_for_chat(chat_identifier: str, image_path:
 
         return "Ошибка: не удалось получить ответ на изображение."
 
+    except AdmissionRejected:
+        return BUSY_REPLY
+    except RunInterrupted as interrupted:
+        return interrupted.reply
     except Exception as e:
         logger.error(f"Error processing image for {chat_identifier}: {e}")
         return "❌ Произошла ошибка при анализе изображения. Попробуйте еще раз."
@@ -671,11 +1047,7 @@ async def send_document_and_get_response(user_id: int, local_file_path: str, use
 
     try:
         # Upload document file to OpenAI with purpose="assistants"
-        with open(local_file_path, "rb") as document_file:
-            uploaded_file = await client.files.create(
-                file=document_file,
-                purpose="assistants"
-            )
+        uploaded_file = await _upload_file(local_file_path, "assistants", f"user:{user_id}")
         
         # Track file for cleanup - use separate function for documents
         add_user_document(user_id, uploaded_file.id, original_filename)
@@ -689,10 +1061,9 @@ async def send_document_and_get_response(user_id: int, local_file_path: str, use
             message_text = f"Please analyze the attached document '{original_filename}' and provide a comprehensive summary of its content, key points, and main topics."
 
         # Add message to thread
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=message_text,
+        posted_message = await _add_user_message(
+            thread_id,
+            message_text,
             attachments=[
                 {
                     "file_id": uploaded_file.id,
@@ -701,21 +1072,8 @@ async def send_document_and_get_response(user_id: int, local_file_path: str, use
             ]
         )
 
-        # Run assistant
-        run = await client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=ASSISTANT_ID,
-        )
-
-        # Wait for completion
-        while True:
-            run_status = await client.beta.threads.runs.retrieve(
-                thread_id=thread_id,
-                run_id=run.id
-            )
-            if run_status.status in ["completed", "failed", "cancelled"]:
-                break
-            await asyncio.sleep(1)
+        # Run assistant and wait for completion
+        run, run_status = await _run_assistant(thread_id, posted_message.id)
 
         # Check for errors
         if run_status.status == "failed":
@@ -731,20 +1089,10 @@ async def send_document_and_get_response(user_id: int, local_file_path: str, use
             return "❌ Запрос требует дополнительных действий, которые не поддерживаются."
 
         # Record token usage
-        tokens_used = 0
-        if run_status.usage and run_status.usage.total_tokens:
-            tokens_used = run_status.usage.total_tokens
-            logger.debug(f"[OpenAI] Document processing tokens used: {tokens_used}")
-        
-        # Record analytics
-        if tokens_used > 0:
-            try:
-                await analytics.record_usage(user_id, username, tokens_used)
-            except Exception as e:
-                logger.error(f"Failed to record usage analytics: {e}")
+        await _record_run_usage(run_status, user_id, username, f"user:{user_id}", REQUEST_KIND_DOCUMENT)
 
         # Get response
-        messages = await client.beta.threads.messages.list(thread_id=thread_id)
+        messages = await _list_messages(thread_id)
 
         for message in reversed(messages.data):
             if (
@@ -761,6 +1109,10 @@ async def send_document_and_get_response(user_id: int, local_file_path: str, use
 
         return "Ошибка: не удалось получить ответ при анализе документа."
 
+    except AdmissionRejected:
+        return BUSY_REPLY
+    except RunInterrupted as interrupted:
+        return interrupted.reply
     except Exception as document_processing_error:
         logger.error(f"Error processing document for user {user_id}: {document_processing_error}")
         return "❌ Ошибка при анализе документа. Попробуйте еще раз."
@@ -802,16 +1154,28 @@ async def generate_image_dalle(prompt: str, user_id: int, username: str = None,
     try:
         logger.info(f"[DALL-E] Starting image generation for user {user_id}")
         
-        response = await client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            n=1,
-            size=size,
-            quality="standard",
-            style="vivid"
-        )
+        trace = get_request_trace()
+        async with image_queue.slot(_current_tenant(f"user:{user_id}")):
+            if trace:
+                trace.mark_run_started()
+            generation_started_at = time.monotonic()
+            
+            response = await call_openai(
+                "images.generate",
+                lambda: client.images.generate(
+                    model="dall-e-3",
+                    prompt=prompt,
+                    n=1,
+                    size=size,
+                    quality="standard",
+                    style="vivid"
+                )
+            )
         
         image_url = response.data[0].url
+        generation_ms = int((time.monotonic() - generation_started_at) * 1000)
+        if trace:
+            trace.mark_run_finished()
         
         # Get equivalent tokens from analytics module
         from user_analytics import DALLE_TOKEN_EQUIVALENT
@@ -823,13 +1187,19 @@ async def generate_image_dalle(prompt: str, user_id: int, username: str = None,
         # Record analytics using enhanced method
         if username:
             try:
-                await analytics.record_image_generation(user_id, username, size)
+                if trace:
+                    # Written together with the Telegram send time once the image is delivered
+                    trace.set_usage(equivalent_tokens, model="dall-e-3")
+                else:
+                    await analytics.record_image_generation(user_id, username, size, run_ms=generation_ms)
                 logger.debug(f"[DALL-E] Recorded analytics: {equivalent_tokens} tokens for user {user_id}")
             except Exception as e:
                 logger.error(f"Failed to record image generation analytics: {e}")
         
         return image_url, equivalent_tokens
         
+    except AdmissionRejected:
+        raise Exception("Too many image requests right now. Please try again in a minute")
     except openai.APIConnectionError as e:
         logger.error(f"[DALL-E] Connection error for user {user_id}: {e}")
         raise Exception("Connection to OpenAI failed")
@@ -0,0 +1,177 @@
+"""
+Rate-Limit-Aware Adaptive Concurrency for OpenAI Calls
+
+OpenAI responses carry x-ratelimit-* headers with the remaining request and
+token budget of the current window. A response hook on the shared httpx client
+feeds them into one AIMD controller per call kind (assistant runs, file uploads,
+image generation), and each controller resizes its fair queue: the limit is
+halved as soon as the remaining budget drops below the configured headroom or a
+429 arrives, and grows back by about one slot per window of successful calls.
+Only calls that start the admitted work (run creation, file upload, image
+generation) count toward growth: run polls and message reads are many per run
+and would undo a decrease within seconds, so they can only lower the limit.
+"""
+
+import time
+from typing import Callable, Optional
+import httpx
+from fair_queue import FairQueue
+from logger import logger
+
+# Kinds of OpenAI calls with their own concurrency limit
+CALL_KIND_RUNS = "runs"
+CALL_KIND_UPLOADS = "uploads"
+CALL_KIND_IMAGES = "images"
+
+# (limit header, remaining header) pairs reported by the API
+RATE_LIMIT_HEADERS = (
+    ("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests"),
+    ("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens"),
+)
+
+
+def call_kind(path: str) -> str:
+    """
+    Maps an API request path to the kind of call it belongs to.
+
+    Thread, message and run endpoints all share the Assistants limits, so
+    everything that is not a file upload or image generation counts as runs.
+    """
+    if "/images/" in path:
+        return CALL_KIND_IMAGES
+    if path.rstrip("/").endswith("/files"):
+        return CALL_KIND_UPLOADS
+    return CALL_KIND_RUNS
+
+
+def starts_work(method: str, path: str) -> bool:
+    """Whether a request starts the work its queue admits: POST of a run, file or image"""
+    if method != "POST":
+        return False
+    return call_kind(path) != CALL_KIND_RUNS or path.rstrip("/").endswith("/runs")
+
+
+def remaining_fraction(headers) -> Optional[float]:
+    """
+    Smallest remaining share of the request and token budgets.
+
+    Returns:
+        Optional[float]: Value in [0, 1], or None if the response has no rate-limit headers
+    """
+    fractions = []
+    for limit_header, remaining_header in RATE_LIMIT_HEADERS:
+        try:
+            limit = int(headers[limit_header])
+            remaining = int(headers[remaining_header])
+        except (KeyError, ValueError):
+            continue
+        if limit > 0:
+            fractions.append(max(0, remaining) / limit)
+    return min(fractions) if fractions else None
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller of a fair queue's concurrency.
+
+    The configured concurrency of the queue is the ceiling. One decrease is
+    applied per cooldown period, so a burst of low-budget responses from calls
+    that were already in flight counts as a single signal.
+    """
+
+    def __init__(self, queue: FairQueue, min_limit: int = 1, headroom: float = 0.1,
+                 decrease_factor: float = 0.5, cooldown: float = 2.0):
+        """
+        Args:
+            queue: Queue whose concurrency is adjusted
+            min_limit: Lowest concurrency the controller may set
+            headroom: Remaining budget share below which concurrency is reduced
+            decrease_factor: Multiplier applied on each decrease
+            cooldown: Minimum interval between decreases, seconds
+        """
+        self.queue = queue
+        self.max_limit = queue.concurrency
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.headroom = headroom
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.limit = float(self.max_limit)
+        self.decreases = 0
+        self.last_remaining: Optional[float] = None
+        self._last_decrease_at = 0.0
+
+    def on_response(self, status_code: int, headers, starts_work: bool = True) -> None:
+        """
+        Updates the limit from one API response.
+
+        Args:
+            status_code: HTTP status of the response
+            headers: Response headers
+            starts_work: The request started admitted work; only such responses increase the limit
+        """
+        if status_code == 429:
+            self._decrease("429 Too Many Requests")
+            return
+
+        remaining = remaining_fraction(headers)
+        if remaining is not None:
+            self.last_remaining = remaining
+        if remaining is not None and remaining < self.headroom:
+            self._decrease(f"{remaining:.0%} of rate limit left")
+        elif status_code < 400 and starts_work:
+            self._increase()
+
+    def _decrease(self, reason: str) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease_at < self.cooldown:
+            return
+        self._last_decrease_at = now
+        self.decreases += 1
+        self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+        self._apply(reason)
+
+    def _increase(self) -> None:
+        if self.limit >= self.max_limit:
+            return
+        # Roughly +1 slot after `limit` successful calls that started work
+        self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+        self._apply("rate limit recovered")
+
+    def _apply(self, reason: str) -> None:
+        target = max(self.min_limit, int(self.limit))
+        if target != self.queue.concurrency:
+            logger.info(f"[OpenAILimits] {self.queue.name}: concurrency {self.queue.concurrency} -> {target} ({reason})")
+            self.queue.set_concurrency(target)
+
+    def get_stats(self) -> dict:
+        """Current limit and the last observed rate-limit budget"""
+        return {
+            "limit": self.queue.concurrency,
+            "max_limit": self.max_limit,
+            "decreases": self.decreases,
+            "remaining": self.last_remaining,
+        }
+
+
+def rate_limit_hook(controllers: dict) -> Callable:
+    """
+    Builds an httpx response hook that feeds rate-limit headers to the controllers.
+
+    Args:
+        controllers: Call kind -> AdaptiveConcurrency
+
+    Returns:
+        Callable: Async hook for httpx.AsyncClient(event_hooks={"response": [...]})
+    """
+    async def on_response(response: httpx.Response) -> None:
+        path = response.request.url.path
+        controller = controllers.get(call_kind(path))
+        if controller is None:
+            return
+        try:
+            controller.on_response(response.status_code, response.headers,
+                                   starts_work(response.request.method, path))
+        except Exception as e:
+            logger.warning(f"[OpenAILimits] Failed to process rate-limit headers: {e}")
+
+    return on_response
@@ -0,0 +1,216 @@
+"""
+Retry Policy for OpenAI Operations
+
+Every OpenAI call in openai_handler goes through call_openai(), which retries
+transient failures (connection errors, 408/409/429 and 5xx) with exponential
+backoff and full jitter. Whether a failed call may be repeated depends on the
+operation:
+
+- IDEMPOTENT operations (reads, and creates whose duplicate is harmless) are
+  retried on any transient failure;
+- VERIFY operations (messages.create, runs.create) are retried only after a
+  recovery check confirms the failed attempt did not take effect - otherwise
+  the result of that attempt is returned;
+- NOT_IDEMPOTENT operations (images.generate, billed per call) are retried
+  only when the request certainly never reached the API.
+
+Within a user request the total time is bounded by OPENAI_REQUEST_BUDGET
+counted from the start of its trace: a retry that cannot start before the
+budget runs out is not attempted. The SDK's own retries are disabled so this
+is the only retry layer.
+"""
+
+import asyncio
+import random
+import time
+from enum import Enum
+from typing import Awaitable, Callable, Optional
+import httpx
+import openai
+from config import OPENAI_RETRY_ATTEMPTS, OPENAI_RETRY_BASE_DELAY, OPENAI_RETRY_MAX_DELAY, OPENAI_REQUEST_BUDGET
+from logger import logger
+from user_analytics import get_request_trace
+
+# Status codes worth retrying: request timeout, lock conflict, rate limit, server errors
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+
+
+class Idempotency(Enum):
+    """How safe it is to repeat an operation whose outcome is unknown"""
+    IDEMPOTENT = "idempotent"
+    VERIFY = "verify"
+    NOT_IDEMPOTENT = "not_idempotent"
+
+
+OPERATION_RULES = {
+    "threads.create": Idempotency.IDEMPOTENT,   # A duplicate thread is simply never used
+    "messages.list": Idempotency.IDEMPOTENT,
+    "messages.create": Idempotency.VERIFY,      # A duplicate would repeat the user's message
+    "messages.delete": Idempotency.IDEMPOTENT,
+    "runs.create": Idempotency.VERIFY,          # A duplicate would answer twice
+    "runs.retrieve": Idempotency.IDEMPOTENT,
+    "runs.list": Idempotency.IDEMPOTENT,
+    "runs.cancel": Idempotency.IDEMPOTENT,
+    "files.create": Idempotency.IDEMPOTENT,     # A duplicate upload only leaves an unreferenced file
+    "files.delete": Idempotency.IDEMPOTENT,
+    "images.generate": Idempotency.NOT_IDEMPOTENT,
+}
+
+
+class _OperationStats:
+    """Retry counters of one operation"""
+
+    __slots__ = ("calls", "retries", "recovered", "failed", "budget_exhausted")
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.recovered = 0
+        self.failed = 0
+        self.budget_exhausted = 0
+
+
+_stats: dict[str, _OperationStats] = {}
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether the error is worth retrying"""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def was_not_applied(error: Exception) -> bool:
+    """Whether the failed request certainly had no effect on the OpenAI side"""
+    if isinstance(error, openai.APIConnectionError):
+        return isinstance(error.__cause__, (httpx.ConnectError, httpx.ConnectTimeout))
+    return isinstance(error, openai.RateLimitError)
+
+
+def budget_left() -> Optional[float]:
+    """Seconds left of the current user request's budget, or None outside of a request"""
+    trace = get_request_trace()
+    if trace is None or OPENAI_REQUEST_BUDGET <= 0:
+        return None
+    return trace.started_at + OPENAI_REQUEST_BUDGET - time.monotonic()
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Delay requested by the server, seconds"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        if "retry-after" in response.headers:
+            return float(response.headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def backoff_delay(retry_number: int, error: Exception) -> float:
+    """
+    Exponential backoff with full jitter, or the server's Retry-After if longer.
+
+    Args:
+        retry_number: 1 for the first retry, 2 for the second, ...
+        error: Error of the failed attempt
+    """
+    ceiling = min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** (retry_number - 1))
+    delay = random.uniform(0, ceiling)
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, OPENAI_RETRY_MAX_DELAY))
+    return delay
+
+
+async def call_openai(operation: str, call: Callable[[], Awaitable],
+                      recover: Optional[Callable[[float], Awaitable]] = None):
+    """
+    Runs an OpenAI operation under the retry policy.
+
+    Args:
+        operation: Operation name from OPERATION_RULES, e.g. "runs.create"
+        call: Performs one attempt
+        recover: For VERIFY operations - takes the attempt's start time (Unix seconds)
+            and returns the attempt's result if it did take effect, otherwise None
+
+    Returns:
+        Result of the successful (or recovered) attempt
+
+    Raises:
+        The last error when it is not transient, retries are exhausted or the budget is spent
+    """
+    rule = OPERATION_RULES.get(operation, Idempotency.NOT_IDEMPOTENT)
+    stats = _stats.setdefault(operation, _OperationStats())
+    stats.calls += 1
+    retry_number = 0
+
+    while True:
+        attempt_started = time.time()
+        try:
+            return await call()
+        except Exception as error:
+            if not is_transient(error):
+                raise
+
+            if not was_not_applied(error):
+                if rule is Idempotency.NOT_IDEMPOTENT:
+                    stats.failed += 1
+                    raise
+                if rule is Idempotency.VERIFY:
+                    if recover is None:
+                        stats.failed += 1
+                        raise
+                    try:
+                        result = await recover(attempt_started)
+                    except Exception as recover_error:
+                        logger.warning(f"[OpenAIRetry] {operation}: recovery check failed: {recover_error}")
+                        stats.failed += 1
+                        raise error
+                    if result is not None:
+                        stats.recovered += 1
+                        logger.info(f"[OpenAIRetry] {operation}: failed attempt had taken effect, using its result")
+                        return result
+
+            retry_number += 1
+            if retry_number >= OPENAI_RETRY_ATTEMPTS:
+                stats.failed += 1
+                logger.error(f"[OpenAIRetry] {operation}: giving up after {retry_number} attempts: {error}")
+                raise
+
+            delay = backoff_delay(retry_number, error)
+            remaining = budget_left()
+            if remaining is not None and remaining <= delay:
+                stats.budget_exhausted += 1
+                stats.failed += 1
+                logger.error(f"[OpenAIRetry] {operation}: request budget exhausted, not retrying: {error}")
+                raise
+
+            stats.retries += 1
+            logger.warning(f"[OpenAIRetry] {operation}: attempt {retry_number} failed ({error}), "
+                           f"retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+def get_retry_stats() -> dict:
+    """
+    Retry counters per operation.
+
+    Returns:
+        dict: Operation -> {calls, retries, recovered, failed, budget_exhausted}
+    """
+    return {
+        operation: {
+            "calls": stats.calls,
+            "retries": stats.retries,
+            "recovered": stats.recovered,
+            "failed": stats.failed,
+            "budget_exhausted": stats.budget_exhausted,
+        }
+        for operation, stats in sorted(_stats.items())
+    }
@@ -0,0 +1,126 @@
+"""
+Незавершенные запуски ассистента.
+
+Запуск сохраняется в Redis вместе с сообщением-заглушкой ("обрабатывается..."),
+пока ответ не доставлен; после перезапуска или падения бота ответ дописывается
+в исходную заглушку.
+"""
+
+from contextvars import ContextVar
+from typing import Optional
+from logger import logger
+import redis
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+
+PENDING_RUN_PREFIX = "pending_run:"
+PENDING_RUNS_INDEX = "pending_runs"
+
+# OpenAI завершает запуск не позже чем через 10 минут; запись живет с запасом
+PENDING_RUN_TTL = 3600
+
+# Сообщение-заглушка текущего запроса: (chat_id, message_id)
+_reply_placeholder: ContextVar[Optional[tuple]] = ContextVar("reply_placeholder", default=None)
+
+
+def _run_key(run_id: str) -> str:
+    """Ключ записи о запуске"""
+    return f"{PENDING_RUN_PREFIX}{run_id}"
+
+
+def set_reply_placeholder(chat_id: int, message_id: int) -> None:
+    """
+    Запоминает сообщение-заглушку, в которое будет доставлен ответ текущего запроса.
+    Вызывается обработчиком сразу после отправки заглушки.
+    """
+    _reply_placeholder.set((chat_id, message_id))
+
+
+def get_reply_placeholder() -> Optional[tuple]:
+    """Возвращает (chat_id, message_id) заглушки текущего запроса, если она есть"""
+    return _reply_placeholder.get()
+
+
+def save_pending_run(run_id: str, thread_id: str, chat_id: int, message_id: int,
+                     chat_identifier: str = None, user_id: int = None, username: str = None,
+                     request_kind: str = None) -> bool:
+    """
+    Сохраняет запуск, ответ на который еще не доставлен.
+
+    Args:
+        run_id: ID запуска ассистента
+        thread_id: ID треда OpenAI
+        chat_id: Чат сообщения-заглушки
+        message_id: ID сообщения-заглушки
+        chat_identifier: "user:ID" / "chat:ID" для учета токенов
+        user_id: ID пользователя для учета токенов
+        username: Имя пользователя для аналитики
+        request_kind: Тип запроса (text/image/document)
+
+    Returns:
+        bool: True, если запись сохранена
+    """
+    record = {
+        "run_id": run_id,
+        "thread_id": thread_id,
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "chat_identifier": chat_identifier or "",
+        "user_id": user_id if user_id is not None else "",
+        "username": username or "",
+        "request_kind": request_kind or "",
+    }
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(_run_key(run_id), mapping=record)
+        pipe.expire(_run_key(run_id), PENDING_RUN_TTL)
+        pipe.sadd(PENDING_RUNS_INDEX, run_id)
+        pipe.execute()
+        return True
+    except Exception as e:
+        logger.warning(f"[PendingRuns] Failed to save run {run_id}: {e}")
+        return False
+
+
+def remove_pending_run(run_id: str) -> None:
+    """Удаляет запись о запуске после доставки ответа (или отмены)"""
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(_run_key(run_id))
+        pipe.srem(PENDING_RUNS_INDEX, run_id)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"[PendingRuns] Failed to remove run {run_id}: {e}")
+
+
+def load_pending_runs() -> list[dict]:
+    """
+    Возвращает все сохраненные незавершенные запуски.
+    Устаревшие ссылки индекса (запись истекла по TTL) удаляются.
+
+    Returns:
+        list[dict]: Записи с полями как в save_pending_run
+    """
+    try:
+        run_ids = redis_client.smembers(PENDING_RUNS_INDEX)
+        if not run_ids:
+            return []
+        pipe = redis_client.pipeline(transaction=False)
+        for run_id in run_ids:
+            pipe.hgetall(_run_key(run_id))
+        records = pipe.execute()
+    except Exception as e:
+        logger.error(f"[PendingRuns] Failed to load pending runs: {e}")
+        return []
+
+    pending = []
+    for run_id, record in zip(run_ids, records):
+        if not record:
+            remove_pending_run(run_id)
+            continue
+        record["chat_id"] = int(record["chat_id"])
+        record["message_id"] = int(record["message_id"])
+        record["user_id"] = int(record["user_id"]) if record.get("user_id") else None
+        pending.append(record)
+    return pending
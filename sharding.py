@@ -0,0 +1,243 @@
+"""
+Multi-Process Sharding of Updates by Chat
+
+A front process receives updates (polling or webhook, as configured by
+BOT_MODE) and routes each one to one of N worker processes by a consistent
+hash of its chat identifier. Every worker runs the regular bot handlers, so
+all cores are used while updates of one chat always reach the same worker in
+order. Shared state (sessions, caches, quotas) already lives in Redis.
+"""
+
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import queue
+import signal
+from typing import Optional
+from telegram import Update
+from config import OPENAI_SHUTDOWN_GRACE, SHARD_QUEUE_SIZE
+from logger import logger
+from update_processor import get_ordering_key
+
+# Worker shutdown marker sent through the shard queue
+STOP_SENTINEL = None
+
+# How long the front waits for a worker to finish its queue on shutdown, seconds
+WORKER_JOIN_TIMEOUT = 30
+
+
+def _key_hash(key: str) -> int:
+    """Stable 64-bit hash of a routing key (identical across processes and restarts)"""
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def jump_consistent_hash(key: int, num_buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping & Veach): maps a 64-bit key to a bucket so that
+    changing the number of buckets from N to N+1 moves only ~1/(N+1) of the keys.
+
+    Args:
+        key: 64-bit integer key
+        num_buckets: Number of buckets
+
+    Returns:
+        int: Bucket index in range [0, num_buckets)
+    """
+    bucket, candidate = -1, 0
+    while candidate < num_buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_for_update(update: object, num_shards: int) -> int:
+    """
+    Chooses the worker for an update by its chat identifier.
+
+    Args:
+        update: Update received by the front process
+        num_shards: Number of worker processes
+
+    Returns:
+        int: Worker index
+    """
+    key = get_ordering_key(update)
+    if key is None:
+        # No ordering requirement - spread by update_id
+        key = f"update:{getattr(update, 'update_id', id(update))}"
+    return jump_consistent_hash(_key_hash(key), num_shards)
+
+
+def _worker_entry(shard_index: int, shard_queue) -> None:
+    """Worker process entry point"""
+    # Ctrl+C goes to the whole process group; the front stops workers with a sentinel
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(shard_index, shard_queue))
+
+
+async def _run_worker(shard_index: int, shard_queue) -> None:
+    """Runs the bot handlers on updates taken from the shard queue"""
+    import main as bot
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+
+    app = bot.build_application()
+    # Background jobs (cache warmup, quota reconcile, retention) run in one worker only
+    await bot.setup_handlers(app, maintenance_jobs=shard_index == 0)
+    await app.initialize()
+    await app.start()
+    logger.info(f"[Shard {shard_index}] Worker started")
+
+    try:
+        while True:
+            try:
+                # Short timeout so SIGTERM is noticed; after it, drain what is already queued
+                data = await loop.run_in_executor(None, shard_queue.get, True, 1.0)
+            except queue.Empty:
+                if stop_event.is_set():
+                    break
+                continue
+
+            if data is STOP_SENTINEL:
+                break
+
+            try:
+                update = Update.de_json(json.loads(data), app.bot)
+            except Exception as decode_error:
+                logger.error(f"[Shard {shard_index}] Failed to decode update: {decode_error}")
+                continue
+            await app.update_queue.put(update)
+    finally:
+        logger.info(f"[Shard {shard_index}] Worker stopping")
+        await bot.shutdown_active_runs(OPENAI_SHUTDOWN_GRACE)
+        # stop() waits until updates already handed to the application are processed
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await bot.close_analytics()
+        logger.info(f"[Shard {shard_index}] Worker stopped")
+
+
+async def _run_front(num_workers: int) -> None:
+    """Receives updates and routes them to worker processes"""
+    import main as bot
+
+    # Schema migrations run once here, not concurrently in every worker
+    await bot.analytics.init_database()
+    await bot.close_analytics()
+
+    context = multiprocessing.get_context("spawn")
+    shard_queues = [context.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(num_workers)]
+    workers: list[Optional[multiprocessing.Process]] = [None] * num_workers
+
+    def start_worker(shard_index: int) -> None:
+        process = context.Process(
+            target=_worker_entry,
+            args=(shard_index, shard_queues[shard_index]),
+            name=f"bot-worker-{shard_index}"
+        )
+        process.start()
+        workers[shard_index] = process
+        logger.info(f"[Sharding] Worker {shard_index} started (pid {process.pid})")
+
+    for shard_index in range(num_workers):
+        start_worker(shard_index)
+
+    # The front only receives updates: no handlers, and app.start() is not called,
+    # so the application's own update fetcher does not compete for update_queue
+    app = bot.build_application(concurrent=False)
+    await app.initialize()
+    await bot.start_receiving_updates(app)
+    logger.info(f"[Sharding] Front started: routing updates to {num_workers} workers")
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop_event.set)
+
+    async def route_updates():
+        # A single sequential router keeps per-chat order into each shard queue
+        while True:
+            update = await app.update_queue.get()
+            try:
+                if not isinstance(update, Update):
+                    continue
+                shard_queue = shard_queues[shard_for_update(update, num_workers)]
+                data = update.to_json()
+                try:
+                    shard_queue.put_nowait(data)
+                except queue.Full:
+                    # Worker is behind - apply backpressure without blocking the event loop;
+                    # short puts so cancelling the router never leaves a thread blocked
+                    while True:
+                        try:
+                            await asyncio.to_thread(shard_queue.put, data, True, 1.0)
+                            break
+                        except queue.Full:
+                            continue
+            except Exception as route_error:
+                logger.error(f"[Sharding] Failed to route update: {route_error}")
+            finally:
+                app.update_queue.task_done()
+
+    async def supervise_workers():
+        while True:
+            await asyncio.sleep(1)
+            for shard_index, process in enumerate(workers):
+                if process is not None and not process.is_alive():
+                    logger.error(f"[Sharding] Worker {shard_index} exited with code {process.exitcode}, restarting")
+                    start_worker(shard_index)
+
+    router_task = asyncio.create_task(route_updates())
+    supervisor_task = asyncio.create_task(supervise_workers())
+
+    try:
+        await stop_event.wait()
+        logger.info("[Sharding] Stop signal received")
+    finally:
+        if app.updater.running:
+            await app.updater.stop()
+        # Route updates already received before stopping the workers; the supervisor keeps
+        # restarting dead workers meanwhile, so a full queue of a crashed one is drained
+        try:
+            await asyncio.wait_for(app.update_queue.join(), WORKER_JOIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"[Sharding] {app.update_queue.qsize()} received updates not routed before shutdown")
+        supervisor_task.cancel()
+        router_task.cancel()
+        await asyncio.gather(router_task, supervisor_task, return_exceptions=True)
+
+        for shard_index, shard_queue in enumerate(shard_queues):
+            if not workers[shard_index].is_alive():
+                # Nobody reads this queue: do not let its feeder thread hold up exit
+                shard_queue.cancel_join_thread()
+                continue
+            try:
+                await asyncio.to_thread(shard_queue.put, STOP_SENTINEL, True, WORKER_JOIN_TIMEOUT)
+            except queue.Full:
+                # The worker is stuck; it is terminated after the join timeout below
+                logger.warning(f"[Sharding] Worker {shard_index} queue is full, cannot send stop marker")
+                shard_queue.cancel_join_thread()
+        for shard_index, process in enumerate(workers):
+            await asyncio.to_thread(process.join, WORKER_JOIN_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"[Sharding] Worker {shard_index} did not stop in time, terminating")
+                process.terminate()
+
+        await app.shutdown()
+        logger.info("[Sharding] Front stopped")
+
+
+def run_sharded(num_workers: int) -> None:
+    """
+    Starts the multi-process mode: one front process and num_workers workers.
+
+    Args:
+        num_workers: Number of worker processes
+    """
+    logger.info(f"🚀 Запускаем Telegram бота в многопроцессном режиме ({num_workers} воркеров)...")
+    asyncio.run(_run_front(num_workers))
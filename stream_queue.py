@@ -0,0 +1,492 @@
+"""
+Durable Update Queue on Redis Streams
+
+With UPDATE_QUEUE=stream, main.py only receives updates (polling or webhook,
+as configured by BOT_MODE), drops redeliveries and appends each update to a
+Redis Stream. Handlers run in worker processes started separately:
+
+    python stream_queue.py worker --partition 0 --consumer worker-a
+
+Workers read through a consumer group and acknowledge an entry only after its
+handlers have completed, so an update taken by a worker that crashed stays
+pending and is reclaimed by another consumer (or the same one after restart):
+processing is at-least-once. An exception raised by a handler also leaves the
+entry pending: Application.process_update hands it to the worker's error
+handler instead of raising, and the worker skips the ack for updates recorded
+there. Errors a handler catches itself (and answers the user about) count as
+completed. Entries that keep failing are moved to a dead-letter stream after
+UPDATE_STREAM_MAX_DELIVERIES attempts, and any range of entries can be fed
+back with the replay command.
+
+Updates are spread over UPDATE_STREAM_PARTITIONS streams by a consistent hash
+of the chat, so updates of one chat stay in one stream and in order as long
+as each partition is read by one active consumer. Extra consumers of the same
+partition act as hot standbys that take over stalled entries.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import signal
+import socket
+from typing import Optional
+import redis.asyncio as aioredis
+from redis.exceptions import ResponseError
+from telegram import Update
+from telegram.ext import ContextTypes
+from config import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, OPENAI_SHUTDOWN_GRACE,
+    UPDATE_STREAM_KEY, UPDATE_STREAM_GROUP, UPDATE_STREAM_PARTITIONS, UPDATE_STREAM_MAXLEN,
+    UPDATE_STREAM_IN_FLIGHT, UPDATE_STREAM_CLAIM_IDLE_MS, UPDATE_STREAM_MAX_DELIVERIES
+)
+from logger import logger
+from sharding import shard_for_update
+from update_dedup import claim_update
+
+# Entries read per XREADGROUP call and updates appended per pipeline
+READ_BATCH = 32
+
+# How long a read blocks waiting for new entries, milliseconds
+READ_BLOCK_MS = 1000
+
+# How long shutdown waits for the intake to flush received updates, seconds
+INTAKE_FLUSH_TIMEOUT = 30
+
+
+def stream_key(partition: int) -> str:
+    """Stream of one partition"""
+    return f"{UPDATE_STREAM_KEY}:{partition}"
+
+
+def dead_letter_key(partition: int) -> str:
+    """Dead-letter stream of one partition"""
+    return f"{stream_key(partition)}:dead"
+
+
+def _redis() -> aioredis.Redis:
+    return aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+
+
+async def ensure_group(client: aioredis.Redis, stream: str) -> None:
+    """Creates the consumer group (and the stream) unless it already exists"""
+    try:
+        await client.xgroup_create(stream, UPDATE_STREAM_GROUP, id="0", mkstream=True)
+        logger.info(f"[StreamQueue] Created consumer group {UPDATE_STREAM_GROUP} on {stream}")
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def _run_intake() -> None:
+    """Receives updates and appends them to the partition streams"""
+    import main as bot
+
+    # Schema migrations run once here, not concurrently in every worker
+    await bot.analytics.init_database()
+    await bot.close_analytics()
+
+    client = _redis()
+    for partition in range(UPDATE_STREAM_PARTITIONS):
+        await ensure_group(client, stream_key(partition))
+
+    # Same as the sharding front: no handlers and no app.start(), the router
+    # below is the only consumer of update_queue
+    app = bot.build_application(concurrent=False)
+    await app.initialize()
+    await bot.start_receiving_updates(app)
+    logger.info(f"[StreamQueue] Intake started: {UPDATE_STREAM_PARTITIONS} partition(s) of {UPDATE_STREAM_KEY}")
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop_event.set)
+
+    def encode(update: Update) -> Optional[tuple]:
+        message = update.message
+        if not claim_update(
+            app.bot.id, update.update_id,
+            message.chat_id if message else None,
+            message.message_id if message else None
+        ):
+            logger.info(f"[StreamQueue] Skipping duplicate update {update.update_id}")
+            return None
+        return stream_key(shard_for_update(update, UPDATE_STREAM_PARTITIONS)), update.to_json()
+
+    async def append(entries: list) -> None:
+        # An update is only done for the intake once Redis has it: retry instead of dropping
+        delay = 0.5
+        while True:
+            try:
+                pipe = client.pipeline(transaction=False)
+                for stream, data in entries:
+                    pipe.xadd(stream, {"update": data}, maxlen=UPDATE_STREAM_MAXLEN, approximate=True)
+                await pipe.execute()
+                return
+            except Exception as e:
+                logger.error(f"[StreamQueue] Failed to append {len(entries)} update(s), retrying in {delay:g}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10)
+
+    async def route_updates():
+        # A single sequential router keeps per-chat order within each partition
+        while True:
+            batch = [await app.update_queue.get()]
+            while len(batch) < READ_BATCH and not app.update_queue.empty():
+                batch.append(app.update_queue.get_nowait())
+            try:
+                entries = []
+                for update in batch:
+                    if not isinstance(update, Update):
+                        continue
+                    try:
+                        entry = encode(update)
+                    except Exception as encode_error:
+                        logger.error(f"[StreamQueue] Failed to encode update: {encode_error}")
+                        continue
+                    if entry is not None:
+                        entries.append(entry)
+                if entries:
+                    await append(entries)
+            finally:
+                for _ in batch:
+                    app.update_queue.task_done()
+
+    router_task = asyncio.create_task(route_updates())
+
+    try:
+        await stop_event.wait()
+        logger.info("[StreamQueue] Stop signal received")
+    finally:
+        if app.updater.running:
+            await app.updater.stop()
+        try:
+            await asyncio.wait_for(app.update_queue.join(), INTAKE_FLUSH_TIMEOUT)
+        except TimeoutError:
+            logger.error(f"[StreamQueue] {app.update_queue.qsize()} received update(s) were not appended before shutdown")
+        router_task.cancel()
+        await asyncio.gather(router_task, return_exceptions=True)
+        await app.shutdown()
+        await client.aclose()
+        logger.info("[StreamQueue] Intake stopped")
+
+
+def run_stream_intake() -> None:
+    """Starts the intake process of the Redis Streams mode"""
+    logger.info("🚀 Запускаем прием апдейтов в Redis Streams (обработка - в воркерах stream_queue.py)...")
+    asyncio.run(_run_intake())
+
+
+class _StreamWorker:
+    """Consumer of one partition stream"""
+
+    def __init__(self, app, client: aioredis.Redis, partition: int, consumer: str):
+        self.app = app
+        self.client = client
+        self.partition = partition
+        self.stream = stream_key(partition)
+        self.consumer = consumer
+        self.in_flight: dict[str, asyncio.Task] = {}
+        # Handler exceptions of updates being processed, by id(update)
+        self.handler_errors: dict[int, Exception] = {}
+        self._slot_freed = asyncio.Event()
+        self.processed = 0
+        self.reclaimed = 0
+        self.dead_lettered = 0
+
+    async def _ack(self, entry_id: str) -> None:
+        try:
+            await self.client.xack(self.stream, UPDATE_STREAM_GROUP, entry_id)
+        except Exception as e:
+            # Stays pending and will be processed again after reclaim
+            logger.error(f"[StreamQueue] Failed to ack {entry_id}: {e}")
+
+    async def _dead_letter(self, entry_id: str, fields: dict, deliveries: int, reason: str) -> None:
+        logger.error(f"[StreamQueue] Moving {self.stream} {entry_id} to dead letters after "
+                     f"{deliveries} deliveries: {reason}")
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.xadd(dead_letter_key(self.partition), {
+                "update": fields.get("update", ""),
+                "source_id": entry_id,
+                "deliveries": deliveries,
+                "reason": reason,
+            }, maxlen=UPDATE_STREAM_MAXLEN, approximate=True)
+            pipe.xack(self.stream, UPDATE_STREAM_GROUP, entry_id)
+            await pipe.execute()
+            self.dead_lettered += 1
+        except Exception as e:
+            logger.error(f"[StreamQueue] Failed to dead-letter {entry_id}: {e}")
+
+    async def on_handler_error(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Error handler of the worker application: records the failure so the entry is not acknowledged"""
+        logger.error(f"[StreamQueue] Handler failed: {context.error}", exc_info=context.error)
+        if isinstance(update, Update):
+            self.handler_errors[id(update)] = context.error
+
+    async def _process(self, entry_id: str, fields: dict) -> None:
+        try:
+            update = Update.de_json(json.loads(fields["update"]), self.app.bot)
+        except Exception as decode_error:
+            await self._dead_letter(entry_id, fields, 1, f"undecodable entry: {decode_error}")
+            return
+        # Same path as the application's own update fetcher: per-chat ordering and
+        # priorities of the update processor, handler errors go to on_handler_error
+        try:
+            await self.app.update_processor.process_update(update, self.app.process_update(update))
+        except Exception as e:
+            # Not acknowledged: the entry is retried after reclaim
+            logger.error(f"[StreamQueue] Processing {entry_id} failed: {e}")
+            return
+        finally:
+            handler_error = self.handler_errors.pop(id(update), None)
+        if handler_error is not None:
+            logger.warning(f"[StreamQueue] Leaving {entry_id} pending after a handler error")
+            return
+        await self._ack(entry_id)
+        self.processed += 1
+
+    def _start(self, entry_id: str, fields: dict) -> None:
+        if entry_id in self.in_flight:
+            return
+        task = asyncio.create_task(self._process(entry_id, fields))
+        self.in_flight[entry_id] = task
+
+        def done(_task):
+            self.in_flight.pop(entry_id, None)
+            self._slot_freed.set()
+        task.add_done_callback(done)
+
+    async def _wait_for_slot(self) -> int:
+        """Waits until fewer than UPDATE_STREAM_IN_FLIGHT entries are processed, returns free slots"""
+        while len(self.in_flight) >= UPDATE_STREAM_IN_FLIGHT:
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+        return UPDATE_STREAM_IN_FLIGHT - len(self.in_flight)
+
+    async def read_new(self) -> None:
+        """Reads and starts new entries, blocking briefly when there are none"""
+        free = await self._wait_for_slot()
+        response = await self.client.xreadgroup(
+            UPDATE_STREAM_GROUP, self.consumer, {self.stream: ">"},
+            count=min(free, READ_BATCH), block=READ_BLOCK_MS
+        )
+        for _, entries in response or []:
+            for entry_id, fields in entries:
+                self._start(entry_id, fields)
+
+    async def heartbeat(self) -> None:
+        """Resets the idle time of entries still being processed so nobody reclaims them"""
+        if not self.in_flight:
+            return
+        await self.client.xclaim(
+            self.stream, UPDATE_STREAM_GROUP, self.consumer, 0, list(self.in_flight), justid=True
+        )
+
+    async def reclaim(self, own_only: bool = False) -> None:
+        """
+        Takes over pending entries whose consumer stopped processing them.
+
+        Never waits for a processing slot: when all slots are busy the remaining
+        entries stay pending for the next round (or another consumer).
+
+        Args:
+            own_only: Only this consumer's entries regardless of idle time (on startup)
+        """
+        if own_only:
+            scope, min_idle = {"consumername": self.consumer}, 0
+        else:
+            scope, min_idle = {"idle": UPDATE_STREAM_CLAIM_IDLE_MS}, UPDATE_STREAM_CLAIM_IDLE_MS
+        cursor = "-"
+        while True:
+            pending = await self.client.xpending_range(
+                self.stream, UPDATE_STREAM_GROUP, min=cursor, max="+", count=READ_BATCH, **scope
+            )
+            if not pending:
+                return
+            cursor = f"({pending[-1]['message_id']}"
+            free = UPDATE_STREAM_IN_FLIGHT - len(self.in_flight)
+            if free <= 0:
+                return
+            # Claim only what can be started now: a claimed entry counts as a delivery
+            deliveries = dict(itertools.islice((
+                (item["message_id"], item["times_delivered"])
+                for item in pending if item["message_id"] not in self.in_flight
+            ), free))
+            if not deliveries:
+                continue
+
+            # XCLAIM re-checks the idle time, so two consumers never take the same entry
+            claimed = await self.client.xclaim(
+                self.stream, UPDATE_STREAM_GROUP, self.consumer, min_idle, list(deliveries)
+            )
+            for entry_id, fields in claimed:
+                if fields is None:
+                    # Trimmed from the stream by MAXLEN while pending
+                    await self._ack(entry_id)
+                    continue
+                if deliveries[entry_id] >= UPDATE_STREAM_MAX_DELIVERIES:
+                    await self._dead_letter(entry_id, fields, deliveries[entry_id], "too many deliveries")
+                    continue
+                self.reclaimed += 1
+                logger.warning(f"[StreamQueue] Reclaimed {self.stream} {entry_id} "
+                               f"(delivery {deliveries[entry_id] + 1})")
+                self._start(entry_id, fields)
+
+    async def drain(self, timeout: float) -> None:
+        """Waits for entries being processed; unfinished ones stay pending for another consumer"""
+        if not self.in_flight:
+            return
+        done, pending = await asyncio.wait(list(self.in_flight.values()), timeout=timeout)
+        if pending:
+            logger.warning(f"[StreamQueue] {len(pending)} entries still in progress at shutdown, "
+                           f"left pending for reclaim")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _run_worker(partition: int, consumer: str, maintenance_jobs: bool) -> None:
+    """Runs the bot handlers on entries of one partition stream"""
+    import main as bot
+
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop_event.set)
+
+    client = _redis()
+    await ensure_group(client, stream_key(partition))
+
+    app = bot.build_application()
+    # Redeliveries are dropped by the intake; entries reclaimed here must run again
+    await bot.setup_handlers(app, maintenance_jobs=maintenance_jobs, deduplicate=False)
+    worker = _StreamWorker(app, client, partition, consumer)
+    app.add_error_handler(worker.on_handler_error)
+    await app.initialize()
+    await app.start()
+    logger.info(f"[StreamQueue] Worker {consumer} started on {worker.stream}")
+
+    interval = max(1.0, UPDATE_STREAM_CLAIM_IDLE_MS / 1000 / 4)
+
+    async def heartbeat_loop():
+        # Separate from reclaim so a slow reclaim round never lets live entries go idle
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await worker.heartbeat()
+            except Exception as e:
+                logger.error(f"[StreamQueue] Heartbeat failed: {e}")
+
+    async def reclaim_loop():
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await worker.reclaim()
+            except Exception as e:
+                logger.error(f"[StreamQueue] Reclaim failed: {e}")
+
+    heartbeat_task = asyncio.create_task(heartbeat_loop())
+    reclaim_task = None
+    try:
+        # Entries this consumer took before a restart come first
+        await worker.reclaim(own_only=True)
+        reclaim_task = asyncio.create_task(reclaim_loop())
+        while not stop_event.is_set():
+            try:
+                await worker.read_new()
+            except Exception as e:
+                logger.error(f"[StreamQueue] Read from {worker.stream} failed: {e}")
+                await asyncio.sleep(1)
+    finally:
+        logger.info(f"[StreamQueue] Worker {consumer} stopping")
+        if reclaim_task is not None:
+            reclaim_task.cancel()
+            await asyncio.gather(reclaim_task, return_exceptions=True)
+        await bot.shutdown_active_runs(OPENAI_SHUTDOWN_GRACE)
+        # Entries finishing within the grace period stay claimed by this consumer
+        await worker.drain(OPENAI_SHUTDOWN_GRACE)
+        heartbeat_task.cancel()
+        await asyncio.gather(heartbeat_task, return_exceptions=True)
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await bot.close_analytics()
+        await client.aclose()
+        logger.info(f"[StreamQueue] Worker {consumer} stopped: processed {worker.processed}, "
+                    f"reclaimed {worker.reclaimed}, dead-lettered {worker.dead_lettered}")
+
+
+async def replay(partition: int, start: str = "-", end: str = "+", dead_letters: bool = False) -> int:
+    """
+    Appends a range of stored entries to the partition stream again.
+
+    Args:
+        partition: Partition to replay
+        start: First entry ID ("-" - from the beginning)
+        end: Last entry ID ("+" - to the end)
+        dead_letters: Replay from the dead-letter stream and remove replayed entries from it
+
+    Returns:
+        int: Number of replayed entries
+    """
+    client = _redis()
+    source = dead_letter_key(partition) if dead_letters else stream_key(partition)
+    replayed = 0
+    try:
+        while True:
+            entries = await client.xrange(source, min=start, max=end, count=READ_BATCH)
+            if not entries:
+                break
+            pipe = client.pipeline(transaction=True)
+            for entry_id, fields in entries:
+                pipe.xadd(stream_key(partition), {"update": fields["update"]},
+                          maxlen=UPDATE_STREAM_MAXLEN, approximate=True)
+                if dead_letters:
+                    pipe.xdel(source, entry_id)
+            await pipe.execute()
+            replayed += len(entries)
+            if len(entries) < READ_BATCH:
+                break
+            # Exclusive start after the last copied entry
+            start = f"({entries[-1][0]}"
+    finally:
+        await client.aclose()
+    logger.info(f"[StreamQueue] Replayed {replayed} entries from {source}")
+    return replayed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Redis Streams update queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    worker_parser = commands.add_parser("worker", help="process updates of one partition")
+    worker_parser.add_argument("--partition", type=int, default=0)
+    worker_parser.add_argument("--consumer",
+                               help="consumer name, stable across restarts to resume own entries "
+                                    "(default: <hostname>-p<partition>)")
+    worker_parser.add_argument("--no-maintenance", action="store_true",
+                               help="do not schedule background jobs (for standby consumers of partition 0)")
+
+    replay_parser = commands.add_parser("replay", help="append stored entries to the stream again")
+    replay_parser.add_argument("--partition", type=int, default=0)
+    replay_parser.add_argument("--start", default="-")
+    replay_parser.add_argument("--end", default="+")
+    replay_parser.add_argument("--dead-letters", action="store_true")
+
+    args = parser.parse_args()
+    if not 0 <= args.partition < UPDATE_STREAM_PARTITIONS:
+        parser.error(f"--partition must be in [0, {UPDATE_STREAM_PARTITIONS})")
+
+    if args.command == "worker":
+        consumer = args.consumer or f"{socket.gethostname()}-p{args.partition}"
+        logger.info(f"🚀 Запускаем воркер Redis Streams (партиция {args.partition})...")
+        # Background jobs run in one worker only: by default the one of partition 0
+        maintenance_jobs = args.partition == 0 and not args.no_maintenance
+        asyncio.run(_run_worker(args.partition, consumer, maintenance_jobs))
+    else:
+        asyncio.run(replay(args.partition, args.start, args.end, args.dead_letters))
+
+
+if __name__ == "__main__":
+    main()
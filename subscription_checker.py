@@ -4,7 +4,7 @@ import json
 from typing import Optional
 from logger import logger
 import redis
-from config import REDIS_HOST, REDIS_PORT, REDIS_DB
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB, CHANNEL_IDS, AUTH_CHAT_TTL
 
 # Создаем подключение к Redis для кеширования
 redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
@@ -15,29 +15,48 @@ ALLOWED_STATUSES = {"creator", "administrator", "member"}
 # Время жизни кеша в секундах (10 минут)
 CACHE_TTL = 600
 
-async def check_channel_subscription(bot_token: str, channel_id: str, user_id: int) -> bool:
+# Режимы проверки нескольких каналов (CHANNEL_MATCH_MODE)
+MATCH_MODE_ANY = "any"
+MATCH_MODE_ALL = "all"
+
+def requires_all_channels(match_mode: str) -> bool:
     """
-    Проверяет подписку пользователя на канал через Telegram Bot API.
+    Разбирает режим проверки каналов.
+    
+    Args:
+        match_mode: "any" - подписка хотя бы на один канал, "all" - на все каналы
+        
+    Returns:
+        bool: True для режима "all"; неизвестное значение логируется и считается "any"
+    """
+    if match_mode not in (MATCH_MODE_ANY, MATCH_MODE_ALL):
+        logger.warning(f"[Subscription] Unknown CHANNEL_MATCH_MODE {match_mode!r}, using {MATCH_MODE_ANY!r}")
+        return False
+    return match_mode == MATCH_MODE_ALL
+
+def _cache_key(user_id: int, channel_id: str) -> str:
+    """Ключ кеша подписки для пары (пользователь, канал)"""
+    return f"subscription:{user_id}:{channel_id}"
+
+def _chat_key(chat_id: int) -> str:
+    """Ключ отметки чата, где недавно был авторизованный участник"""
+    return f"authorized_chat:{chat_id}"
+
+async def _fetch_channel_membership(session: aiohttp.ClientSession, bot_token: str,
+                                    channel_id: str, user_id: int) -> Optional[bool]:
+    """
+    Запрашивает статус пользователя в канале через getChatMember и кеширует результат.
     
     Args:
+        session: Открытая aiohttp сессия
         bot_token: Токен Telegram бота
         channel_id: ID канала (например, @logloss_notes)
         user_id: ID пользователя Telegram
         
     Returns:
-        bool: True если пользователь подписан на канал, False иначе
+        Optional[bool]: True/False если статус определен, None при временной ошибке
     """
-    # Проверяем кеш
-    cache_key = f"subscription:{user_id}"
-    try:
-        cached_result = redis_client.get(cache_key)
-        if cached_result is not None:
-            logger.info(f"[Subscription] Cache hit for user {user_id}: {cached_result}")
-            return cached_result.lower() == "true"
-    except Exception as e:
-        logger.warning(f"[Subscription] Redis cache error for user {user_id}: {e}")
-    
-    # Выполняем запрос к API
+    cache_key = _cache_key(user_id, channel_id)
     url = f"https://api.telegram.org/bot{bot_token}/getChatMember"
     params = {
         "chat_id": channel_id,
@@ -45,82 +64,210 @@ async def check_channel_subscription(bot_token: str, channel_id: str, user_id: i
     }
     
     try:
-        timeout = aiohttp.ClientTimeout(total=10)  # Таймаут 10 секунд
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    if data.get("ok"):
-                        member_status = data.get("result", {}).get("status")
-                        is_subscribed = member_status in ALLOWED_STATUSES
-                        
-                        logger.info(f"[Subscription] User {user_id} status in channel: {member_status}, allowed: {is_subscribed}")
-                        
-                        # Кешируем результат
+        async with session.get(url, params=params) as response:
+            if response.status == 200:
+                data = await response.json()
+                if data.get("ok"):
+                    member_status = data.get("result", {}).get("status")
+                    is_subscribed = member_status in ALLOWED_STATUSES
+                    
+                    logger.info(f"[Subscription] User {user_id} status in channel {channel_id}: {member_status}, allowed: {is_subscribed}")
+                    
+                    # Кешируем результат
+                    try:
+                        redis_client.setex(cache_key, CACHE_TTL, "true" if is_subscribed else "false")
+                    except Exception as e:
+                        logger.warning(f"[Subscription] Failed to cache result for user {user_id}: {e}")
+                    
+                    return is_subscribed
+                else:
+                    error_description = data.get("description", "Unknown error")
+                    logger.warning(f"[Subscription] API error for user {user_id} in channel {channel_id}: {error_description}")
+                    
+                    # Если пользователь не найден в канале, считаем что не подписан
+                    if "user not found" in error_description.lower() or "bad request" in error_description.lower():
                         try:
-                            redis_client.setex(cache_key, CACHE_TTL, "true" if is_subscribed else "false")
+                            redis_client.setex(cache_key, CACHE_TTL, "false")
                         except Exception as e:
-                            logger.warning(f"[Subscription] Failed to cache result for user {user_id}: {e}")
-                        
-                        return is_subscribed
-                    else:
-                        error_description = data.get("description", "Unknown error")
-                        logger.warning(f"[Subscription] API error for user {user_id}: {error_description}")
-                        
-                        # Если пользователь не найден в канале, считаем что не подписан
-                        if "user not found" in error_description.lower() or "bad request" in error_description.lower():
-                            try:
-                                redis_client.setex(cache_key, CACHE_TTL, "false")
-                            except Exception as e:
-                                logger.warning(f"[Subscription] Failed to cache negative result for user {user_id}: {e}")
-                            return False
-                        
-                        # Для других ошибок не кешируем и возвращаем False
+                            logger.warning(f"[Subscription] Failed to cache negative result for user {user_id}: {e}")
                         return False
-                else:
-                    logger.error(f"[Subscription] HTTP error {response.status} for user {user_id}")
-                    return False
                     
+                    # Для других ошибок не кешируем
+                    return None
+            else:
+                logger.error(f"[Subscription] HTTP error {response.status} for user {user_id} in channel {channel_id}")
+                return None
+                
     except asyncio.TimeoutError:
-        logger.error(f"[Subscription] Timeout checking subscription for user {user_id}")
-        return False
+        logger.error(f"[Subscription] Timeout checking subscription for user {user_id} in channel {channel_id}")
+        return None
     except aiohttp.ClientError as e:
-        logger.error(f"[Subscription] Network error checking subscription for user {user_id}: {e}")
+        logger.error(f"[Subscription] Network error checking subscription for user {user_id} in channel {channel_id}: {e}")
+        return None
+
+async def check_channels_subscription(bot_token: str, channel_ids: list[str], user_id: int,
+                                      require_all: bool = False) -> bool:
+    """
+    Проверяет подписку пользователя на несколько каналов.
+    Закешированные статусы читаются одним запросом к Redis, остальные каналы
+    проверяются параллельно. Проверка завершается на первом решающем ответе:
+    первая найденная подписка в режиме "any" или первое отсутствие подписки
+    в режиме "all"; оставшиеся запросы отменяются.
+    
+    Args:
+        bot_token: Токен Telegram бота
+        channel_ids: Список ID каналов
+        user_id: ID пользователя Telegram
+        require_all: True - нужна подписка на все каналы, False - хотя бы на один
+        
+    Returns:
+        bool: True если условие подписки выполнено
+    """
+    if not channel_ids:
+        logger.warning("[Subscription] No channels configured for subscription check")
         return False
+    
+    # Проверяем кеш для всех каналов одним запросом
+    uncached_channels = []
+    try:
+        cached_results = redis_client.mget([_cache_key(user_id, channel_id) for channel_id in channel_ids])
+    except Exception as e:
+        logger.warning(f"[Subscription] Redis cache error for user {user_id}: {e}")
+        cached_results = [None] * len(channel_ids)
+    
+    for channel_id, cached_result in zip(channel_ids, cached_results):
+        if cached_result is None:
+            uncached_channels.append(channel_id)
+            continue
+        is_subscribed = cached_result.lower() == "true"
+        if is_subscribed != require_all:
+            # Решающий ответ из кеша: подписка в режиме "any" или ее отсутствие в режиме "all"
+            logger.info(f"[Subscription] Cache hit for user {user_id} in channel {channel_id}: {cached_result}")
+            return is_subscribed
+    
+    if not uncached_channels:
+        logger.info(f"[Subscription] Cache hit for user {user_id} in all channels")
+        return require_all
+    
+    # Выполняем запросы к API параллельно
+    try:
+        timeout = aiohttp.ClientTimeout(total=10)  # Таймаут 10 секунд
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            tasks = [
+                asyncio.create_task(_fetch_channel_membership(session, bot_token, channel_id, user_id))
+                for channel_id in uncached_channels
+            ]
+            try:
+                for completed in asyncio.as_completed(tasks):
+                    is_subscribed = await completed
+                    if is_subscribed is None:
+                        # Статус не определен - в режиме "all" это отказ, в режиме "any" ждем остальные каналы
+                        if require_all:
+                            return False
+                        continue
+                    if is_subscribed != require_all:
+                        return is_subscribed
+            finally:
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        
+        return require_all
+                    
     except Exception as e:
         logger.error(f"[Subscription] Unexpected error checking subscription for user {user_id}: {e}")
         return False
 
-async def clear_subscription_cache(user_id: int) -> bool:
+def get_cached_subscription(channel_ids: list[str], user_id: int, require_all: bool = False) -> Optional[bool]:
+    """
+    Проверяет подписку только по кешу, без запросов к Telegram API.
+    
+    Args:
+        channel_ids: Список ID каналов
+        user_id: ID пользователя Telegram
+        require_all: True - нужна подписка на все каналы, False - хотя бы на один
+        
+    Returns:
+        Optional[bool]: Результат проверки или None, если кеша для решения недостаточно
+    """
+    if not channel_ids:
+        return False
+    try:
+        cached_results = redis_client.mget([_cache_key(user_id, channel_id) for channel_id in channel_ids])
+    except Exception as e:
+        logger.warning(f"[Subscription] Redis cache error for user {user_id}: {e}")
+        return None
+    
+    for cached_result in cached_results:
+        if cached_result is not None and (cached_result.lower() == "true") != require_all:
+            return not require_all
+    if all(cached_result is not None for cached_result in cached_results):
+        return require_all
+    return None
+
+def mark_chat_authorized(chat_id: int) -> None:
+    """Отмечает чат, в котором писал авторизованный участник, на AUTH_CHAT_TTL секунд"""
+    try:
+        redis_client.set(_chat_key(chat_id), 1, ex=AUTH_CHAT_TTL)
+    except Exception as e:
+        logger.warning(f"[Subscription] Failed to mark chat {chat_id} as authorized: {e}")
+
+def is_chat_authorized(chat_id: int) -> bool:
+    """Был ли в чате авторизованный участник за последние AUTH_CHAT_TTL секунд"""
+    try:
+        return bool(redis_client.exists(_chat_key(chat_id)))
+    except Exception as e:
+        logger.warning(f"[Subscription] Failed to check chat {chat_id} authorization: {e}")
+        return False
+
+async def check_channel_subscription(bot_token: str, channel_id: str, user_id: int) -> bool:
+    """
+    Проверяет подписку пользователя на канал через Telegram Bot API.
+    
+    Args:
+        bot_token: Токен Telegram бота
+        channel_id: ID канала (например, @logloss_notes)
+        user_id: ID пользователя Telegram
+        
+    Returns:
+        bool: True если пользователь подписан на канал, False иначе
+    """
+    return await check_channels_subscription(bot_token, [channel_id], user_id)
+
+async def clear_subscription_cache(user_id: int, channel_ids: Optional[list[str]] = None) -> bool:
     """
     Очищает кеш подписки для конкретного пользователя.
     
     Args:
         user_id: ID пользователя Telegram
+        channel_ids: Список каналов (по умолчанию - все каналы из конфигурации)
         
     Returns:
         bool: True если кеш был успешно очищен
     """
-    cache_key = f"subscription:{user_id}"
+    channel_ids = channel_ids or CHANNEL_IDS
     try:
-        result = redis_client.delete(cache_key)
+        result = redis_client.delete(*[_cache_key(user_id, channel_id) for channel_id in channel_ids])
         logger.info(f"[Subscription] Cache cleared for user {user_id}")
         return bool(result)
     except Exception as e:
         logger.error(f"[Subscription] Failed to clear cache for user {user_id}: {e}")
         return False
 
-def get_subscription_cache_info(user_id: int) -> Optional[dict]:
+def get_subscription_cache_info(user_id: int, channel_id: Optional[str] = None) -> Optional[dict]:
     """
     Получает информацию о кешированном статусе подписки.
     
     Args:
         user_id: ID пользователя Telegram
+        channel_id: ID канала (по умолчанию - первый канал из конфигурации)
         
     Returns:
         dict: Информация о кеше или None если кеш пуст
     """
-    cache_key = f"subscription:{user_id}"
+    channel_id = channel_id or CHANNEL_IDS[0]
+    cache_key = _cache_key(user_id, channel_id)
     try:
         value = redis_client.get(cache_key)
         ttl = redis_client.ttl(cache_key)
@@ -128,10 +275,53 @@ def get_subscription_cache_info(user_id: int) -> Optional[dict]:
         if value is not None:
             return {
                 "user_id": user_id,
+                "channel_id": channel_id,
                 "subscribed": value.lower() == "true",
                 "ttl_seconds": ttl if ttl > 0 else 0
             }
         return None
     except Exception as e:
         logger.error(f"[Subscription] Failed to get cache info for user {user_id}: {e}")
-        return None 
\ No newline at end of file
+        return None
+
+
+async def warm_subscription_cache(bot_token: str, channel_ids: list[str], user_ids: list[int],
+                                  batch_size: int = 20, batch_delay: float = 1.0,
+                                  require_all: bool = False) -> int:
+    """
+    Прогревает кеш подписок для списка пользователей.
+    Пользователи, для которых кеш уже дает решение, пропускаются, остальные
+    проверяются пачками по batch_size запросов с паузой batch_delay секунд,
+    чтобы не упереться в лимиты Telegram Bot API.
+    
+    Args:
+        bot_token: Токен Telegram бота
+        channel_ids: Список ID каналов
+        user_ids: Список ID пользователей Telegram
+        batch_size: Количество параллельных запросов в одной пачке
+        batch_delay: Пауза между пачками в секундах
+        require_all: Режим проверки подписки (см. check_channels_subscription)
+        
+    Returns:
+        int: Количество пользователей, для которых был выполнен запрос к API
+    """
+    # В режиме "any" проверка останавливается на первой подписке, поэтому закешированы
+    # не все каналы - достаточно, чтобы кеш давал решение
+    pending = [
+        user_id for user_id in user_ids
+        if get_cached_subscription(channel_ids, user_id, require_all=require_all) is None
+    ]
+    
+    batch_size = max(1, batch_size)
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        await asyncio.gather(
+            *(check_channels_subscription(bot_token, channel_ids, user_id, require_all) for user_id in batch),
+            return_exceptions=True
+        )
+        if start + batch_size < len(pending):
+            await asyncio.sleep(batch_delay)
+    
+    logger.info(f"[Subscription] Cache warmup finished: {len(pending)} checked, "
+                f"{len(user_ids) - len(pending)} already cached")
+    return len(pending)
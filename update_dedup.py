@@ -0,0 +1,66 @@
+"""
+Окно де-дупликации апдейтов в Redis.
+
+Повторная доставка после переподключения polling, перезапуска или повтора webhook
+не должна запускать второй (платный) запрос к OpenAI.
+
+Апдейт помечается взятым (SET NX) до запуска обработчиков, поэтому в пределах окна
+UPDATE_DEDUP_TTL доставка не более чем однократная: если процесс упал посреди
+обработки, повторная доставка того же апдейта будет пропущена и ответ потеряется.
+Это сознательный выбор - потерянный ответ дешевле двойного запуска ассистента.
+Режим Redis Streams дает обратную гарантию: claim_update вызывается при приеме
+апдейта перед записью в поток, а воркеры подключают обработчики с
+setup_handlers(deduplicate=False) и подтверждают запись только после обработки,
+так что взятый апдейт обрабатывается хотя бы один раз.
+"""
+
+from typing import Optional
+from logger import logger
+import redis
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB, UPDATE_DEDUP_TTL
+
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+
+DEDUP_PREFIX = "dedup:"
+
+
+def _update_key(bot_id: int, update_id: int) -> str:
+    """Ключ обработанного апдейта"""
+    return f"{DEDUP_PREFIX}update:{bot_id}:{update_id}"
+
+
+def _message_key(bot_id: int, chat_id: int, message_id: int) -> str:
+    """Ключ обработанного нового сообщения (message_id уникален в пределах чата)"""
+    return f"{DEDUP_PREFIX}message:{bot_id}:{chat_id}:{message_id}"
+
+
+def claim_update(bot_id: int, update_id: int, chat_id: Optional[int] = None,
+                 message_id: Optional[int] = None) -> bool:
+    """
+    Отмечает апдейт как взятый в обработку (SET NX с TTL).
+
+    Апдейт считается повтором, если уже встречался его update_id или, для новых
+    сообщений, пара (chat_id, message_id). При недоступности Redis апдейт
+    обрабатывается: лучше редкий дубль, чем потерянное сообщение.
+
+    Args:
+        bot_id: ID бота (несколько ботов могут делить одну базу Redis)
+        update_id: update_id апдейта
+        chat_id: Чат нового сообщения (None для остальных апдейтов)
+        message_id: ID нового сообщения
+
+    Returns:
+        bool: True, если апдейт нужно обработать; False, если это повтор
+    """
+    if UPDATE_DEDUP_TTL <= 0:
+        return True
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.set(_update_key(bot_id, update_id), 1, nx=True, ex=UPDATE_DEDUP_TTL)
+        if chat_id is not None and message_id is not None:
+            pipe.set(_message_key(bot_id, chat_id, message_id), 1, nx=True, ex=UPDATE_DEDUP_TTL)
+        return all(pipe.execute())
+    except Exception as e:
+        logger.warning(f"[Dedup] Failed to check update {update_id}, processing it: {e}")
+        return True
@@ -0,0 +1,333 @@
+"""
+Concurrent Update Processing with Per-Chat Ordering
+
+This module provides an update processor for python-telegram-bot that runs
+updates from different chats in parallel while keeping updates within one
+chat (or supergroup topic) strictly in arrival order. Free run slots go to
+interactive updates first; background work is capped to a share of them.
+Commands such as /reset can interrupt the request their chat is running
+instead of waiting behind it.
+"""
+
+import asyncio
+import math
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from chat_detector import get_update_context
+from logger import logger
+
+
+class UpdatePriority(IntEnum):
+    """Priority classes of updates, lower value runs first"""
+    ADDRESSED = 0    # Commands and group messages addressed to the bot
+    PRIVATE = 1      # Private chat messages
+    BACKGROUND = 2   # Group messages ingested as context only
+    MAINTENANCE = 3  # Edits, membership changes and other service updates
+
+
+# Classes limited to the background share of run slots
+BACKGROUND_PRIORITIES = (UpdatePriority.BACKGROUND, UpdatePriority.MAINTENANCE)
+
+# Commands that interrupt the chat's running update instead of queueing behind it
+INTERRUPTING_COMMANDS = frozenset({"reset"})
+
+
+def get_update_priority(update: object) -> UpdatePriority:
+    """
+    Classifies an update for scheduling.
+
+    Args:
+        update: Object taken from the application's update queue
+
+    Returns:
+        UpdatePriority: Priority class of the update
+    """
+    if not isinstance(update, Update) or update.message is None or update.effective_chat is None:
+        return UpdatePriority.MAINTENANCE
+
+    # Shared with the handlers, which ask the same questions about the update
+    update_context = get_update_context(update)
+    if update_context.is_command:
+        return UpdatePriority.ADDRESSED
+
+    if update_context.is_private:
+        return UpdatePriority.PRIVATE
+
+    if update_context.is_group:
+        # Without a bot bound to the update, mentions and replies are not recognized
+        if update_context.is_mentioned or update_context.is_reply_to_bot:
+            return UpdatePriority.ADDRESSED
+        return UpdatePriority.BACKGROUND
+
+    return UpdatePriority.MAINTENANCE
+
+
+def is_interrupting_command(update: object) -> bool:
+    """
+    Checks whether the update is an interrupting command addressed to this bot.
+
+    Args:
+        update: Object taken from the application's update queue
+
+    Returns:
+        bool: True for /reset and /reset@this_bot
+    """
+    if not isinstance(update, Update) or update.message is None or not update.message.text:
+        return False
+    if not update.message.text.startswith("/"):
+        return False
+
+    command, _, mention = update.message.text.split(maxsplit=1)[0][1:].partition("@")
+    if command.lower() not in INTERRUPTING_COMMANDS:
+        return False
+    if mention:
+        try:
+            return mention.lower() == (update.get_bot().username or "").lower()
+        except RuntimeError:
+            return False
+    return True
+
+
+class PriorityLimiter:
+    """
+    Concurrency limiter that grants free slots to the highest-priority waiter.
+
+    At most ``limit`` holders run at once, and holders of background classes
+    are additionally capped at ``background_limit``. Waiters of one class are
+    served in FIFO order.
+    """
+
+    def __init__(self, limit: int, background_limit: int):
+        """
+        Args:
+            limit: Maximum number of concurrent holders
+            background_limit: Maximum number of concurrent background holders
+        """
+        self.limit = limit
+        self.background_limit = max(1, min(background_limit, limit))
+        self.running = 0
+        self.background_running = 0
+        self._waiters: dict[UpdatePriority, deque] = {priority: deque() for priority in UpdatePriority}
+
+    @property
+    def waiting(self) -> dict:
+        """Number of waiters per priority class"""
+        return {priority.name.lower(): len(waiters) for priority, waiters in self._waiters.items()}
+
+    def _can_run(self, priority: UpdatePriority) -> bool:
+        if self.running >= self.limit:
+            return False
+        return priority not in BACKGROUND_PRIORITIES or self.background_running < self.background_limit
+
+    def _take(self, priority: UpdatePriority) -> None:
+        self.running += 1
+        if priority in BACKGROUND_PRIORITIES:
+            self.background_running += 1
+
+    def _has_waiters_before(self, priority: UpdatePriority) -> bool:
+        """Whether an eligible waiter of the same or higher priority is queued"""
+        return any(
+            self._waiters[waiting_priority] and self._can_run(waiting_priority)
+            for waiting_priority in UpdatePriority
+            if waiting_priority <= priority
+        )
+
+    def _wake_next(self) -> None:
+        """Hands free slots to waiters, highest priority first"""
+        for priority in UpdatePriority:
+            waiters = self._waiters[priority]
+            while waiters and self._can_run(priority):
+                waiter = waiters.popleft()
+                if waiter.done():
+                    continue
+                self._take(priority)
+                waiter.set_result(None)
+
+    async def acquire(self, priority: UpdatePriority) -> None:
+        """Waits for a run slot for the given priority class"""
+        if self._can_run(priority) and not self._has_waiters_before(priority):
+            self._take(priority)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted right before cancellation - give it back
+                self.release(priority)
+            else:
+                try:
+                    self._waiters[priority].remove(waiter)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self, priority: UpdatePriority) -> None:
+        """Returns a run slot"""
+        self.running -= 1
+        if priority in BACKGROUND_PRIORITIES:
+            self.background_running -= 1
+        self._wake_next()
+
+    @asynccontextmanager
+    async def slot(self, priority: UpdatePriority):
+        """Context manager holding a run slot"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release(priority)
+
+
+def get_ordering_key(update: object) -> Optional[str]:
+    """
+    Determines the key whose updates must be processed sequentially.
+
+    Args:
+        update: Object taken from the application's update queue
+
+    Returns:
+        Optional[str]: Chat identifier as used for sessions ("user:ID", "chat:ID",
+        "chat:ID:topic:N"), or None if the update has no ordering requirement
+    """
+    if not isinstance(update, Update):
+        return None
+
+    if update.effective_chat is not None:
+        if update.effective_chat.type == "private" and update.effective_user is None:
+            return f"chat:{update.effective_chat.id}"
+        return get_update_context(update).chat_identifier
+
+    if update.effective_user is not None:
+        # Inline queries, callback queries without a message, etc.
+        return f"user:{update.effective_user.id}"
+
+    return None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Update processor with bounded global concurrency and per-chat ordering.
+
+    Every update first takes the FIFO lock of its chat, so updates of one chat
+    run one after another in the order they were received. Only then does it
+    take a run slot, so a busy chat waiting on its own lock never occupies a
+    slot that another chat could use. Free slots go to addressed and private
+    updates before group context ingestion and service updates, which together
+    may hold at most ``background_share`` of the slots.
+
+    When an interrupting command arrives for a chat that already has updates in
+    flight, ``interrupt_callback(update, key)`` is started as a task right away,
+    so it can stop the running work; the command itself still waits its turn.
+
+    ``max_concurrent_updates`` of the base class bounds how many updates may be
+    pending (waiting or running) at once; ``max_running_updates`` bounds how many
+    actually execute handlers concurrently.
+    """
+
+    __slots__ = ("_max_running_updates", "_run_limiter", "_chat_locks", "_interrupt_callback", "_interrupt_tasks")
+
+    def __init__(self, max_running_updates: int, max_pending_updates: int, background_share: float = 1.0,
+                 interrupt_callback: Optional[Callable[[Update, str], Awaitable[Any]]] = None):
+        """
+        Args:
+            max_running_updates: Maximum number of updates executing handlers concurrently
+            max_pending_updates: Maximum number of updates accepted for processing at once
+            background_share: Share of run slots available to background updates (0-1]
+            interrupt_callback: Coroutine function called for interrupting commands of busy chats
+        """
+        super().__init__(max_concurrent_updates=max(max_pending_updates, max_running_updates))
+        if max_running_updates < 1:
+            raise ValueError("max_running_updates must be a positive integer")
+        self._max_running_updates = max_running_updates
+        self._run_limiter = PriorityLimiter(
+            max_running_updates, math.floor(max_running_updates * background_share)
+        )
+        # chat key -> [lock, number of updates holding or waiting for it]
+        self._chat_locks: dict[str, list] = {}
+        self._interrupt_callback = interrupt_callback
+        self._interrupt_tasks: set = set()
+
+    @property
+    def max_running_updates(self) -> int:
+        """Maximum number of updates executing handlers concurrently"""
+        return self._max_running_updates
+
+    @property
+    def active_chats(self) -> int:
+        """Number of chats with an update currently running or waiting"""
+        return len(self._chat_locks)
+
+    @property
+    def waiting_by_priority(self) -> dict:
+        """Number of updates waiting for a run slot, per priority class"""
+        return self._run_limiter.waiting
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        """
+        Runs the update after its chat's earlier updates, within the global run limit.
+
+        Args:
+            update: The update to be processed
+            coroutine: Coroutine that processes the update
+        """
+        try:
+            key = get_ordering_key(update)
+        except Exception as key_error:
+            logger.warning(f"[UpdateProcessor] Failed to determine ordering key: {key_error}")
+            key = None
+        try:
+            priority = get_update_priority(update)
+        except Exception as priority_error:
+            logger.warning(f"[UpdateProcessor] Failed to determine update priority: {priority_error}")
+            priority = UpdatePriority.MAINTENANCE
+
+        if key is None:
+            async with self._run_limiter.slot(priority):
+                await coroutine
+            return
+
+        if self._interrupt_callback is not None and key in self._chat_locks and is_interrupting_command(update):
+            self._start_interrupt(update, key)
+
+        # Acquiring the lock must follow arrival order: no await between taking the
+        # entry and calling acquire(), and asyncio.Lock wakes waiters in FIFO order
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._run_limiter.slot(priority):
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    def _start_interrupt(self, update: Update, key: str) -> None:
+        """Runs the interrupt callback as a task so the update keeps its place in the chat queue"""
+        async def interrupt():
+            try:
+                await self._interrupt_callback(update, key)
+            except Exception as interrupt_error:
+                logger.warning(f"[UpdateProcessor] Interrupt callback failed for {key}: {interrupt_error}")
+
+        task = asyncio.create_task(interrupt())
+        self._interrupt_tasks.add(task)
+        task.add_done_callback(self._interrupt_tasks.discard)
+
+    async def initialize(self) -> None:
+        """Nothing to allocate"""
+        logger.info(f"[UpdateProcessor] Concurrent update processing: up to {self.max_running_updates} "
+                    f"running ({self._run_limiter.background_limit} background), "
+                    f"{self.max_concurrent_updates} pending, ordered per chat")
+
+    async def shutdown(self) -> None:
+        """Nothing to free"""
@@ -0,0 +1,200 @@
+import time
+from datetime import date
+from typing import Optional
+from logger import logger
+import redis
+from config import REDIS_HOST, REDIS_PORT, REDIS_DB, DAILY_TOKEN_LIMIT_USER, DAILY_TOKEN_LIMIT_CHAT, QUOTA_CACHE_TTL_MS
+from fair_queue import tenant_for
+
+# Счетчики дневного расхода токенов в Redis (общие для всех процессов бота)
+redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+
+QUOTA_PREFIX = "quota:"
+
+# Счетчик живет чуть дольше суток, чтобы пережить смену даты
+COUNTER_TTL = 2 * 24 * 3600
+
+# Поднимает счетчик до значения из SQLite, но никогда не уменьшает его: инкременты,
+# еще не записанные в SQLite (буфер отложенной записи, другие процессы), не теряются.
+# Возвращает {итоговое значение, 1 если счетчик поднят}
+_RAISE_COUNTER = redis_client.register_script("""
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local total = tonumber(ARGV[1])
+if total > current then
+    redis.call('SET', KEYS[1], total, 'EX', ARGV[2])
+    return {total, 1}
+end
+return {current, 0}
+""")
+
+# Локальная копия счетчиков: ключ -> [значение, время чтения из Redis (monotonic)].
+# Проверка квоты читает только ее, к Redis обращается не чаще раза в QUOTA_CACHE_TTL_MS.
+_local_counters: dict[str, list] = {}
+_local_date: Optional[str] = None
+
+
+def _user_key(user_id: int, day: str) -> str:
+    """Ключ счетчика пользователя за день"""
+    return f"{QUOTA_PREFIX}user:{user_id}:{day}"
+
+
+def _chat_key(chat_identifier: str, day: str) -> str:
+    """Ключ счетчика чата за день (общий для всех топиков супергруппы)"""
+    return f"{QUOTA_PREFIX}{tenant_for(chat_identifier)}:{day}"
+
+
+def _today() -> str:
+    """Текущая дата (та же, что пишет user_analytics) и сброс локальных счетчиков при ее смене"""
+    global _local_date
+    today = date.today().isoformat()
+    if today != _local_date:
+        _local_counters.clear()
+        _local_date = today
+    return today
+
+
+def quotas_enabled() -> bool:
+    """Включен ли хотя бы один дневной лимит"""
+    return DAILY_TOKEN_LIMIT_USER > 0 or DAILY_TOKEN_LIMIT_CHAT > 0
+
+
+def _refresh_counters(keys: list[str]) -> None:
+    """Перечитывает устаревшие локальные счетчики из Redis одним MGET"""
+    now = time.monotonic()
+    stale_keys = [
+        key for key in keys
+        if key not in _local_counters or (now - _local_counters[key][1]) * 1000 >= QUOTA_CACHE_TTL_MS
+    ]
+    if not stale_keys:
+        return
+
+    try:
+        values = redis_client.mget(stale_keys)
+    except Exception as e:
+        # Redis недоступен - работаем по локальным значениям, не блокируя пользователей
+        logger.warning(f"[Quota] Failed to read counters from Redis: {e}")
+        for key in stale_keys:
+            _local_counters.setdefault(key, [0, now])[1] = now
+        return
+
+    for key, value in zip(stale_keys, values):
+        _local_counters[key] = [int(value or 0), now]
+
+
+def check_quota(user_id: int, chat_identifier: Optional[str] = None) -> Optional[dict]:
+    """
+    Проверяет дневные лимиты токенов пользователя и чата перед запуском запроса к OpenAI.
+    В общем случае читает только локальные счетчики; Redis опрашивается, когда они устарели.
+
+    Args:
+        user_id: ID пользователя Telegram
+        chat_identifier: Идентификатор чата ("user:ID", "chat:ID" или "chat:ID:topic:N")
+
+    Returns:
+        dict: Данные о превышенном лимите (scope, used, limit) или None если лимит не превышен
+    """
+    if not quotas_enabled():
+        return None
+
+    today = _today()
+    checks = []
+    if DAILY_TOKEN_LIMIT_USER > 0:
+        checks.append(("user", _user_key(user_id, today), DAILY_TOKEN_LIMIT_USER))
+    # Личный чат совпадает с пользователем, для него действует только пользовательский лимит
+    if DAILY_TOKEN_LIMIT_CHAT > 0 and chat_identifier and chat_identifier.startswith("chat:"):
+        checks.append(("chat", _chat_key(chat_identifier, today), DAILY_TOKEN_LIMIT_CHAT))
+
+    _refresh_counters([key for _, key, _ in checks])
+
+    for scope, key, limit in checks:
+        used = _local_counters[key][0]
+        if used >= limit:
+            logger.info(f"[Quota] Daily {scope} quota exceeded: user={user_id}, chat={chat_identifier}, "
+                        f"used={used}, limit={limit}")
+            return {"scope": scope, "used": used, "limit": limit}
+    return None
+
+
+def add_usage(user_id: int, chat_identifier: Optional[str], tokens_used: int, day: Optional[str] = None) -> None:
+    """
+    Увеличивает дневные счетчики пользователя и чата (вызывается из record_usage).
+
+    Args:
+        user_id: ID пользователя Telegram
+        chat_identifier: Идентификатор чата или None
+        tokens_used: Количество израсходованных токенов
+        day: Дата события в формате YYYY-MM-DD (по умолчанию - сегодня)
+    """
+    if not quotas_enabled() or tokens_used <= 0:
+        return
+
+    today = _today()
+    day = day or today
+    keys = [_user_key(user_id, day)]
+    if chat_identifier and chat_identifier.startswith("chat:"):
+        keys.append(_chat_key(chat_identifier, day))
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.incrby(key, tokens_used)
+            pipe.expire(key, COUNTER_TTL)
+        results = pipe.execute()
+    except Exception as e:
+        logger.warning(f"[Quota] Failed to increment counters for user {user_id}: {e}")
+        if day == today:
+            for key in keys:
+                counter = _local_counters.setdefault(key, [0, time.monotonic()])
+                counter[0] += tokens_used
+        return
+
+    if day == today:
+        # INCRBY вернул актуальное значение - локальная копия сразу становится свежей
+        now = time.monotonic()
+        for key, value in zip(keys, results[::2]):
+            _local_counters[key] = [int(value), now]
+
+
+def reconcile_counters(day: str, user_totals: dict[int, int], chat_totals: dict[str, int]) -> int:
+    """
+    Поднимает счетчики за день до данных SQLite, исправляя расхождения
+    после потери данных Redis или неудачных инкрементов.
+
+    Счетчики только увеличиваются: Redis получает расход в момент запроса, а SQLite
+    отстает на буфер отложенной записи, поэтому меньший счетчик Redis - потеря,
+    а больший - еще не записанный расход.
+
+    Args:
+        day: Дата в формате YYYY-MM-DD
+        user_totals: Расход токенов по пользователям за день
+        chat_totals: Расход токенов по групповым чатам за день
+
+    Returns:
+        int: Количество поднятых счетчиков
+    """
+    counters = {_user_key(user_id, day): tokens for user_id, tokens in user_totals.items()}
+    # Расход топиков складывается в общий счетчик чата
+    for chat_identifier, tokens in chat_totals.items():
+        if chat_identifier.startswith("chat:"):
+            key = _chat_key(chat_identifier, day)
+            counters[key] = counters.get(key, 0) + tokens
+    if not counters:
+        return 0
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key, tokens in counters.items():
+            _RAISE_COUNTER(keys=[key], args=[tokens, COUNTER_TTL], client=pipe)
+        results = pipe.execute()
+    except Exception as e:
+        logger.error(f"[Quota] Failed to reconcile counters for {day}: {e}")
+        return 0
+
+    if day == _today():
+        now = time.monotonic()
+        for key, (value, _) in zip(counters, results):
+            _local_counters[key] = [int(value), now]
+
+    raised = sum(int(was_raised) for _, was_raised in results)
+    logger.info(f"[Quota] Reconciled {len(counters)} counters for {day}, raised {raised}")
+    return raised
@@ -1,9 +1,20 @@
 import aiosqlite
+import asyncio
+import gzip
+import json
 import os
-from datetime import datetime, date
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime, date, timedelta, timezone
 from typing import List, Optional, Dict, Any
 from logger import logger
-from config import ANALYTICS_DB_PATH
+from usage_quota import add_usage as add_quota_usage
+from config import (
+    ANALYTICS_DB_PATH, ANALYTICS_BUSY_TIMEOUT_MS, ANALYTICS_CACHED_STATEMENTS, ANALYTICS_WRITE_BEHIND,
+    ANALYTICS_FLUSH_INTERVAL_MS, ANALYTICS_FLUSH_MAX_ROWS, ANALYTICS_MAX_BUFFERED_ROWS,
+    ANALYTICS_RETENTION_DAYS, ANALYTICS_ARCHIVE_DIR, ANALYTICS_ARCHIVE_BATCH_SIZE, ANALYTICS_VACUUM_PAGES
+)
 
 # DALL-E 3 Pricing Constants
 DALLE_PRICING = {
@@ -18,6 +29,24 @@ DALLE_TOKEN_EQUIVALENT = {
     "1024x1792": 800,        # $0.08 = 800 "tokens"
 }
 
+# Типы запросов для аналитики
+REQUEST_KIND_TEXT = "text"
+REQUEST_KIND_IMAGE = "image"
+REQUEST_KIND_DOCUMENT = "document"
+REQUEST_KIND_DALLE = "dalle"
+
+# Дополнительные колонки user_analytics с деталями запроса
+EVENT_DETAIL_COLUMNS = [
+    ("request_kind", "TEXT"),
+    ("chat_identifier", "TEXT"),
+    ("model", "TEXT"),
+    ("prompt_tokens", "INTEGER"),
+    ("completion_tokens", "INTEGER"),
+    ("queue_ms", "INTEGER"),   # от начала обработки апдейта до запуска run (подготовка, загрузки, ожидание)
+    ("run_ms", "INTEGER"),     # выполнение run/генерации на стороне OpenAI
+    ("send_ms", "INTEGER"),    # отправка ответа в Telegram
+]
+
 
 class UserAnalytics:
     """
@@ -38,12 +67,65 @@ class UserAnalytics:
         if db_dir:  # Проверяем, что директория не пустая
             os.makedirs(db_dir, exist_ok=True)
         
+        # Долгоживущее соединение: открывается в init_database (или при первом запросе)
+        # и закрывается в close(). sqlite3 кеширует подготовленные выражения на уровне
+        # соединения, поэтому одинаковые SQL-запросы не компилируются повторно.
+        self._db: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        # Записи сериализуются, чтобы commit одной корутины не захватил чужую транзакцию
+        self._write_lock = asyncio.Lock()
+        
+        # Буфер отложенной записи (write-behind), сбрасывается фоновой задачей
+        self._buffer: List[tuple] = []
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_stopping = False
+    
+    async def _get_connection(self) -> aiosqlite.Connection:
+        """
+        Возвращает общее соединение с базой данных, открывая его при необходимости.
+        Включает WAL, чтобы запись из бота и чтение из view_analytics.py не блокировали друг друга,
+        и synchronous=NORMAL, при котором fsync выполняется на checkpoint, а не на каждый commit.
+        """
+        if self._db is not None:
+            return self._db
+        
+        async with self._connect_lock:
+            if self._db is None:
+                db = await aiosqlite.connect(self.db_path, cached_statements=ANALYTICS_CACHED_STATEMENTS)
+                # Для новой базы включает инкрементальный auto-vacuum (должно идти до создания таблиц);
+                # существующую базу переводит только VACUUM, см. enable_incremental_vacuum()
+                await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                await db.execute("PRAGMA journal_mode=WAL")
+                await db.execute("PRAGMA synchronous=NORMAL")
+                await db.execute(f"PRAGMA busy_timeout={ANALYTICS_BUSY_TIMEOUT_MS}")
+                self._db = db
+                logger.debug(f"User analytics connection opened at {self.db_path}")
+        return self._db
+    
+    @asynccontextmanager
+    async def _connection(self):
+        """Контекст для чтения через общее соединение."""
+        yield await self._get_connection()
+    
+    @asynccontextmanager
+    async def _transaction(self):
+        """Контекст для записи: общее соединение под блокировкой записи."""
+        db = await self._get_connection()
+        async with self._write_lock:
+            try:
+                yield db
+            except BaseException:
+                # Не оставляем открытую транзакцию в общем соединении (в том числе при отмене)
+                await db.rollback()
+                raise
+        
     async def init_database(self) -> None:
         """
         Инициализация базы данных и создание таблиц.
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._transaction() as db:
                 # Создание таблицы для аналитики пользователей
                 await db.execute("""
                     CREATE TABLE IF NOT EXISTS user_analytics (
@@ -72,14 +154,68 @@ class UserAnalytics:
                     ON user_analytics(user_id, request_date)
                 """)
                 
+                # Детализация запросов: тип, чат, модель, разбивка токенов и задержки.
+                # Колонки добавляются к существующей таблице, старые строки остаются с NULL.
+                cursor = await db.execute("PRAGMA table_info(user_analytics)")
+                existing_columns = {row[1] for row in await cursor.fetchall()}
+                for column_name, column_type in EVENT_DETAIL_COLUMNS:
+                    if column_name not in existing_columns:
+                        await db.execute(f"ALTER TABLE user_analytics ADD COLUMN {column_name} {column_type}")
+                
+                # Сводные таблицы, обновляемые при записи: по (пользователь, дата) и по дате.
+                # Отчеты читают их вместо полного сканирования user_analytics.
+                await db.execute("""
+                    CREATE TABLE IF NOT EXISTS user_daily_usage (
+                        user_id INTEGER NOT NULL,
+                        request_date DATE NOT NULL,
+                        username TEXT,
+                        tokens_used INTEGER NOT NULL DEFAULT 0,
+                        requests_count INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY (user_id, request_date)
+                    )
+                """)
+                
+                await db.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_user_daily_usage_date 
+                    ON user_daily_usage(request_date)
+                """)
+                
+                await db.execute("""
+                    CREATE TABLE IF NOT EXISTS daily_usage (
+                        request_date DATE PRIMARY KEY,
+                        unique_users INTEGER NOT NULL DEFAULT 0,
+                        requests_count INTEGER NOT NULL DEFAULT 0,
+                        tokens_used INTEGER NOT NULL DEFAULT 0
+                    )
+                """)
+                
                 await db.commit()
                 logger.info(f"User analytics database initialized at {self.db_path}")
                 
+                # Первичное заполнение сводных таблиц для уже существующих данных
+                cursor = await db.execute("""
+                    SELECT EXISTS(SELECT 1 FROM user_analytics), EXISTS(SELECT 1 FROM user_daily_usage)
+                """)
+                has_events, has_rollups = await cursor.fetchone()
+                if has_events and not has_rollups:
+                    await self._rebuild_rollups(db)
+                
+                cursor = await db.execute("PRAGMA auto_vacuum")
+                if (await cursor.fetchone())[0] != 2:
+                    logger.warning("User analytics database is not in incremental auto-vacuum mode, "
+                                   "freed space will not be reclaimed; run 'python view_analytics.py vacuum' once")
+                
         except Exception as e:
             logger.error(f"Error initializing user analytics database: {e}")
             raise
+        
+        if ANALYTICS_WRITE_BEHIND:
+            self.start_write_behind()
     
-    async def record_usage(self, user_id: int, username: str, tokens_used: int) -> None:
+    async def record_usage(self, user_id: int, username: str, tokens_used: int,
+                           request_kind: str = None, chat_identifier: str = None, model: str = None,
+                           prompt_tokens: int = None, completion_tokens: int = None,
+                           queue_ms: int = None, run_ms: int = None, send_ms: int = None) -> None:
         """
         Записывает использование токенов пользователем.
         
@@ -87,6 +223,14 @@ class UserAnalytics:
             user_id: Telegram ID пользователя
             username: Имя пользователя или никнейм
             tokens_used: Количество использованных токенов
+            request_kind: Тип запроса (text/image/document/dalle)
+            chat_identifier: Идентификатор чата ("user:ID", "chat:ID" или "chat:ID:topic:N")
+            model: Модель OpenAI, выполнившая запрос
+            prompt_tokens: Токены запроса
+            completion_tokens: Токены ответа
+            queue_ms: Время от начала обработки до запуска run, мс
+            run_ms: Время выполнения run, мс
+            send_ms: Время отправки ответа в Telegram, мс
         """
         if not isinstance(user_id, int) or user_id <= 0:
             logger.warning(f"Invalid user_id: {user_id}")
@@ -100,24 +244,338 @@ class UserAnalytics:
         if username and len(username) > 100:
             username = username[:100]
             
+        current_date = date.today().isoformat()
+        # created_at фиксируем в момент события (UTC, как CURRENT_TIMESTAMP), а не в момент сброса буфера
+        created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        row = (user_id, username, current_date, tokens_used, created_at,
+               request_kind, chat_identifier, model, prompt_tokens, completion_tokens,
+               queue_ms, run_ms, send_ms)
+        
+        # Счетчики дневных квот обновляются сразу, не дожидаясь записи в SQLite
+        add_quota_usage(user_id, chat_identifier, tokens_used, current_date)
+        
+        if self._flush_task is not None and not self._flush_task.done():
+            # Отложенная запись: событие попадает в буфер, ответ пользователю не ждет fsync
+            self._buffer.append(row)
+            if len(self._buffer) >= ANALYTICS_FLUSH_MAX_ROWS:
+                self._flush_event.set()
+            logger.debug(f"Buffered usage: user_id={user_id}, username={username}, "
+                         f"date={current_date}, tokens={tokens_used}")
+            return
+        
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                current_date = date.today().isoformat()
-                
-                await db.execute("""
-                    INSERT INTO user_analytics 
-                    (user_id, username, request_date, tokens_used) 
-                    VALUES (?, ?, ?, ?)
-                """, (user_id, username, current_date, tokens_used))
-                
-                await db.commit()
-                
-                logger.debug(f"Recorded usage: user_id={user_id}, username={username}, "
-                           f"date={current_date}, tokens={tokens_used}")
+            await self._write_rows([row])
+            logger.debug(f"Recorded usage: user_id={user_id}, username={username}, "
+                       f"date={current_date}, tokens={tokens_used}")
                            
         except Exception as e:
             logger.error(f"Error recording usage for user {user_id}: {e}")
     
+    async def _write_rows(self, rows: List[tuple]) -> None:
+        """
+        Записывает пачку событий одной транзакцией.
+        
+        Args:
+            rows: Кортежи (user_id, username, request_date, tokens_used, created_at, *EVENT_DETAIL_COLUMNS)
+        """
+        # Агрегируем пачку в памяти, чтобы обновить сводные таблицы одним UPSERT на ключ
+        user_totals: Dict[tuple, list] = {}
+        dates = set()
+        for user_id, username, request_date, tokens_used, *_ in rows:
+            totals = user_totals.setdefault((user_id, request_date), [username, 0, 0])
+            totals[0] = username or totals[0]
+            totals[1] += tokens_used
+            totals[2] += 1
+            dates.add(request_date)
+        
+        async with self._transaction() as db:
+            await db.executemany("""
+                INSERT INTO user_analytics 
+                (user_id, username, request_date, tokens_used, created_at,
+                 request_kind, chat_identifier, model, prompt_tokens, completion_tokens,
+                 queue_ms, run_ms, send_ms) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            
+            await db.executemany("""
+                INSERT INTO user_daily_usage 
+                (user_id, request_date, username, tokens_used, requests_count) 
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, request_date) DO UPDATE SET
+                    username = COALESCE(excluded.username, username),
+                    tokens_used = tokens_used + excluded.tokens_used,
+                    requests_count = requests_count + excluded.requests_count
+            """, [
+                (user_id, request_date, username, tokens_used, requests_count)
+                for (user_id, request_date), (username, tokens_used, requests_count) in user_totals.items()
+            ])
+            
+            await self._refresh_daily_usage(db, dates)
+            
+            await db.commit()
+    
+    async def _refresh_daily_usage(self, db: aiosqlite.Connection, dates) -> None:
+        """
+        Пересчитывает строки daily_usage для указанных дат из user_daily_usage.
+        Стоимость - O(пользователей за день), а не O(событий).
+        """
+        await db.executemany("""
+            INSERT OR REPLACE INTO daily_usage 
+            (request_date, unique_users, requests_count, tokens_used)
+            SELECT request_date, COUNT(*), SUM(requests_count), SUM(tokens_used)
+            FROM user_daily_usage
+            WHERE request_date = ?
+            GROUP BY request_date
+        """, [(request_date,) for request_date in dates])
+    
+    async def _rebuild_rollups(self, db: aiosqlite.Connection) -> int:
+        """
+        Пересобирает сводные таблицы из user_analytics для дат, по которым есть сырые события.
+        Даты, сырые события которых уже удалены, не затрагиваются.
+        
+        Returns:
+            Количество пересчитанных строк user_daily_usage
+        """
+        await db.execute("""
+            DELETE FROM user_daily_usage 
+            WHERE request_date IN (SELECT DISTINCT request_date FROM user_analytics)
+        """)
+        
+        # username берется из последней записи пользователя за день (строка с MAX(id))
+        cursor = await db.execute("""
+            INSERT INTO user_daily_usage 
+            (user_id, request_date, username, tokens_used, requests_count)
+            SELECT user_id, request_date, username, tokens_used, requests_count
+            FROM (
+                SELECT user_id, request_date, username, MAX(id),
+                       SUM(tokens_used) as tokens_used, COUNT(*) as requests_count
+                FROM user_analytics
+                GROUP BY user_id, request_date
+            )
+        """)
+        rebuilt_rows = cursor.rowcount
+        
+        await db.execute("""
+            DELETE FROM daily_usage 
+            WHERE request_date IN (SELECT DISTINCT request_date FROM user_daily_usage)
+        """)
+        await db.execute("""
+            INSERT INTO daily_usage 
+            (request_date, unique_users, requests_count, tokens_used)
+            SELECT request_date, COUNT(*), SUM(requests_count), SUM(tokens_used)
+            FROM user_daily_usage
+            GROUP BY request_date
+        """)
+        
+        await db.commit()
+        logger.info(f"User analytics rollups rebuilt: {rebuilt_rows} user-day rows")
+        return rebuilt_rows
+    
+    async def backfill_rollups(self) -> int:
+        """
+        Заполняет сводные таблицы по существующим сырым событиям.
+        Используется для данных, записанных до появления сводных таблиц.
+        
+        Returns:
+            Количество пересчитанных строк user_daily_usage
+        """
+        await self.flush()
+        async with self._transaction() as db:
+            return await self._rebuild_rollups(db)
+    
+    def _archive_path(self, month: str) -> str:
+        """Путь к сжатому архиву сырых событий за месяц (YYYY-MM)."""
+        return os.path.join(ANALYTICS_ARCHIVE_DIR, f"user_analytics-{month}.jsonl.gz")
+    
+    def _append_to_archives(self, rows_by_month: Dict[str, List[dict]]) -> None:
+        """
+        Дописывает события в помесячные архивы (блокирующий ввод-вывод, вызывается через to_thread).
+        Каждая дозапись - отдельный gzip-member, файл читается целиком через gzip.open.
+        """
+        os.makedirs(ANALYTICS_ARCHIVE_DIR, exist_ok=True)
+        for month, month_rows in rows_by_month.items():
+            with gzip.open(self._archive_path(month), "at", encoding="utf-8") as archive:
+                for row in month_rows:
+                    archive.write(json.dumps(row, ensure_ascii=False) + "\n")
+                archive.flush()
+                os.fsync(archive.fileno())
+    
+    async def archive_old_events(self, retention_days: int = None) -> int:
+        """
+        Переносит сырые события старше retention_days дней в сжатые помесячные архивы
+        и удаляет их из user_analytics. Сводные таблицы не затрагиваются, поэтому отчеты
+        по дням и пользователям за архивный период продолжают работать.
+        
+        Строки сначала дописываются в архив и только потом удаляются, пачками по
+        ANALYTICS_ARCHIVE_BATCH_SIZE, чтобы не держать блокировку записи надолго.
+        При сбое между этими шагами пачка может попасть в архив повторно, но не потеряется.
+        
+        Args:
+            retention_days: Сколько дней хранить сырые события (по умолчанию ANALYTICS_RETENTION_DAYS)
+            
+        Returns:
+            Количество перенесенных в архив событий
+        """
+        retention_days = ANALYTICS_RETENTION_DAYS if retention_days is None else retention_days
+        if retention_days <= 0:
+            return 0
+        
+        cutoff_date = (date.today() - timedelta(days=retention_days)).isoformat()
+        archived = 0
+        last_id = 0
+        
+        while True:
+            async with self._connection() as db:
+                cursor = await db.execute("""
+                    SELECT * FROM user_analytics 
+                    WHERE id > ? AND request_date < ?
+                    ORDER BY id
+                    LIMIT ?
+                """, (last_id, cutoff_date, ANALYTICS_ARCHIVE_BATCH_SIZE))
+                columns = [column[0] for column in cursor.description]
+                rows = await cursor.fetchall()
+            
+            if not rows:
+                break
+            
+            rows_by_month: Dict[str, List[dict]] = {}
+            for row in rows:
+                event = dict(zip(columns, row))
+                rows_by_month.setdefault(str(event["request_date"])[:7], []).append(event)
+            await asyncio.to_thread(self._append_to_archives, rows_by_month)
+            
+            first_id, last_id = rows[0][0], rows[-1][0]
+            async with self._transaction() as db:
+                # Диапазон по первичному ключу покрывает ровно выбранные строки
+                await db.execute("""
+                    DELETE FROM user_analytics 
+                    WHERE id BETWEEN ? AND ? AND request_date < ?
+                """, (first_id, last_id, cutoff_date))
+                await db.commit()
+            
+            archived += len(rows)
+            # Отдаем управление обработчикам между пачками
+            await asyncio.sleep(0)
+        
+        if archived:
+            logger.info(f"Archived {archived} usage events older than {cutoff_date} to {ANALYTICS_ARCHIVE_DIR}")
+        return archived
+    
+    async def incremental_vacuum(self, pages_per_step: int = None) -> int:
+        """
+        Возвращает свободные страницы файлу базы небольшими шагами через PRAGMA incremental_vacuum,
+        не блокируя базу на время полного VACUUM.
+        
+        Args:
+            pages_per_step: Страниц за один шаг (по умолчанию ANALYTICS_VACUUM_PAGES)
+            
+        Returns:
+            Количество освобожденных страниц
+        """
+        pages_per_step = pages_per_step or ANALYTICS_VACUUM_PAGES
+        async with self._connection() as db:
+            cursor = await db.execute("PRAGMA auto_vacuum")
+            if (await cursor.fetchone())[0] != 2:
+                return 0
+            cursor = await db.execute("PRAGMA freelist_count")
+            initial_free_pages = (await cursor.fetchone())[0]
+        
+        free_pages = initial_free_pages
+        while free_pages > 0:
+            async with self._transaction() as db:
+                cursor = await db.execute(f"PRAGMA incremental_vacuum({pages_per_step})")
+                await cursor.fetchall()
+                await db.commit()
+                cursor = await db.execute("PRAGMA freelist_count")
+                remaining = (await cursor.fetchone())[0]
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
+            await asyncio.sleep(0)
+        
+        reclaimed = initial_free_pages - free_pages
+        if reclaimed:
+            logger.info(f"User analytics incremental vacuum reclaimed {reclaimed} pages")
+        return reclaimed
+    
+    async def run_retention(self, retention_days: int = None) -> Dict[str, int]:
+        """
+        Применяет политику хранения: архивирует старые события и возвращает место на диске.
+        
+        Returns:
+            Словарь с количеством перенесенных событий и освобожденных страниц
+        """
+        archived = await self.archive_old_events(retention_days)
+        reclaimed_pages = await self.incremental_vacuum()
+        return {"archived_events": archived, "reclaimed_pages": reclaimed_pages}
+    
+    async def enable_incremental_vacuum(self) -> bool:
+        """
+        Переводит существующую базу в режим auto_vacuum=INCREMENTAL.
+        Требует однократного полного VACUUM, который блокирует базу, поэтому
+        выполняется вручную (python view_analytics.py vacuum), а не по расписанию.
+        
+        Returns:
+            True если режим включен
+        """
+        await self.flush()
+        async with self._transaction() as db:
+            await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await db.execute("VACUUM")
+            cursor = await db.execute("PRAGMA auto_vacuum")
+            enabled = (await cursor.fetchone())[0] == 2
+        logger.info(f"User analytics incremental auto-vacuum enabled: {enabled}")
+        return enabled
+    
+    def start_write_behind(self) -> None:
+        """
+        Запускает фоновую задачу отложенной записи.
+        Должна вызываться из работающего event loop.
+        """
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        self._flush_event = asyncio.Event()
+        self._flush_stopping = False
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"User analytics write-behind started: every {ANALYTICS_FLUSH_INTERVAL_MS} ms "
+                    f"or {ANALYTICS_FLUSH_MAX_ROWS} rows")
+    
+    async def _flush_loop(self) -> None:
+        """Сбрасывает буфер каждые ANALYTICS_FLUSH_INTERVAL_MS мс или при накоплении ANALYTICS_FLUSH_MAX_ROWS строк."""
+        interval = ANALYTICS_FLUSH_INTERVAL_MS / 1000
+        while not self._flush_stopping:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+    
+    async def flush(self) -> int:
+        """
+        Записывает все накопленные в буфере события в базу данных.
+        
+        Returns:
+            Количество записанных событий
+        """
+        if not self._buffer:
+            return 0
+        
+        rows, self._buffer = self._buffer, []
+        try:
+            await self._write_rows(rows)
+            logger.debug(f"Flushed {len(rows)} usage events")
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Error flushing {len(rows)} usage events: {e}")
+            # Возвращаем события в буфер для следующей попытки, не допуская неограниченного роста
+            self._buffer = (rows + self._buffer)[-ANALYTICS_MAX_BUFFERED_ROWS:]
+            return 0
+        except BaseException:
+            # Отмена посреди записи: транзакция откатана, события остаются в буфере
+            self._buffer = (rows + self._buffer)[-ANALYTICS_MAX_BUFFERED_ROWS:]
+            raise
+    
     async def get_user_daily_usage(self, user_id: int, target_date: str) -> int:
         """
         Получает общое количество токенов, использованных пользователем за день.
@@ -130,10 +588,10 @@ class UserAnalytics:
             Общее количество токенов за день
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._connection() as db:
                 cursor = await db.execute("""
-                    SELECT SUM(tokens_used) as total_tokens
-                    FROM user_analytics 
+                    SELECT tokens_used
+                    FROM user_daily_usage 
                     WHERE user_id = ? AND request_date = ?
                 """, (user_id, target_date))
                 
@@ -155,10 +613,10 @@ class UserAnalytics:
             Общее количество токенов
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._connection() as db:
                 cursor = await db.execute("""
                     SELECT SUM(tokens_used) as total_tokens
-                    FROM user_analytics 
+                    FROM user_daily_usage 
                     WHERE user_id = ?
                 """, (user_id,))
                 
@@ -180,12 +638,11 @@ class UserAnalytics:
             Список словарей с данными о пользователях и их использовании
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._connection() as db:
                 cursor = await db.execute("""
-                    SELECT user_id, username, SUM(tokens_used) as total_tokens
-                    FROM user_analytics 
+                    SELECT user_id, username, tokens_used as total_tokens
+                    FROM user_daily_usage 
                     WHERE request_date = ?
-                    GROUP BY user_id, username
                     ORDER BY total_tokens DESC
                 """, (target_date,))
                 
@@ -204,6 +661,31 @@ class UserAnalytics:
             logger.error(f"Error getting usage by date {target_date}: {e}")
             return []
     
+    async def get_chat_usage_by_date(self, target_date: str) -> Dict[str, int]:
+        """
+        Получает расход токенов по чатам за определенную дату.
+        
+        Args:
+            target_date: Дата в формате YYYY-MM-DD
+            
+        Returns:
+            Словарь {chat_identifier: количество токенов}
+        """
+        try:
+            async with self._connection() as db:
+                cursor = await db.execute("""
+                    SELECT chat_identifier, SUM(tokens_used)
+                    FROM user_analytics 
+                    WHERE request_date = ? AND chat_identifier IS NOT NULL
+                    GROUP BY chat_identifier
+                """, (target_date,))
+                
+                return {row[0]: row[1] for row in await cursor.fetchall()}
+                
+        except Exception as e:
+            logger.error(f"Error getting chat usage by date {target_date}: {e}")
+            return {}
+    
     async def get_user_usage_stats(self, user_id: int, days: int = 7) -> Dict[str, Any]:
         """
         Получает статистику использования пользователя за последние N дней.
@@ -216,15 +698,14 @@ class UserAnalytics:
             Словарь со статистикой пользователя
         """
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._connection() as db:
                 cursor = await db.execute("""
                     SELECT 
                         request_date,
-                        SUM(tokens_used) as daily_tokens
-                    FROM user_analytics 
+                        tokens_used as daily_tokens
+                    FROM user_daily_usage 
                     WHERE user_id = ? 
                     AND request_date >= date('now', '-{} days')
-                    GROUP BY request_date
                     ORDER BY request_date DESC
                 """.format(days), (user_id,))
                 
@@ -247,8 +728,39 @@ class UserAnalytics:
             logger.error(f"Error getting usage stats for user {user_id}: {e}")
             return {"user_id": user_id, "total_tokens": 0, "daily_usage": [], "days_analyzed": days}
     
-    async def record_image_generation(self, user_id: int, username: str, 
-                                     size: str = "1024x1024", model: str = "dall-e-3") -> None:
+    async def get_recent_active_users(self, days: int = 3, limit: int = 5000) -> List[int]:
+        """
+        Получает ID пользователей, которые пользовались ботом за последние N дней.
+        Самые недавно активные идут первыми.
+
+        Args:
+            days: Количество дней для анализа
+            limit: Максимальное количество пользователей
+
+        Returns:
+            Список Telegram ID пользователей
+        """
+        try:
+            async with self._connection() as db:
+                cursor = await db.execute("""
+                    SELECT user_id, MAX(request_date) as last_date
+                    FROM user_daily_usage
+                    WHERE request_date >= date('now', ?)
+                    GROUP BY user_id
+                    ORDER BY last_date DESC
+                    LIMIT ?
+                """, (f"-{int(days)} days", limit))
+
+                results = await cursor.fetchall()
+                return [row[0] for row in results]
+
+        except Exception as e:
+            logger.error(f"Error getting recently active users: {e}")
+            return []
+
+    async def record_image_generation(self, user_id: int, username: str,
+                                     size: str = "1024x1024", model: str = "dall-e-3",
+                                     run_ms: int = None) -> None:
         """
         Records image generation usage in analytics.
         
@@ -257,12 +769,14 @@ class UserAnalytics:
             username: Username or display name
             size: Image size (e.g., "1024x1024")
             model: AI model used for generation
+            run_ms: Generation time in milliseconds
         """
         cost = DALLE_PRICING.get(size, 0.040)
         # Convert to "tokens" for consistency with existing system
         equivalent_tokens = DALLE_TOKEN_EQUIVALENT.get(size, 400)
         
-        await self.record_usage(user_id, username, equivalent_tokens)
+        await self.record_usage(user_id, username, equivalent_tokens,
+                                request_kind=REQUEST_KIND_DALLE, model=model, run_ms=run_ms)
         
         logger.info(f"Recorded image generation: user={user_id}, cost=${cost}, tokens={equivalent_tokens}")
 
@@ -284,10 +798,159 @@ class UserAnalytics:
     async def close(self) -> None:
         """
         Закрытие соединения с базой данных.
-        В случае aiosqlite это не критично, но добавлено для совместимости.
+        Останавливает отложенную запись и сбрасывает оставшиеся в буфере события.
         """
+        if self._flush_task is not None:
+            # Цикл не отменяется, а завершается после текущего сброса, чтобы не прервать запись
+            self._flush_stopping = True
+            self._flush_event.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        
+        async with self._connect_lock:
+            if self._db is not None:
+                async with self._write_lock:
+                    await self._db.close()
+                self._db = None
         logger.debug("User analytics connection closed")
 
 
 # Глобальный экземпляр для использования в приложении
-analytics = UserAnalytics() 
\ No newline at end of file
+analytics = UserAnalytics()
+
+
+class RequestTrace:
+    """
+    Расход токенов и задержки одного запроса пользователя на пути ответа.
+    
+    Обработчик начинает трассировку, openai_handler заполняет время run и расход токенов,
+    а обработчик записывает ее после отправки ответа в Telegram - так одна строка
+    аналитики содержит время ожидания, выполнения run и отправки.
+    """
+    
+    def __init__(self, request_kind: str, user_id: int, username: str = None, chat_identifier: str = None):
+        self.request_kind = request_kind
+        self.user_id = user_id
+        self.username = username
+        self.chat_identifier = chat_identifier
+        self.started_at = time.monotonic()
+        self.run_started_at: Optional[float] = None
+        self.run_finished_at: Optional[float] = None
+        self.send_ms: Optional[int] = None
+        self.model: Optional[str] = None
+        self.tokens_used: Optional[int] = None
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens: Optional[int] = None
+        self.spans: Dict[str, float] = {}
+        self._token = None
+    
+    def mark_run_started(self) -> None:
+        """Отмечает момент запуска run OpenAI (или генерации изображения)."""
+        self.run_started_at = time.monotonic()
+    
+    def mark_run_finished(self) -> None:
+        """Отмечает момент, когда run OpenAI перешел в конечный статус."""
+        self.run_finished_at = time.monotonic()
+    
+    def mark_sent(self, send_started_at: float) -> None:
+        """Запоминает время отправки в Telegram, отсчитанное от send_started_at (time.monotonic())."""
+        self.send_ms = int((time.monotonic() - send_started_at) * 1000)
+    
+    @contextmanager
+    def span(self, name: str):
+        """Замеряет шаг пути ответа; длительности хранятся в self.spans (секунды)."""
+        span_started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans[name] = time.monotonic() - span_started_at
+    
+    def log_overlap(self, names: tuple, since: float) -> None:
+        """
+        Пишет в лог, насколько параллельные шаги сократили критический путь.
+        
+        Args:
+            names: Шаги, выполнявшиеся одновременно
+            since: Момент запуска шагов (time.monotonic())
+        """
+        durations = [self.spans[name] for name in names if name in self.spans]
+        if len(durations) != len(names):
+            return
+        critical_ms = int((time.monotonic() - since) * 1000)
+        sequential_ms = int(sum(durations) * 1000)
+        steps = ", ".join(f"{name} {int(self.spans[name] * 1000)}ms" for name in names)
+        logger.info(f"[Timing] {self.request_kind} {self.chat_identifier}: {steps}; "
+                    f"critical path {critical_ms}ms instead of {sequential_ms}ms "
+                    f"(saved {max(0, sequential_ms - critical_ms)}ms)")
+    
+    def set_usage(self, tokens_used: int, model: str = None,
+                  prompt_tokens: int = None, completion_tokens: int = None) -> None:
+        """Запоминает расход токенов run; он записывается при завершении трассировки."""
+        self.tokens_used = tokens_used
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+    
+    @property
+    def queue_ms(self) -> Optional[int]:
+        if self.run_started_at is None:
+            return None
+        return int((self.run_started_at - self.started_at) * 1000)
+    
+    @property
+    def run_ms(self) -> Optional[int]:
+        if self.run_started_at is None or self.run_finished_at is None:
+            return None
+        return int((self.run_finished_at - self.run_started_at) * 1000)
+    
+    async def finish(self) -> None:
+        """Отвязывает трассировку от текущего контекста и записывает ее, если run сообщил расход."""
+        if self._token is not None:
+            _current_trace.reset(self._token)
+            self._token = None
+        
+        if self.tokens_used is None:
+            return
+        
+        await analytics.record_usage(
+            self.user_id, self.username, self.tokens_used,
+            request_kind=self.request_kind,
+            chat_identifier=self.chat_identifier,
+            model=self.model,
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.completion_tokens,
+            queue_ms=self.queue_ms,
+            run_ms=self.run_ms,
+            send_ms=self.send_ms
+        )
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("request_trace", default=None)
+
+
+def start_request_trace(request_kind: str, user_id: int, username: str = None,
+                        chat_identifier: str = None) -> RequestTrace:
+    """
+    Начинает трассировку запроса и делает ее текущей для вызывающей корутины.
+    Вызывающий обязан дождаться trace.finish() после доставки ответа (или ошибки).
+    """
+    trace = RequestTrace(request_kind, user_id, username, chat_identifier)
+    trace._token = _current_trace.set(trace)
+    return trace
+
+
+def get_request_trace() -> Optional[RequestTrace]:
+    """Возвращает трассировку запроса текущего контекста, если она есть."""
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_span(name: str):
+    """RequestTrace.span() текущей трассировки; вне запроса ничего не делает."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name):
+        yield 
\ No newline at end of file
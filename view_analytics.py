@@ -4,11 +4,50 @@
 Показывает данные из базы данных user_analytics.db.
 """
 
+import argparse
 import asyncio
+import csv
+import json
 import sys
 from datetime import date, timedelta
 from user_analytics import analytics
 
+# Наборы данных для экспорта: таблица, колонки с типами (для Parquet) и поддержка фильтра по пользователю
+EXPORT_DATASETS = {
+    "events": {
+        "table": "user_analytics",
+        "columns": [
+            ("id", "int"), ("user_id", "int"), ("username", "str"), ("request_date", "str"),
+            ("tokens_used", "int"), ("created_at", "str"), ("request_kind", "str"),
+            ("chat_identifier", "str"), ("model", "str"), ("prompt_tokens", "int"),
+            ("completion_tokens", "int"), ("queue_ms", "int"), ("run_ms", "int"), ("send_ms", "int"),
+        ],
+        "order_by": "id",
+        "has_user": True,
+    },
+    "user-daily": {
+        "table": "user_daily_usage",
+        "columns": [
+            ("user_id", "int"), ("request_date", "str"), ("username", "str"),
+            ("tokens_used", "int"), ("requests_count", "int"),
+        ],
+        "order_by": "request_date, user_id",
+        "has_user": True,
+    },
+    "daily": {
+        "table": "daily_usage",
+        "columns": [
+            ("request_date", "str"), ("unique_users", "int"),
+            ("requests_count", "int"), ("tokens_used", "int"),
+        ],
+        "order_by": "request_date",
+        "has_user": False,
+    },
+}
+
+# Сколько строк читается из курсора и пишется в файл за один шаг
+EXPORT_CHUNK_SIZE = 5000
+
 
 async def show_all_data():
     """Показывает все записи в базе данных."""
@@ -47,17 +86,20 @@ async def show_user_stats():
     try:
         import aiosqlite
         async with aiosqlite.connect(analytics.db_path) as db:
-            # Общая статистика по пользователям
+            # Общая статистика по пользователям (из сводной таблицы по дням;
+            # username берется из последнего дня активности)
             cursor = await db.execute("""
                 SELECT 
                     user_id, 
-                    username,
+                    (SELECT u2.username FROM user_daily_usage u2
+                     WHERE u2.user_id = user_daily_usage.user_id
+                     ORDER BY u2.request_date DESC LIMIT 1) as username,
                     SUM(tokens_used) as total_tokens,
-                    COUNT(*) as requests_count,
+                    SUM(requests_count) as requests_count,
                     MIN(request_date) as first_date,
                     MAX(request_date) as last_date
-                FROM user_analytics 
-                GROUP BY user_id, username
+                FROM user_daily_usage 
+                GROUP BY user_id
                 ORDER BY total_tokens DESC
             """)
             
@@ -89,12 +131,11 @@ async def show_daily_stats():
             cursor = await db.execute("""
                 SELECT 
                     request_date,
-                    COUNT(DISTINCT user_id) as unique_users,
-                    COUNT(*) as total_requests,
-                    SUM(tokens_used) as total_tokens,
-                    AVG(tokens_used) as avg_tokens
-                FROM user_analytics 
-                GROUP BY request_date
+                    unique_users,
+                    requests_count as total_requests,
+                    tokens_used as total_tokens,
+                    CAST(tokens_used AS REAL) / NULLIF(requests_count, 0) as avg_tokens
+                FROM daily_usage 
                 ORDER BY request_date DESC
                 LIMIT 30
             """)
@@ -119,6 +160,98 @@ async def show_daily_stats():
         print(f"❌ Ошибка при получении дневной статистики: {e}")
 
 
+async def show_request_stats(days: int = 7):
+    """Показывает стоимость и задержки по типам запросов и по чатам."""
+    try:
+        import aiosqlite
+        async with aiosqlite.connect(analytics.db_path) as db:
+            cursor = await db.execute("""
+                SELECT 
+                    COALESCE(request_kind, 'unknown') as kind,
+                    COUNT(*) as requests,
+                    SUM(tokens_used) as total_tokens,
+                    SUM(prompt_tokens) as prompt_tokens,
+                    SUM(completion_tokens) as completion_tokens,
+                    AVG(queue_ms) as avg_queue_ms,
+                    AVG(run_ms) as avg_run_ms,
+                    AVG(send_ms) as avg_send_ms
+                FROM user_analytics 
+                WHERE request_date >= date('now', ?)
+                GROUP BY kind
+                ORDER BY total_tokens DESC
+            """, (f"-{days} days",))
+            
+            results = await cursor.fetchall()
+            
+            if not results:
+                print("📊 Статистика запросов пуста.")
+                return
+            
+            print(f"\n⏱️  Статистика по типам запросов (последние {days} дней):")
+            print("-" * 100)
+            print(f"{'Kind':<10} {'Requests':<10} {'Tokens':<10} {'Prompt':<10} {'Completion':<11} {'Queue ms':<10} {'Run ms':<10} {'Send ms':<10}")
+            print("-" * 100)
+            
+            for row in results:
+                kind, requests, tokens, prompt, completion, queue_ms, run_ms, send_ms = row
+                print(f"{kind:<10} {requests:<10} {tokens or 0:<10} {prompt or 0:<10} {completion or 0:<11} "
+                      f"{round(queue_ms or 0):<10} {round(run_ms or 0):<10} {round(send_ms or 0):<10}")
+            
+            cursor = await db.execute("""
+                SELECT 
+                    chat_identifier,
+                    COUNT(*) as requests,
+                    SUM(tokens_used) as total_tokens,
+                    AVG(queue_ms + run_ms + COALESCE(send_ms, 0)) as avg_total_ms,
+                    MAX(queue_ms + run_ms + COALESCE(send_ms, 0)) as max_total_ms
+                FROM user_analytics 
+                WHERE request_date >= date('now', ?) AND chat_identifier IS NOT NULL
+                GROUP BY chat_identifier
+                ORDER BY total_tokens DESC
+                LIMIT 20
+            """, (f"-{days} days",))
+            
+            results = await cursor.fetchall()
+            
+            print(f"\n💬 Топ чатов по расходу токенов (последние {days} дней):")
+            print("-" * 90)
+            print(f"{'Chat':<35} {'Requests':<10} {'Tokens':<12} {'Avg ms':<12} {'Max ms':<12}")
+            print("-" * 90)
+            
+            for row in results:
+                chat_identifier, requests, tokens, avg_total_ms, max_total_ms = row
+                print(f"{chat_identifier:<35} {requests:<10} {tokens or 0:<12} "
+                      f"{round(avg_total_ms or 0):<12} {max_total_ms or 0:<12}")
+                
+    except Exception as e:
+        print(f"❌ Ошибка при получении статистики запросов: {e}")
+
+
+def show_live_activity():
+    """Показывает DAU/MAU и активность чатов из счетчиков Redis (без обращения к SQLite)."""
+    from activity_counters import get_activity_summary
+    
+    summary = get_activity_summary(top_chats=20)
+    if summary is None:
+        print("❌ Счетчики активности в Redis недоступны")
+        return
+    
+    print(f"\n⚡ Активность по счетчикам Redis (оценка HyperLogLog):")
+    print(f"   👤 DAU ({summary['date']}): {summary['dau']}")
+    print(f"   👥 MAU ({summary['month']}): {summary['mau']}")
+    print(f"   💬 Активных групп за день: {summary['active_chats_day']}")
+    print(f"   💬 Активных групп за месяц: {summary['active_chats_month']}")
+    print(f"   📨 Чатов с апдейтами за день: {summary['chats_with_updates']}")
+    
+    if summary["top_chats"]:
+        print("\n🔥 Самые активные чаты за день:")
+        print("-" * 40)
+        print(f"{'Chat ID':<20} {'Updates':<10}")
+        print("-" * 40)
+        for chat_id, count in summary["top_chats"]:
+            print(f"{chat_id:<20} {count:<10}")
+
+
 async def show_database_info():
     """Показывает общую информацию о базе данных."""
     try:
@@ -132,22 +265,29 @@ async def show_database_info():
         file_size = os.path.getsize(analytics.db_path)
         
         async with aiosqlite.connect(analytics.db_path) as db:
-            # Общее количество записей
-            cursor = await db.execute("SELECT COUNT(*) FROM user_analytics")
-            total_records = (await cursor.fetchone())[0]
+            # Общее количество записей и токенов (из сводной таблицы по дням)
+            cursor = await db.execute("SELECT SUM(requests_count), SUM(tokens_used) FROM daily_usage")
+            total_records, total_tokens = await cursor.fetchone()
+            total_records = total_records or 0
+            total_tokens = total_tokens or 0
             
-            # Количество уникальных пользователей
-            cursor = await db.execute("SELECT COUNT(DISTINCT user_id) FROM user_analytics")
+            # Количество уникальных пользователей (по первичному ключу сводной таблицы)
+            cursor = await db.execute("SELECT COUNT(*) FROM (SELECT DISTINCT user_id FROM user_daily_usage)")
             unique_users = (await cursor.fetchone())[0]
             
-            # Общее количество токенов
-            cursor = await db.execute("SELECT SUM(tokens_used) FROM user_analytics")
-            total_tokens = (await cursor.fetchone())[0] or 0
-            
-            # Дата первой и последней записи
-            cursor = await db.execute("SELECT MIN(created_at), MAX(created_at) FROM user_analytics")
+            # Период данных по сводной таблице (включает архивированные дни)
+            cursor = await db.execute("SELECT MIN(request_date), MAX(request_date) FROM daily_usage")
             date_range = await cursor.fetchone()
             
+            # Первое сырое событие, оставшееся в базе после архивирования (по первичному ключу)
+            cursor = await db.execute("SELECT created_at FROM user_analytics ORDER BY id ASC LIMIT 1")
+            first_raw = await cursor.fetchone()
+            
+            cursor = await db.execute("PRAGMA freelist_count")
+            free_pages = (await cursor.fetchone())[0]
+            cursor = await db.execute("PRAGMA auto_vacuum")
+            auto_vacuum = {0: "none", 1: "full", 2: "incremental"}.get((await cursor.fetchone())[0], "unknown")
+            
             print(f"🗃️  Информация о базе данных:")
             print(f"   📍 Путь: {analytics.db_path}")
             print(f"   📏 Размер файла: {file_size} байт ({file_size/1024:.1f} KB)")
@@ -155,12 +295,171 @@ async def show_database_info():
             print(f"   👥 Уникальных пользователей: {unique_users}")
             print(f"   🎯 Общее количество токенов: {total_tokens}")
             if date_range[0] and date_range[1]:
-                print(f"   📅 Период данных: {date_range[0][:19]} - {date_range[1][:19]}")
+                print(f"   📅 Период данных: {date_range[0]} - {date_range[1]}")
+            if first_raw:
+                print(f"   🧾 Сырые события с: {first_raw[0][:19]}")
+            print(f"   🧹 Auto-vacuum: {auto_vacuum}, свободных страниц: {free_pages}")
                 
     except Exception as e:
         print(f"❌ Ошибка при получении информации о базе: {e}")
 
 
+async def backfill_rollups():
+    """Заполняет сводные таблицы по уже существующим записям."""
+    try:
+        await analytics.init_database()
+        rebuilt_rows = await analytics.backfill_rollups()
+        print(f"✅ Сводные таблицы заполнены: {rebuilt_rows} строк (пользователь, дата)")
+    except Exception as e:
+        print(f"❌ Ошибка при заполнении сводных таблиц: {e}")
+    finally:
+        await analytics.close()
+
+
+async def archive_old_events():
+    """Переносит старые сырые события в архив и возвращает место в базе."""
+    try:
+        await analytics.init_database()
+        result = await analytics.run_retention()
+        print(f"✅ Перенесено в архив: {result['archived_events']} событий, "
+              f"освобождено страниц: {result['reclaimed_pages']}")
+    except Exception as e:
+        print(f"❌ Ошибка при архивировании: {e}")
+    finally:
+        await analytics.close()
+
+
+async def enable_incremental_vacuum():
+    """Однократно переводит базу в режим инкрементального auto-vacuum (полный VACUUM)."""
+    try:
+        await analytics.init_database()
+        enabled = await analytics.enable_incremental_vacuum()
+        if enabled:
+            print("✅ Инкрементальный auto-vacuum включен")
+        else:
+            print("❌ Не удалось включить инкрементальный auto-vacuum")
+    except Exception as e:
+        print(f"❌ Ошибка при выполнении VACUUM: {e}")
+    finally:
+        await analytics.close()
+
+
+def _build_export_query(dataset: dict, date_from: str = None, date_to: str = None, user_id: int = None):
+    """Собирает SELECT для экспорта с фильтрами по датам и пользователю."""
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append("request_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("request_date <= ?")
+        params.append(date_to)
+    if user_id is not None:
+        conditions.append("user_id = ?")
+        params.append(user_id)
+    
+    query = f"SELECT {', '.join(name for name, _ in dataset['columns'])} FROM {dataset['table']}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {dataset['order_by']}"
+    return query, params
+
+
+async def _iter_chunks(cursor):
+    """Читает курсор порциями по EXPORT_CHUNK_SIZE строк, не загружая результат целиком."""
+    while True:
+        rows = await cursor.fetchmany(EXPORT_CHUNK_SIZE)
+        if not rows:
+            break
+        yield rows
+
+
+async def _export_text(cursor, columns: list, export_format: str, output) -> int:
+    """Потоково пишет строки курсора в CSV или JSONL."""
+    names = [name for name, _ in columns]
+    exported = 0
+    writer = None
+    if export_format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(names)
+    
+    async for rows in _iter_chunks(cursor):
+        if writer:
+            writer.writerows(rows)
+        else:
+            output.writelines(json.dumps(dict(zip(names, row)), ensure_ascii=False) + "\n" for row in rows)
+        exported += len(rows)
+    return exported
+
+
+async def _export_parquet(cursor, columns: list, output_path: str) -> int:
+    """Потоково пишет строки курсора в Parquet: одна порция курсора - одна row group."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("для экспорта в Parquet установите pyarrow: pip install pyarrow")
+    
+    arrow_types = {"int": pa.int64(), "str": pa.string()}
+    schema = pa.schema([(name, arrow_types[column_type]) for name, column_type in columns])
+    exported = 0
+    with pq.ParquetWriter(output_path, schema, compression="zstd") as writer:
+        async for rows in _iter_chunks(cursor):
+            arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            exported += len(rows)
+    return exported
+
+
+async def export_data(argv: list):
+    """
+    Экспортирует данные аналитики в CSV, JSONL или Parquet.
+    Результат запроса читается порциями, поэтому потребление памяти не зависит от размера таблицы.
+    При ошибке завершает процесс с кодом 1, чтобы скрипты выгрузки могли ее обнаружить.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python view_analytics.py export",
+        description="Экспорт аналитики для внешних систем"
+    )
+    parser.add_argument("dataset", nargs="?", default="events", choices=EXPORT_DATASETS.keys(),
+                        help="events - сырые события, user-daily - сводка по пользователям и дням, daily - сводка по дням")
+    parser.add_argument("--format", dest="export_format", default="csv", choices=["csv", "jsonl", "parquet"])
+    parser.add_argument("--from", dest="date_from", help="начальная дата YYYY-MM-DD (включительно)")
+    parser.add_argument("--to", dest="date_to", help="конечная дата YYYY-MM-DD (включительно)")
+    parser.add_argument("--user", dest="user_id", type=int, help="ID пользователя Telegram")
+    parser.add_argument("--output", "-o", help="файл результата (по умолчанию stdout для csv/jsonl)")
+    args = parser.parse_args(argv)
+    
+    dataset = EXPORT_DATASETS[args.dataset]
+    if args.user_id is not None and not dataset["has_user"]:
+        parser.error(f"набор {args.dataset} не поддерживает фильтр --user")
+    if args.export_format == "parquet" and not args.output:
+        parser.error("для формата parquet нужен --output")
+    
+    try:
+        import aiosqlite
+        # Схема приводится к текущей до выгрузки: на немигрированной базе экспорт
+        # падает сразу, а не посреди потока данных
+        await analytics.init_database()
+        await analytics.close()
+        query, params = _build_export_query(dataset, args.date_from, args.date_to, args.user_id)
+        async with aiosqlite.connect(analytics.db_path) as db:
+            cursor = await db.execute(query, params)
+            if args.export_format == "parquet":
+                exported = await _export_parquet(cursor, dataset["columns"], args.output)
+            elif args.output:
+                with open(args.output, "w", encoding="utf-8", newline="") as output:
+                    exported = await _export_text(cursor, dataset["columns"], args.export_format, output)
+            else:
+                exported = await _export_text(cursor, dataset["columns"], args.export_format, sys.stdout)
+                sys.stdout.flush()
+        
+        print(f"✅ Экспортировано строк: {exported}", file=sys.stderr)
+    except Exception as e:
+        print(f"❌ Ошибка при экспорте: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
 async def main():
     """Основная функция для отображения аналитики."""
     
@@ -172,6 +471,12 @@ async def main():
             print("  python view_analytics.py users     - статистика по пользователям") 
             print("  python view_analytics.py daily     - статистика по дням")
             print("  python view_analytics.py info      - информация о базе")
+            print("  python view_analytics.py live      - DAU/MAU и активность чатов из Redis")
+            print("  python view_analytics.py requests  - стоимость и задержки по типам запросов и чатам")
+            print("  python view_analytics.py backfill  - заполнить сводные таблицы по старым данным")
+            print("  python view_analytics.py archive   - перенести старые события в архив")
+            print("  python view_analytics.py vacuum    - включить инкрементальный auto-vacuum (однократно)")
+            print("  python view_analytics.py export    - экспорт в CSV/JSONL/Parquet (export --help)")
             print("  python view_analytics.py help      - эта справка")
             return
         elif command == 'users':
@@ -185,6 +490,24 @@ async def main():
         elif command == 'info':
             await show_database_info()
             return
+        elif command == 'live':
+            show_live_activity()
+            return
+        elif command == 'requests':
+            await show_request_stats()
+            return
+        elif command == 'archive':
+            await archive_old_events()
+            return
+        elif command == 'vacuum':
+            await enable_incremental_vacuum()
+            return
+        elif command == 'backfill':
+            await backfill_rollups()
+            return
+        elif command == 'export':
+            await export_data(sys.argv[2:])
+            return
     
     # По умолчанию показываем всё
     await show_database_info()
@@ -194,8 +517,10 @@ async def main():
 
 
 if __name__ == "__main__":
-    print("🚀 Просмотр аналитики Telegram GPT Bot")
-    print("=" * 50)
+    # При экспорте stdout занят данными, служебный вывод уходит в stderr
+    banner_output = sys.stderr if len(sys.argv) > 1 and sys.argv[1].lower() == 'export' else sys.stdout
+    print("🚀 Просмотр аналитики Telegram GPT Bot", file=banner_output)
+    print("=" * 50, file=banner_output)
     
     try:
         asyncio.run(main())
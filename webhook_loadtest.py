@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный клиент для webhook-режима бота.
+Имитирует Telegram: отправляет синтетические апдейты POST-запросами на локальный
+webhook с заголовком X-Telegram-Bot-Api-Secret-Token и измеряет задержку приема.
+
+Сервер PTB отвечает 200 после постановки апдейта в очередь, поэтому замер показывает
+задержку приема апдейта, а не время ответа бота пользователю.
+
+По умолчанию шлются групповые сообщения без упоминания бота: они только добавляются
+в контекст беседы, запусков ассистента и ответов в Telegram нет. Личные сообщения
+(--private) запускают платные запросы к OpenAI и ответы в несуществующие чаты, поэтому
+требуют явного --allow-paid; запускайте их только против бота с тестовым ассистентом.
+
+Каждый запуск берет новый случайный диапазон update_id и message_id: бот помнит
+обработанные апдейты UPDATE_DEDUP_TTL секунд, и повторный прогон с теми же id
+измерил бы только отбрасывание дублей.
+
+Примеры:
+  python webhook_loadtest.py --requests 5000 --concurrency 50
+  python webhook_loadtest.py --url http://127.0.0.1:8443/telegram --chats 20 --private --allow-paid
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import sys
+import time
+
+import aiohttp
+
+from config import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN
+
+# Синтетические апдейты не должны пересекаться с настоящими update_id
+UPDATE_ID_BASE = 900_000_000
+
+# Размер диапазона id одного запуска; запуск выбирает один из ID_BLOCKS диапазонов
+ID_BLOCK_SIZE = 1_000_000
+ID_BLOCKS = 1_000_000
+
+
+def build_update(update_id: int, user_id: int, chat_id: int, private: bool) -> dict:
+    """Собирает апдейт с текстовым сообщением в формате Bot API."""
+    user = {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "username": f"load_{user_id}"}
+    if private:
+        chat = {"id": user_id, "type": "private", "first_name": user["first_name"]}
+    else:
+        chat = {"id": chat_id, "type": "supergroup", "title": f"Load chat {chat_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": chat,
+            "from": user,
+            "text": f"load test message {update_id}",
+        },
+    }
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """Перцентиль по отсортированному списку (ближайший ранг)."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def check_secret_rejected(session: aiohttp.ClientSession, url: str) -> bool:
+    """Проверяет, что сервер отклоняет апдейт с неверным секретным токеном."""
+    update = build_update(UPDATE_ID_BASE - 1, 1, -1, private=True)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "wrong-secret-token"}
+    async with session.post(url, json=update, headers=headers) as response:
+        return response.status == 403
+
+
+async def run_load(args) -> int:
+    """Отправляет апдейты с заданной параллельностью и печатает статистику."""
+    headers = {}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+
+    update_ids = itertools.count(args.id_base)
+    latencies = []
+    statuses = {}
+    errors = 0
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        if args.secret:
+            rejected = await check_secret_rejected(session, args.url)
+            print(f"🔐 Неверный секрет отклонен: {'да' if rejected else 'НЕТ'}")
+
+        async def worker(worker_index: int):
+            nonlocal errors
+            while True:
+                update_id = next(update_ids)
+                sequence = update_id - args.id_base
+                if sequence >= args.requests:
+                    return
+                user_id = args.user_base + sequence % args.users
+                chat_id = -(args.chat_base + sequence % args.chats)
+                update = build_update(update_id, user_id, chat_id, args.private)
+                started_at = time.perf_counter()
+                try:
+                    async with session.post(args.url, json=update, headers=headers) as response:
+                        await response.read()
+                        statuses[response.status] = statuses.get(response.status, 0) + 1
+                    latencies.append((time.perf_counter() - started_at) * 1000)
+                except Exception as e:
+                    errors += 1
+                    if errors <= 5:
+                        print(f"❌ Ошибка запроса в воркере {worker_index}: {e}", file=sys.stderr)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(worker(index) for index in range(args.concurrency)))
+        elapsed = time.perf_counter() - started_at
+
+    latencies.sort()
+    print(f"📨 Отправлено апдейтов: {args.requests} за {elapsed:.2f} с ({args.requests / elapsed:.0f} в секунду)")
+    print(f"   Статусы: {dict(sorted(statuses.items()))}, ошибок: {errors}")
+    if latencies:
+        print(f"   Задержка, мс: p50={percentile(latencies, 0.50):.1f} p90={percentile(latencies, 0.90):.1f} "
+              f"p99={percentile(latencies, 0.99):.1f} max={latencies[-1]:.1f}")
+    return 0 if errors == 0 and set(statuses) <= {200} else 1
+
+
+def main() -> int:
+    default_host = "127.0.0.1" if WEBHOOK_LISTEN in ("0.0.0.0", "::") else WEBHOOK_LISTEN
+    parser = argparse.ArgumentParser(description="Нагрузочный клиент для webhook-режима бота")
+    parser.add_argument("--url", default=f"http://{default_host}:{WEBHOOK_PORT}/{WEBHOOK_PATH.strip('/')}",
+                        help="адрес webhook (по умолчанию из WEBHOOK_LISTEN/WEBHOOK_PORT/WEBHOOK_PATH)")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET_TOKEN, help="секретный токен (по умолчанию WEBHOOK_SECRET_TOKEN)")
+    parser.add_argument("--requests", type=int, default=1000, help="сколько апдейтов отправить")
+    parser.add_argument("--concurrency", type=int, default=40, help="параллельных соединений (как max_connections)")
+    parser.add_argument("--users", type=int, default=100, help="число синтетических пользователей")
+    parser.add_argument("--chats", type=int, default=10, help="число синтетических групп")
+    parser.add_argument("--private", action="store_true",
+                        help="слать личные сообщения вместо групповых (платные запросы, нужен --allow-paid)")
+    parser.add_argument("--allow-paid", action="store_true",
+                        help="разрешить апдейты, на которые бот отвечает через OpenAI")
+    parser.add_argument("--user-base", type=int, default=1_000_000_000, help="первый синтетический user_id")
+    parser.add_argument("--chat-base", type=int, default=1_000_000_000_000, help="модуль первого синтетического chat_id")
+    parser.add_argument("--timeout", type=float, default=30, help="таймаут одного запроса, с")
+    parser.add_argument("--id-base", type=int,
+                        help="первый update_id (по умолчанию случайный, чтобы не попасть в окно де-дупликации)")
+    args = parser.parse_args()
+
+    if args.requests > ID_BLOCK_SIZE:
+        parser.error(f"--requests не больше {ID_BLOCK_SIZE}")
+    if args.id_base is None:
+        args.id_base = UPDATE_ID_BASE + random.randrange(1, ID_BLOCKS) * ID_BLOCK_SIZE
+    print(f"🆔 update_id с {args.id_base}")
+
+    if args.private:
+        if not args.allow_paid:
+            parser.error("--private запускает платные запросы к OpenAI и ответы в Telegram; добавьте --allow-paid")
+        print(f"⚠️ Каждый из {args.requests} апдейтов запустит ассистента OpenAI и ответ в Telegram", file=sys.stderr)
+
+    return asyncio.run(run_load(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())